@@ -5,7 +5,7 @@ import yaml
 from chainlit.utils import mount_chainlit
 from fastapi import FastAPI
 
-from src.api import public, redirect_middleware, router
+from src.api import internal_router, public, redirect_middleware, router
 
 
 def setup_logging(config_file):
@@ -21,6 +21,7 @@ app.middleware("http")(redirect_middleware)
 
 # Include the API router in the app
 app.include_router(router, prefix="/api")
+app.include_router(internal_router, prefix="/internal")
 
 # Include /public directory for static files
 app.mount("/public", public, name="public")
@@ -13,15 +13,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import gc
+import hashlib
 import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
-from typing import List
+from typing import Any, Hashable, List, Optional, Tuple
 
 import nltk
+import torch
 import typer
 import uvicorn
 from alignscore import AlignScore
 from fastapi import FastAPI
+from nltk.tokenize import sent_tokenize
 from pydantic import BaseModel
 
 # Make sure we have the punkt tokenizer downloaded.
@@ -39,6 +49,53 @@ app = FastAPI()
 
 device = os.environ.get("ALIGN_SCORE_DEVICE", "cpu")
 
+# Dynamic int8 quantization of the linear layers, for CPU inference
+quantize = os.environ.get("ALIGN_SCORE_QUANTIZE", "false").lower() == "true"
+
+# Requests scored together in one forward pass, and how long the first one waits for others
+batching = {
+    "max_batch_size": int(os.environ.get("ALIGN_SCORE_MAX_BATCH_SIZE", 32)),
+    "max_wait": float(os.environ.get("ALIGN_SCORE_MAX_WAIT_MS", 10)) / 1000,
+}
+
+
+class LRUCache:
+    """A bounded, thread-safe mapping evicting the least recently used entries."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+# Tokenized chunks of the evidences, which are usually the same few retrieved documents
+evidence_cache = LRUCache(int(os.environ.get("ALIGN_SCORE_EVIDENCE_CACHE_SIZE", 1024)))
+# Final scores, keyed by (model, evidence hash, claim hash)
+score_cache = LRUCache(int(os.environ.get("ALIGN_SCORE_SCORE_CACHE_SIZE", 65536)))
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
 
 @lru_cache
 def get_model(model: str):
@@ -47,13 +104,164 @@ def get_model(model: str):
     Args
         model: The type of the model to be loaded, i.e. "base", "large".
     """
-    return AlignScore(
+    model = AlignScore(
         model="roberta-base",
         batch_size=32,
         device=device,
         ckpt_path=os.path.join(models_path, f"AlignScore-{model}.ckpt"),
         evaluation_mode="nli_sp",
     )
+    model.model.verbose = False
+    if quantize:
+        model.model.model = torch.quantization.quantize_dynamic(
+            model.model.model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+def split_evidence(evidence: str) -> List[str]:
+    """Split the evidence into chunks of sentences of about 350 words, as AlignScore does.
+
+    Mirrors `Inferencer.inference_per_example` of AlignScore (alignscore/inference.py):
+        n_chunk = len(premise.strip().split()) // 350 + 1
+        n_chunk = max(len(premise_sents) // n_chunk, 1)
+    where the second `n_chunk` is the number of sentences per chunk. `test_server.py` checks
+    the chunks against the ones AlignScore.score builds.
+    """
+    sentences = sent_tokenize(evidence) or [""]
+    n_chunks = len(evidence.strip().split()) // 350 + 1
+    size = max(len(sentences) // n_chunks, 1)
+    return [" ".join(sentences[i : i + size]) for i in range(0, len(sentences), size)]
+
+
+def encode_evidence(tokenizer, evidence: str) -> List[List[int]]:
+    """Split and tokenize the evidence, cached by content hash."""
+    key = (tokenizer.name_or_path, content_hash(evidence))
+    chunks = evidence_cache.get(key)
+    if chunks is None:
+        chunks = tokenizer(split_evidence(evidence), add_special_tokens=False)[
+            "input_ids"
+        ]
+        evidence_cache.set(key, chunks)
+    return chunks
+
+
+def encode_pair(tokenizer, chunk: List[int], sentence: List[int]) -> List[int]:
+    """Build the input of an (evidence chunk, claim sentence) pair, truncating the evidence
+    first as AlignScore does."""
+    max_length = tokenizer.model_max_length - tokenizer.num_special_tokens_to_add(
+        pair=True
+    )
+    sentence = sentence[:max_length]
+    chunk = chunk[: max_length - len(sentence)]
+    return tokenizer.build_inputs_with_special_tokens(chunk, sentence)
+
+
+def score_pairs(model, pairs: List[Tuple[str, str]]) -> List[float]:
+    """Score (evidence, claim) pairs with a single batched pass of the model.
+
+    AlignScore.score runs one forward pass per pair in "nli_sp" mode. Here, the chunks of
+    every evidence are paired with the sentences of its claim, the whole set goes through
+    the model in mini-batches, and each claim gets the same aggregate as AlignScore: the mean
+    over its sentences of the best entailment probability among the evidence chunks.
+    Mini-batches are padded to their longest pair instead of the maximum length.
+    """
+    inferencer = model.model
+    tokenizer = inferencer.tokenizer
+    inputs, shapes = [], []
+    for evidence, claim in pairs:
+        chunks = encode_evidence(tokenizer, evidence)
+        sentences = tokenizer(sent_tokenize(claim) or [""], add_special_tokens=False)[
+            "input_ids"
+        ]
+        for chunk in chunks:
+            inputs.extend(
+                encode_pair(tokenizer, chunk, sentence) for sentence in sentences
+            )
+        shapes.append((len(chunks), len(sentences)))
+
+    # Pairs of similar lengths are batched together, to keep the padding small
+    order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]))
+    entailment = torch.empty(len(inputs))
+    with torch.no_grad():
+        for start in range(0, len(order), inferencer.batch_size):
+            indices = order[start : start + inferencer.batch_size]
+            batch = tokenizer.pad(
+                {"input_ids": [inputs[i] for i in indices]}, return_tensors="pt"
+            ).to(inferencer.device)
+            logits = inferencer.model(batch).tri_label_logits
+            entailment[indices] = torch.softmax(logits, dim=-1)[:, 0].cpu()
+
+    scores, start = [], 0
+    for n_chunks, n_sentences in shapes:
+        size = n_chunks * n_sentences
+        matrix = entailment[start : start + size].view(n_chunks, n_sentences)
+        scores.append(matrix.max(dim=0).values.mean().item())
+        start += size
+    return scores
+
+
+class MicroBatcher:
+    """Gather concurrent scoring requests of a model into batched forward passes.
+
+    The first pending request waits at most `max_wait` seconds for others to join, and a
+    batch holds at most `max_batch_size` pairs. Batches run one at a time in a worker thread,
+    so the event loop keeps accepting requests while the model is busy.
+    """
+
+    def __init__(self, model, max_batch_size: int = 32, max_wait: float = 0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = None
+        self.worker: asyncio.Task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def score(self, evidence: str, claim: str) -> float:
+        """Score a claim against an evidence, along with the other pending requests."""
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self.__run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(((evidence, claim), future))
+        return await future
+
+    async def __next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.__next_batch()
+            pairs = [pair for pair, _ in batch]
+            try:
+                scores = await loop.run_in_executor(
+                    self.executor, score_pairs, self.model, pairs
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), score in zip(batch, scores):
+                if not future.done():
+                    future.set_result(score)
+
+
+@lru_cache
+def get_batcher(model: str) -> MicroBatcher:
+    """Get the micro-batcher of a model."""
+    return MicroBatcher(get_model(model), **batching)
 
 
 class AlignScoreRequest(BaseModel):
@@ -61,32 +269,64 @@ class AlignScoreRequest(BaseModel):
     claim: str
 
 
+class AlignScoreBatchRequest(BaseModel):
+    evidence: str
+    claims: List[str]
+
+
 @app.get("/")
 def hello_world():
     welcome_str = (
         f"This is a development server to host AlignScore models.\n"
         + f"<br>Hit the /alignscore_base or alignscore_large endpoints with "
         f"a POST request containing evidence and claim.\n"
+        + f"<br>Hit the /alignscore_base/batch or /alignscore_large/batch endpoints "
+        f"with an evidence and a list of claims to score them together.\n"
         + f"<br>Example: curl -X POST -d 'evidence=This is an evidence "
         f"passage&claim=This is a claim.' http://localhost:8000/alignscore_base\n"
     )
     return welcome_str
 
 
-def get_alignscore(model, evidence: str, claim: str) -> dict:
-    return {"alignscore": model.score(contexts=[evidence], claims=[claim])[0]}
+async def cached_score(model: str, evidence: str, claim: str) -> float:
+    """Score a claim against an evidence, unless it was scored before."""
+    key = (model, content_hash(evidence), content_hash(claim))
+    score = score_cache.get(key)
+    if score is None:
+        score = await get_batcher(model).score(evidence, claim)
+        score_cache.set(key, score)
+    return score
+
+
+async def get_alignscore(model: str, evidence: str, claim: str) -> dict:
+    return {"alignscore": await cached_score(model, evidence, claim)}
+
+
+async def get_alignscores(model: str, evidence: str, claims: List[str]) -> dict:
+    scores = await asyncio.gather(
+        *[cached_score(model, evidence, claim) for claim in claims]
+    )
+    return {"alignscores": list(scores)}
 
 
 @app.post("/alignscore_base")
-def alignscore_base(request: AlignScoreRequest):
-    model = get_model("base")
-    return get_alignscore(model, request.evidence, request.claim)
+async def alignscore_base(request: AlignScoreRequest):
+    return await get_alignscore("base", request.evidence, request.claim)
 
 
 @app.post("/alignscore_large")
-def alignscore_large(request: AlignScoreRequest):
-    model = get_model("large")
-    return get_alignscore(model, request.evidence, request.claim)
+async def alignscore_large(request: AlignScoreRequest):
+    return await get_alignscore("large", request.evidence, request.claim)
+
+
+@app.post("/alignscore_base/batch")
+async def alignscore_base_batch(request: AlignScoreBatchRequest):
+    return await get_alignscores("base", request.evidence, request.claims)
+
+
+@app.post("/alignscore_large/batch")
+async def alignscore_large_batch(request: AlignScoreBatchRequest):
+    return await get_alignscores("large", request.evidence, request.claims)
 
 
 cli_app = typer.Typer()
@@ -104,7 +344,44 @@ def start(
     initialize_only: bool = typer.Option(
         default=False, help="Whether to run only the initialization for the models."
     ),
+    max_batch_size: int = typer.Option(
+        default=batching["max_batch_size"],
+        help="The maximum number of requests scored in one forward pass.",
+    ),
+    max_wait_ms: float = typer.Option(
+        default=batching["max_wait"] * 1000,
+        help="How long a request waits for others to be batched with, in milliseconds.",
+    ),
+    quantize_int8: bool = typer.Option(
+        default=quantize,
+        help="Whether to quantize the models to int8 for faster CPU inference.",
+    ),
+    intra_op_threads: Optional[int] = typer.Option(
+        default=None,
+        help="The number of threads of each operator, per worker. "
+        "Defaults to the number of cores divided by the number of workers.",
+    ),
+    inter_op_threads: Optional[int] = typer.Option(
+        default=None, help="The number of threads running operators in parallel."
+    ),
+    workers: int = typer.Option(
+        default=1,
+        help="The number of server processes, forked after loading the models so that "
+        "they share the weights.",
+    ),
 ):
+    global quantize
+    quantize = quantize_int8
+    if quantize and device != "cpu":
+        raise typer.BadParameter("int8 quantization is only supported on cpu.")
+    batching.update(max_batch_size=max_batch_size, max_wait=max_wait_ms / 1000)
+
+    if intra_op_threads is None:
+        intra_op_threads = max((os.cpu_count() or 1) // workers, 1)
+    torch.set_num_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        torch.set_num_interop_threads(inter_op_threads)
+
     # Preload the models
     for model in models:
         typer.echo(f"Pre-loading model {model}.")
@@ -112,9 +389,47 @@ def start(
 
     if initialize_only:
         print("Initialization successful.")
+    elif workers > 1:
+        serve_forked(port, workers, intra_op_threads)
     else:
         uvicorn.run(app, host="0.0.0.0", port=port)
 
 
+def serve_forked(port: int, workers: int, intra_op_threads: int):
+    """Serve the app from several processes forked after the models are loaded.
+
+    The weights are shared copy-on-write by the workers, which accept connections on the
+    same socket. The models must not have run yet: the thread pools of torch do not survive
+    a fork, the workers start their own on their first request.
+    """
+    config = uvicorn.Config(app, host="0.0.0.0", port=port)
+    sock = config.bind_socket()
+    # Keep the garbage collector from touching, and so copying, the objects loaded so far
+    gc.freeze()
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            torch.set_num_threads(intra_op_threads)
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        children.append(pid)
+    typer.echo(f"Started {workers} workers: {children}")
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
 if __name__ == "__main__":
     cli_app()
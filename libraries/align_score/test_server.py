@@ -0,0 +1,58 @@
+# Parity of the batched scoring of the server with AlignScore.score.
+#
+# Usage (from libraries/align_score, with the AlignScore package and checkpoints installed):
+#   ALIGN_SCORE_PATH=/app/AlignScore python -m pytest test_server.py
+import os
+
+import pytest
+
+pytest.importorskip("alignscore")
+if not os.path.exists(
+    os.path.join(os.environ.get("ALIGN_SCORE_PATH", ""), "AlignScore-base.ckpt")
+):
+    pytest.skip("AlignScore-base checkpoint not found", allow_module_level=True)
+
+import server  # noqa: E402
+
+SENTENCES = [
+    "The film was directed by Christopher Nolan and released in 2010.",
+    "It follows a thief who steals corporate secrets through dream-sharing technology.",
+    "The cast includes Leonardo DiCaprio, Joseph Gordon-Levitt and Elliot Page.",
+    "Principal photography took place in six countries over several months.",
+    "The score, composed by Hans Zimmer, became one of the most recognized of the decade.",
+]
+# About 1000 words, so that the evidence is split into several chunks
+LONG_EVIDENCE = " ".join(SENTENCES * 16)
+CLAIMS = [
+    "Inception was directed by Christopher Nolan.",
+    "The music was composed by John Williams. It was released in 1999.",
+    "Leonardo DiCaprio stars in the film.",
+]
+
+
+@pytest.fixture(scope="module")
+def model():
+    return server.get_model("base")
+
+
+def test_split_evidence_matches_alignscore(model, monkeypatch):
+    premises = []
+    inference = model.model.inference
+
+    def record(premise, hypo):
+        premises.extend(premise)
+        return inference(premise, hypo)
+
+    monkeypatch.setattr(model.model, "inference", record)
+    model.score(contexts=[LONG_EVIDENCE], claims=[CLAIMS[0]])
+
+    chunks = server.split_evidence(LONG_EVIDENCE)
+    assert len(chunks) > 1
+    # The claim has a single sentence, so AlignScore pairs it once with each chunk
+    assert premises == chunks
+
+
+def test_score_pairs_matches_alignscore(model):
+    expected = model.score(contexts=[LONG_EVIDENCE] * len(CLAIMS), claims=CLAIMS)
+    scores = server.score_pairs(model, [(LONG_EVIDENCE, claim) for claim in CLAIMS])
+    assert scores == pytest.approx(expected, abs=1e-4)
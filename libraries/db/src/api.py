@@ -1,23 +1,98 @@
 # FastAPI to access qdrant database
+import asyncio
 import logging
+import os
 import sys
 from pathlib import Path
 from typing import Dict, List, Union
 
-from fastapi import FastAPI
+import aiohttp
+from fastapi import FastAPI, HTTPException
 
 # Add the parent directory to sys.path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-from src.model import ContextDocument, ContextDocumentList, ContextRequest
-from src.qdrant import ContextRetriever
+from src.model import (
+    ContextBatchRequest,
+    ContextDocument,
+    ContextDocumentList,
+    ContextRequest,
+    CreateIndexRequest,
+    DeleteRequest,
+    IndexConfig,
+)
+from src.qdrant import ContextRetriever, content_id, hash_to_id
 
 logger = logging.getLogger(__name__)
 
-db_manager = ContextRetriever(url="http://qdrant:6333", collection="documents")
+db_manager = ContextRetriever(
+    url=os.environ.get("QDRANT_URL", "http://qdrant:6333"),
+    collection="documents",
+    prefer_grpc=os.environ.get("QDRANT_PREFER_GRPC", "false").lower() == "true",
+    grpc_port=int(os.environ.get("QDRANT_GRPC_PORT", 6334)),
+    max_workers=int(os.environ.get("EMBEDDING_WORKERS", os.cpu_count() or 1)),
+    title_refresh_interval=float(os.environ.get("TITLE_INDEX_REFRESH_INTERVAL", 300)),
+)
+
+# Endpoints notified when the documents of an index change, to invalidate their caches
+CACHE_INVALIDATION_URLS = [
+    url for url in os.environ.get("CACHE_INVALIDATION_URLS", "").split(",") if url
+]
+# Shared token sent in the X-Internal-Token header of the notifications
+CACHE_INVALIDATION_TOKEN = os.environ.get("CACHE_INVALIDATION_TOKEN")
 
 db = FastAPI()  # Set up server
 
+# Connect to qdrant once the event loop runs, and release the connections on shutdown
+db.add_event_handler("startup", db_manager.initialize)
+db.add_event_handler("shutdown", db_manager.close)
+
+
+@db.get("/healthz", tags=["db"])
+async def healthz() -> Dict[str, str]:
+    """Liveness of the service, answered without embedding or searching anything."""
+    return {"status": "ok"}
+
+
+async def __notify(session: aiohttp.ClientSession, url: str, indexes: List[str]):
+    try:
+        async with session.post(url, json={"indexes": indexes}) as response:
+            response.raise_for_status()
+    except Exception as e:
+        logger.error(f"Could not invalidate cache at {url}: {e!r}")
+
+
+async def invalidate_caches(indexes: List[str]):
+    """Notify subscribed services that the documents of some indexes changed."""
+    if not CACHE_INVALIDATION_URLS:
+        return
+    timeout = aiohttp.ClientTimeout(total=2)
+    headers = (
+        {"X-Internal-Token": CACHE_INVALIDATION_TOKEN}
+        if CACHE_INVALIDATION_TOKEN
+        else None
+    )
+    async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
+        await asyncio.gather(
+            *[__notify(session, url, indexes) for url in CACHE_INVALIDATION_URLS]
+        )
+
+
+@db.post("/create_index", tags=["db"])
+async def create_index(request: CreateIndexRequest) -> Dict[str, bool]:
+    """Create a collection with quantization, on-disk storage and HNSW settings.
+    Args:
+        request (CreateIndexRequest): Name and settings of the collection.
+    Returns:
+        Dict[str, bool]: Whether the collection was created, False if it already existed.
+    """
+    config = IndexConfig(**request.model_dump(exclude={"name"}))
+    created = await db_manager.create_index(request.name, config=config)
+    logger.info(
+        f"Collection {request.name} {'created' if created else 'already exists'}"
+    )
+    return {"created": created}
+
 
 @db.post("/add_documents", tags=["db"])
 async def add_documents(request: ContextDocumentList) -> List[str]:
@@ -32,15 +107,33 @@ async def add_documents(request: ContextDocumentList) -> List[str]:
         *[(doc.document, doc.metadata) for doc in request.documents]
     )
     # make sure metadata is not None
-    ids = db_manager.add_documents(documents, metadata, index=request.index)
+    ids = await db_manager.add_documents(documents, metadata, index=request.index)
     logger.info(f"Loaded {len(request.documents)} documents: {ids}")
+    await invalidate_caches([request.index or db_manager.collection_name])
     return ids
 
 
+@db.post("/sync_documents", tags=["db"])
+async def sync_documents(request: ContextDocumentList) -> Dict[str, int]:
+    """Make an index hold exactly the given documents.
+    Unchanged documents are skipped, and documents missing from the request are deleted.
+    Args:
+        request (ContextDocumentList): Full list of documents of the index.
+    Returns:
+        Dict[str, int]: Number of documents added, unchanged and deleted.
+    """
+    documents = [doc.document for doc in request.documents]
+    metadata = [doc.metadata or {} for doc in request.documents]
+    stats = await db_manager.sync_documents(documents, metadata, index=request.index)
+    if stats["added"] or stats["deleted"]:
+        await invalidate_caches([request.index or db_manager.collection_name])
+    return stats
+
+
 @db.post("/search", tags=["db"])
 async def search(request: ContextRequest) -> List[ContextDocument]:
     # Retrieve documents
-    response = db_manager.search(
+    response = await db_manager.search(
         request.text,
         threshold=request.threshold,
         limit=request.limit,
@@ -50,14 +143,72 @@ async def search(request: ContextRequest) -> List[ContextDocument]:
     return response
 
 
+@db.post("/search_batch", tags=["db"])
+async def search_batch(request: ContextBatchRequest) -> List[List[ContextDocument]]:
+    """Retrieve documents for several texts in one call.
+    Args:
+        request (ContextBatchRequest): Texts to search and search parameters.
+    Returns:
+        List[List[ContextDocument]]: Documents retrieved for each text, in the same order.
+    """
+    response = await db_manager.search_batch(
+        request.texts,
+        threshold=request.threshold,
+        limit=request.limit,
+        indexes=request.indexes,
+    )
+    logger.info(f"Retrieved documents for {len(response)} texts.")
+    return response
+
+
 @db.delete("/delete_documents", tags=["db"])
 async def delete_documents(request: ContextDocumentList):
-    # Retrieve documents
-    documents = [
-        db_manager.search(text, threshold=1, limit=1, index=request.index)[0]
-        for text in request.documents
+    """Delete documents by content, or by id when given.
+    Args:
+        request (ContextDocumentList): List of documents to delete.
+    """
+    # Point ids are derived from the content, no need to search the documents
+    document_ids = [
+        doc.id if doc.id is not None else content_id(doc.document, doc.metadata)
+        for doc in request.documents
     ]
-    document_ids = [doc.id for doc in documents]
     # Delete documents
-    db_manager.delete_documents(document_ids=document_ids, index=request.index)
+    await db_manager.delete_documents(document_ids=document_ids, index=request.index)
+    await invalidate_caches([request.index or db_manager.collection_name])
     return
+
+
+@db.delete("/delete", tags=["db"])
+async def delete(request: DeleteRequest) -> Dict[str, Union[int, str]]:
+    """Delete documents by id, content hash or metadata filter, in as few requests as possible.
+    Args:
+        request (DeleteRequest): Ids, content hashes and/or filter of the documents to delete.
+    Returns:
+        Dict[str, Union[int, str]]: Number of ids and hashes requested for deletion (ids of
+        missing documents included), and status of the deletion by filter, if any.
+    """
+    try:
+        hashed_ids = [hash_to_id(content_hash) for content_hash in request.hashes]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid content hash")
+    document_ids = [*request.ids, *hashed_ids]
+    has_filter = request.collection is not None or request.older_than is not None
+    if not document_ids and not has_filter:
+        raise HTTPException(
+            status_code=400, detail="Provide ids, hashes or a filter to delete"
+        )
+
+    deleted: Dict[str, Union[int, str]] = {"requested_ids": 0}
+    if document_ids:
+        await db_manager.delete_documents(
+            document_ids=document_ids, index=request.index
+        )
+        deleted["requested_ids"] = len(document_ids)
+    if has_filter:
+        deleted["filter_status"] = await db_manager.delete_by_filter(
+            collection=request.collection,
+            older_than=request.older_than,
+            index=request.index,
+        )
+    await invalidate_caches([request.index or db_manager.collection_name])
+    return deleted
@@ -0,0 +1,306 @@
+# Benchmark of the storage settings of a collection: memory footprint, recall and latency
+#
+# Usage (from libraries/db):
+#   python -m src.benchmark imbd_movies --queries 200 --limit 10 --ef 64 128 256
+#
+# The points of the source collection are copied into one temporary collection per setting,
+# a held-out sample of them being used as queries. Recall@limit is measured against an exact
+# (brute force) search of the full precision vectors.
+import argparse
+import json
+import logging
+import math
+import random
+import statistics
+import time
+from typing import Dict, List, Optional, Tuple
+
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    CollectionStatus,
+    HnswConfigDiff,
+    OptimizersConfigDiff,
+    PointStruct,
+    QuantizationSearchParams,
+    SearchParams,
+)
+from tqdm import tqdm
+
+from src.model import IndexConfig
+from src.qdrant import create_collection, search_params
+
+logger = logging.getLogger(__name__)
+
+SETTINGS: Dict[str, IndexConfig] = {
+    "full-precision": IndexConfig(),
+    "full-precision-on-disk": IndexConfig(on_disk=True),
+    "scalar": IndexConfig(quantization="scalar", quantile=0.99),
+    "scalar-on-disk": IndexConfig(quantization="scalar", quantile=0.99, on_disk=True),
+    "product-x16-on-disk": IndexConfig(
+        quantization="product", compression="x16", on_disk=True
+    ),
+    "binary-on-disk": IndexConfig(
+        quantization="binary", oversampling=3.0, on_disk=True
+    ),
+}
+
+# Qdrant defaults, used to estimate the size of the HNSW graph
+DEFAULT_HNSW_M = 16
+
+
+def estimate_memory(config: IndexConfig, count: int, dimension: int) -> Dict[str, int]:
+    """Estimate the bytes of RAM and disk used by the vectors and the HNSW graph of a collection.
+    Qdrant only reports sizes through its telemetry, the estimate follows its storage layout:
+    float32 original vectors, int8 scalar quantization, one byte per sub-vector of the product
+    quantization and one bit per dimension of the binary quantization.
+    """
+    original = count * dimension * 4
+    if config.quantization == "scalar":
+        quantized = count * dimension
+    elif config.quantization == "product":
+        quantized = original // int(config.compression[1:])
+    elif config.quantization == "binary":
+        quantized = count * math.ceil(dimension / 8)
+    else:
+        quantized = 0
+    # Level 0 of the graph holds up to 2 * m links of 4 bytes per point
+    graph = count * 2 * (config.hnsw_m or DEFAULT_HNSW_M) * 4
+
+    ram = graph + (0 if config.on_disk else original)
+    disk = original + quantized
+    if config.always_ram:
+        ram += quantized
+    return {"ram": ram, "disk": disk}
+
+
+def read_points(
+    client: QdrantClient, collection_name: str, vector_name: str, batch_size: int = 1000
+) -> List[PointStruct]:
+    """Read every point of a collection, with its vector and payload."""
+    points = []
+    offset = None
+    progress = tqdm(desc=f"Reading {collection_name}", unit="points")
+    while True:
+        records, offset = client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=[vector_name],
+        )
+        points.extend(
+            PointStruct(id=record.id, vector=record.vector, payload=record.payload)
+            for record in records
+        )
+        progress.update(len(records))
+        if offset is None:
+            break
+    progress.close()
+    return points
+
+
+def build_collection(
+    client: QdrantClient,
+    collection_name: str,
+    config: IndexConfig,
+    points: List[PointStruct],
+    batch_size: int = 256,
+    timeout: float = 600,
+):
+    """Create a collection with a setting, load the points and wait for the index to be built."""
+    if client.collection_exists(collection_name=collection_name):
+        client.delete_collection(collection_name=collection_name)
+    create_collection(client, collection_name, config)
+    # Index and search the graph whatever the size of the sample, as a large corpus would be
+    client.update_collection(
+        collection_name=collection_name,
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=1),
+        hnsw_config=HnswConfigDiff(full_scan_threshold=1),
+    )
+    for start in tqdm(
+        range(0, len(points), batch_size), desc=f"Loading {collection_name}"
+    ):
+        client.upsert(
+            collection_name=collection_name,
+            points=points[start : start + batch_size],
+            wait=True,
+        )
+
+    deadline = time.monotonic() + timeout
+    while True:
+        info = client.get_collection(collection_name)
+        if info.status == CollectionStatus.GREEN and (
+            info.indexed_vectors_count or 0
+        ) >= len(points):
+            return
+        if time.monotonic() > deadline:
+            logger.warning(f"Index of {collection_name} not built after {timeout}s")
+            return
+        time.sleep(1)
+
+
+def run_queries(
+    client: QdrantClient,
+    collection_name: str,
+    vector_name: str,
+    queries: List[PointStruct],
+    limit: int,
+    params: Optional[SearchParams],
+) -> Tuple[List[List[str]], List[float]]:
+    """Search the nearest points of each query, one at a time.
+    Returns:
+        Tuple[List[List[str]], List[float]]: Ids found and latency in seconds of each query.
+    """
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        points = client.search(
+            collection_name=collection_name,
+            query_vector=(vector_name, query.vector[vector_name]),
+            limit=limit,
+            search_params=params,
+            with_payload=False,
+        )
+        latencies.append(time.perf_counter() - start)
+        results.append([str(point.id) for point in points])
+    return results, latencies
+
+
+def recall(found: List[List[str]], expected: List[List[str]]) -> float:
+    """Mean fraction of the exact nearest neighbours found by each query."""
+    return statistics.mean(
+        len(set(ids) & set(truth)) / len(truth) if truth else 1.0
+        for ids, truth in zip(found, expected)
+    )
+
+
+def benchmark(
+    source: str,
+    url: str = "http://localhost:6333",
+    settings: Optional[List[str]] = None,
+    num_queries: int = 100,
+    limit: int = 10,
+    ef_values: Optional[List[int]] = None,
+    hnsw_m: Optional[int] = None,
+    hnsw_ef_construct: Optional[int] = None,
+    seed: int = 0,
+    keep: bool = False,
+) -> List[Dict]:
+    """Compare the memory footprint, recall and latency of storage settings on a collection.
+    Args:
+        source (str): Name of the collection to sample points and queries from.
+        url (str): Url to the qdrant server. Defaults to "http://localhost:6333".
+        settings (Optional[List[str]]): Names of the settings to compare, all of SETTINGS if None.
+        num_queries (int): Number of points held out as queries. Defaults to 100.
+        limit (int): Number of neighbours searched per query. Defaults to 10.
+        ef_values (Optional[List[int]]): Search `ef` values to try per setting, Qdrant default if None.
+        hnsw_m (Optional[int]): HNSW `m` of every setting, Qdrant default if None.
+        hnsw_ef_construct (Optional[int]): HNSW `ef_construct` of every setting, Qdrant default if None.
+        seed (int): Seed of the query sample. Defaults to 0.
+        keep (bool): Keep the benchmark collections instead of deleting them. Defaults to False.
+    Returns:
+        List[Dict]: One result per setting and `ef` value.
+    """
+    client = QdrantClient(url=url, timeout=60)
+    vector_name = client.get_vector_field_name()
+    points = read_points(client, source, vector_name)
+    if len(points) <= num_queries:
+        raise ValueError(
+            f"{source} has {len(points)} points, not enough for {num_queries} queries"
+        )
+    random.Random(seed).shuffle(points)
+    queries, points = points[:num_queries], points[num_queries:]
+    dimension = len(points[0].vector[vector_name])
+
+    results = []
+    truth = None
+    for name in settings or SETTINGS:
+        config = SETTINGS[name].model_copy(
+            update={"hnsw_m": hnsw_m, "hnsw_ef_construct": hnsw_ef_construct}
+        )
+        collection_name = f"{source}__benchmark_{name}"
+        build_collection(client, collection_name, config, points)
+        if truth is None:
+            truth, _ = run_queries(
+                client,
+                collection_name,
+                vector_name,
+                queries,
+                limit,
+                SearchParams(
+                    exact=True, quantization=QuantizationSearchParams(ignore=True)
+                ),
+            )
+
+        memory = estimate_memory(config, len(points), dimension)
+        for ef in ef_values or [None]:
+            params = search_params(config.model_copy(update={"hnsw_ef": ef}))
+            # Warm up the caches and the memory-mapped pages before measuring
+            run_queries(client, collection_name, vector_name, queries, limit, params)
+            found, latencies = run_queries(
+                client, collection_name, vector_name, queries, limit, params
+            )
+            latencies = sorted(latencies)
+            results.append(
+                {
+                    "setting": name,
+                    "ef": ef,
+                    "ram_mb": memory["ram"] / 2**20,
+                    "disk_mb": memory["disk"] / 2**20,
+                    "recall": recall(found, truth),
+                    "p50_ms": latencies[len(latencies) // 2] * 1000,
+                    "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+                }
+            )
+        if not keep:
+            client.delete_collection(collection_name=collection_name)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the memory footprint, recall and latency of collection settings."
+    )
+    parser.add_argument("source", help="Name of the collection to sample from")
+    parser.add_argument("--url", type=str, default="http://localhost:6333")
+    parser.add_argument("--settings", nargs="+", choices=list(SETTINGS), default=None)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--ef", type=int, nargs="+", default=None)
+    parser.add_argument("--m", type=int, default=None)
+    parser.add_argument("--ef-construct", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true")
+    parser.add_argument("--json", action="store_true", help="Print results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = benchmark(
+        args.source,
+        url=args.url,
+        settings=args.settings,
+        num_queries=args.queries,
+        limit=args.limit,
+        ef_values=args.ef,
+        hnsw_m=args.m,
+        hnsw_ef_construct=args.ef_construct,
+        seed=args.seed,
+        keep=args.keep,
+    )
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(
+        f"{'setting':<24}{'ef':>6}{'RAM MB':>10}{'disk MB':>10}"
+        f"{'recall@' + str(args.limit):>11}{'p50 ms':>9}{'p99 ms':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['setting']:<24}{result['ef'] or '-':>6}"
+            f"{result['ram_mb']:>10.1f}{result['disk_mb']:>10.1f}"
+            f"{result['recall']:>11.3f}{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
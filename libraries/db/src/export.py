@@ -0,0 +1,156 @@
+# Export of a collection to a memory-mapped ANN snapshot, searchable without qdrant
+#
+# Usage (from libraries/db):
+#   python -m src.export imbd_movies --output snapshots
+#
+# Each export is written to its own versioned directory (.<collection>.<version>), and the
+# snapshot of a collection is a symlink named after it, pointing to the latest version.
+# A snapshot version is a directory holding:
+#   meta.json     collection, embedding model, dimension, metric and number of points
+#   vectors.ann   annoy index (angular metric) of the vectors, item i being the i-th point
+#   payloads.bin  concatenated utf-8 json records {"id", "document", "metadata"}
+#   offsets.npy   int64 offsets of the records in payloads.bin (one more than the points)
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+from annoy import AnnoyIndex
+from qdrant_client import QdrantClient
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def export_snapshot(
+    collection_name: str,
+    output_dir: Path,
+    url: str = "http://localhost:6333",
+    n_trees: int = 50,
+    batch_size: int = 1000,
+) -> Path:
+    """Export the vectors and payloads of a collection to an ANN snapshot.
+    The snapshot is written to a new versioned directory, then published by atomically
+    replacing the symlink of the collection, so readers always find a complete snapshot.
+    The previous version is kept for readers still opening it, older ones are removed.
+    Args:
+        collection_name (str): Name of the collection to export.
+        output_dir (Path): Directory of the snapshots, the snapshot is written to a subdirectory named after the collection.
+        url (str): Url to the qdrant server. Defaults to "http://localhost:6333".
+        n_trees (int): Number of annoy trees, more trees give more accurate searches. Defaults to 50.
+        batch_size (int): Number of points read per request. Defaults to 1000.
+    Returns:
+        Path: Symlink to the snapshot.
+    """
+    client = QdrantClient(url=url)
+    vector_name = client.get_vector_field_name()
+    dimension = (
+        client.get_collection(collection_name).config.params.vectors[vector_name].size
+    )
+
+    destination = Path(output_dir) / collection_name
+    staging = destination.with_name(f".{collection_name}.{time.time_ns()}")
+    staging.mkdir(parents=True)
+
+    index = AnnoyIndex(dimension, "angular")
+    index.on_disk_build(str(staging / "vectors.ann"))
+    offsets = [0]
+    count = 0
+    progress = tqdm(desc=f"Exporting {collection_name}", unit="points")
+    with open(staging / "payloads.bin", "wb") as payloads:
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                collection_name=collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=[vector_name],
+            )
+            for point in points:
+                payload = dict(point.payload or {})
+                record = {
+                    "id": point.id,
+                    "document": payload.pop("document", ""),
+                    "metadata": payload,
+                }
+                index.add_item(count, point.vector[vector_name])
+                payloads.write(json.dumps(record).encode("utf-8"))
+                offsets.append(payloads.tell())
+                count += 1
+            progress.update(len(points))
+            if offset is None:
+                break
+    progress.close()
+
+    index.build(n_trees)
+    index.unload()
+    np.save(staging / "offsets.npy", np.array(offsets, dtype=np.int64))
+    meta = {
+        "collection": collection_name,
+        "model": client.embedding_model_name,
+        "dimension": dimension,
+        "metric": "angular",
+        "count": count,
+        "created_at": time.time(),
+    }
+    (staging / "meta.json").write_text(json.dumps(meta))
+
+    publish_snapshot(staging, destination)
+
+    logger.info(f"Exported {count} points of {collection_name} to {destination}")
+    return destination
+
+
+def publish_snapshot(version: Path, destination: Path):
+    """Point the symlink of a collection to a new snapshot version, atomically.
+    Args:
+        version (Path): Directory of the new snapshot version, next to the destination.
+        destination (Path): Symlink of the collection.
+    """
+    previous = os.readlink(destination) if destination.is_symlink() else None
+    if destination.exists() and not destination.is_symlink():
+        # Snapshots exported before versioning were plain directories, move it aside once
+        previous = f".{destination.name}.0"
+        destination.rename(destination.with_name(previous))
+
+    link = destination.with_name(f".{destination.name}.link.{os.getpid()}")
+    link.unlink(missing_ok=True)
+    link.symlink_to(version.name)
+    os.replace(link, destination)
+
+    # Keep the previous version for readers that resolved the symlink before the replace,
+    # and newer ones that concurrent exports may still be writing
+    number = int(version.name.rsplit(".", 1)[1])
+    for stale in destination.parent.glob(f".{destination.name}.*"):
+        suffix = stale.name.rsplit(".", 1)[1]
+        if (
+            suffix.isdigit()
+            and int(suffix) < number
+            and stale.name != previous
+            and not stale.is_symlink()
+        ):
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export collections to memory-mapped ANN snapshots."
+    )
+    parser.add_argument("collections", nargs="+", help="Names of the collections")
+    parser.add_argument("--output", type=Path, default=Path("snapshots"))
+    parser.add_argument("--url", type=str, default="http://localhost:6333")
+    parser.add_argument("--trees", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for collection_name in args.collections:
+        export_snapshot(collection_name, args.output, url=args.url, n_trees=args.trees)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+# Streaming ingestion of csv corpora into the qdrant database
+#
+# Usage (from libraries/db):
+#   python -m src.ingest "../../data/movie_plots/*.csv" --index movie_plots --format plots
+#   python -m src.ingest imdb_movies.csv --index imbd_movies --format table
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import re
+import sys
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from qdrant_client import QdrantClient
+from qdrant_client.models import PointIdsList, PointStruct
+from tqdm import tqdm
+
+from src.qdrant import collection_ids, content_id, create_collection
+
+logger = logging.getLogger(__name__)
+
+# Renamed columns of the tabular corpora, as done in data/data_preparation.ipynb
+COLUMN_NAMES = {
+    "names": "title",
+    "date_x": "date released",
+    "orig_title": "original title",
+    "orig_lang": "original language",
+    "budget_x": "budget",
+    "score": "IMDB score",
+}
+
+# Embedding model of each worker process
+_embedding_model = None
+
+csv.field_size_limit(sys.maxsize)
+
+
+@dataclass
+class Batch:
+    """A batch of chunks read from consecutive rows of a source file."""
+
+    source: str
+    end_row: int  # Number of rows of the source read once this batch is uploaded
+    ids: List[str] = field(default_factory=list)
+    documents: List[str] = field(default_factory=list)
+
+
+class Checkpoint:
+    """
+    Persist the number of rows of each source file whose chunks were all uploaded.
+    Batches may complete out of order, so only the rows before the first incomplete batch
+    are committed.
+    Attributes:
+        path (Optional[Path]): Path to the checkpoint file, nothing is persisted if None.
+        rows (Dict[str, int]): Number of rows committed per source file.
+    Methods:
+        start(batch): Track a batch before it is uploaded.
+        complete(batch): Mark a batch as uploaded and persist the progress.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.rows: Dict[str, int] = {}
+        if path is not None and path.exists():
+            self.rows = json.loads(path.read_text())
+        self.in_flight: Dict[str, Deque[int]] = {}
+        self.completed: Dict[str, Set[int]] = {}
+
+    def start(self, batch: Batch):
+        self.in_flight.setdefault(batch.source, deque()).append(batch.end_row)
+
+    def complete(self, batch: Batch):
+        in_flight = self.in_flight[batch.source]
+        completed = self.completed.setdefault(batch.source, set())
+        completed.add(batch.end_row)
+        while in_flight and in_flight[0] in completed:
+            completed.remove(in_flight[0])
+            self.rows[batch.source] = in_flight.popleft()
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        staging = self.path.with_suffix(".tmp")
+        staging.write_text(json.dumps(self.rows))
+        os.replace(staging, self.path)
+
+
+def chunk_text(text: str, chunk_size: int, overlap: int = 0) -> List[str]:
+    """Split a text into chunks of at most `chunk_size` characters on whitespace boundaries.
+    Args:
+        text (str): The text to split.
+        chunk_size (int): Maximum number of characters per chunk.
+        overlap (int): Number of characters repeated at the start of the next chunk. Defaults to 0.
+    Returns:
+        List[str]: The chunks of the text.
+    """
+    if len(text) <= chunk_size:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + 1, end)
+            end = space if space > start + overlap else end
+        chunks.append(text[start:end].strip())
+        if end == len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [chunk for chunk in chunks if chunk]
+
+
+def format_row(row: Dict[str, str], format: str) -> str:
+    """Format a csv row as a document."""
+    if format == "plots":
+        plot = re.sub(r"\n", " ", row["plot"] or "")
+        return f"{row['title']}\n{plot}"
+    return "".join(
+        f"{COLUMN_NAMES.get(column, column).title()}: {value}\n"
+        for column, value in row.items()
+    )
+
+
+def read_batches(
+    sources: List[str],
+    format: str,
+    batch_size: int,
+    chunk_size: int,
+    overlap: int,
+    checkpoint: Checkpoint,
+) -> Iterator[Batch]:
+    """Stream the rows of the source files as batches of chunks, skipping rows already committed."""
+    for source in sources:
+        skip = checkpoint.rows.get(source, 0)
+        if skip:
+            logger.info(f"Resuming {source} after {skip} rows")
+        with open(source, newline="", encoding="utf-8") as file:
+            batch = Batch(source=source, end_row=skip)
+            for row_number, row in enumerate(csv.DictReader(file)):
+                if row_number < skip:
+                    continue
+                chunks = chunk_text(format_row(row, format), chunk_size, overlap)
+                for chunk in chunks:
+                    # Content ids, so that chunks uploaded again are overwritten
+                    id = content_id(chunk)
+                    if id not in batch.ids:
+                        batch.ids.append(id)
+                        batch.documents.append(chunk)
+                batch.end_row = row_number + 1
+                if len(batch.documents) >= batch_size:
+                    yield batch
+                    batch = Batch(source=source, end_row=row_number + 1)
+            if batch.documents:
+                yield batch
+
+
+def _init_worker(model_name: str, cache_dir: Optional[str], threads: Optional[int]):
+    """Load the embedding model once per worker process."""
+    global _embedding_model
+    from fastembed import TextEmbedding
+
+    _embedding_model = TextEmbedding(
+        model_name=model_name, cache_dir=cache_dir, threads=threads
+    )
+
+
+def _embed(documents: List[str]) -> List[List[float]]:
+    """Embed a batch of documents in a worker process."""
+    return [vector.tolist() for vector in _embedding_model.passage_embed(documents)]
+
+
+def _upload(
+    client: QdrantClient,
+    collection_name: str,
+    vector_name: str,
+    batch: Batch,
+    vectors: List[List[float]],
+):
+    """Upsert a batch of embedded chunks."""
+    timestamp = datetime.now().timestamp()
+    points = [
+        PointStruct(
+            id=id,
+            vector={vector_name: vector},
+            payload={
+                "document": document,
+                "timestamp": timestamp,
+                "collection": collection_name,
+            },
+        )
+        for id, document, vector in zip(batch.ids, batch.documents, vectors)
+    ]
+    client.upsert(collection_name=collection_name, points=points, wait=True)
+
+
+def ingest(
+    sources: List[str],
+    index: str,
+    format: str = "plots",
+    url: str = "http://localhost:6333",
+    batch_size: int = 256,
+    chunk_size: int = 2000,
+    overlap: int = 200,
+    workers: int = os.cpu_count() or 1,
+    uploaders: int = 4,
+    checkpoint_path: Optional[Path] = None,
+    models_dir: Optional[str] = ".cache",
+    sync: bool = False,
+) -> int:
+    """Load csv files into a collection, embedding and uploading batches in parallel.
+    At most a couple of batches per worker are embedded or uploaded at any time, so memory
+    stays constant regardless of the size of the corpus.
+    Args:
+        sources (List[str]): Paths to the csv files.
+        index (str): Name of the collection to load the documents into.
+        format (str): "plots" for title and plot columns, "table" for one "Column: value" line per column. Defaults to "plots".
+        url (str): Url to the qdrant server. Defaults to "http://localhost:6333".
+        batch_size (int): Number of chunks embedded and uploaded together. Defaults to 256.
+        chunk_size (int): Maximum number of characters per chunk. Defaults to 2000.
+        overlap (int): Number of characters shared by consecutive chunks of a row. Defaults to 200.
+        workers (int): Number of embedding processes. Defaults to the number of CPUs.
+        uploaders (int): Number of batches uploaded concurrently. Defaults to 4.
+        checkpoint_path (Optional[Path]): File to persist the progress to, and resume from.
+        models_dir (Optional[str]): Directory to store embedding models. Defaults to ".cache".
+        sync (bool): Skip the chunks already in the collection and delete the ones no longer in the sources. Defaults to False.
+    Returns:
+        int: Number of chunks uploaded.
+    """
+    if sync and checkpoint_path is not None:
+        raise ValueError("A sync reads the sources in full and cannot be resumed")
+
+    client = QdrantClient(url=url)
+    if not client.collection_exists(collection_name=index):
+        create_collection(client, index)
+        logger.info(f"Created new collection for retrieval {index}")
+    vector_name = client.get_vector_field_name()
+
+    # Ids in the collection before the sync, and ids found in the sources
+    existing = collection_ids(client, index) if sync else set()
+    seen = set()
+
+    checkpoint = Checkpoint(checkpoint_path)
+    batches = read_batches(sources, format, batch_size, chunk_size, overlap, checkpoint)
+    # Pin each worker to one thread, parallelism comes from the processes
+    threads = 1 if workers > 1 else None
+    embedder = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(client.embedding_model_name, models_dir, threads),
+    )
+    uploader = ThreadPoolExecutor(max_workers=uploaders)
+
+    embedding: Deque[Tuple[Batch, Future]] = deque()
+    uploading: Dict[Future, Batch] = {}
+    uploaded = 0
+    progress = tqdm(desc=f"Ingesting {index}", unit="chunks")
+
+    def complete_uploads(return_when: str):
+        nonlocal uploaded
+        done, _ = wait(uploading, return_when=return_when)
+        for future in done:
+            batch = uploading.pop(future)
+            future.result()  # Raise upload errors
+            checkpoint.complete(batch)
+            uploaded += len(batch.documents)
+            progress.update(len(batch.documents))
+
+    def upload_next():
+        batch, future = embedding.popleft()
+        vectors = future.result()
+        # Backpressure: wait for an upload slot before embedding further
+        while len(uploading) >= uploaders:
+            complete_uploads(FIRST_COMPLETED)
+        uploading[
+            uploader.submit(_upload, client, index, vector_name, batch, vectors)
+        ] = batch
+
+    try:
+        for batch in batches:
+            if sync:
+                seen.update(batch.ids)
+                changed = [i for i, id in enumerate(batch.ids) if id not in existing]
+                progress.update(len(batch.ids) - len(changed))
+                if not changed:
+                    continue
+                batch.ids = [batch.ids[i] for i in changed]
+                batch.documents = [batch.documents[i] for i in changed]
+            checkpoint.start(batch)
+            embedding.append((batch, embedder.submit(_embed, batch.documents)))
+            # Backpressure: keep a bounded number of batches in flight
+            while len(embedding) >= 2 * workers:
+                upload_next()
+        while embedding:
+            upload_next()
+        if uploading:
+            complete_uploads("ALL_COMPLETED")
+    finally:
+        progress.close()
+        embedder.shutdown(cancel_futures=True)
+        uploader.shutdown()
+
+    if sync:
+        vanished = list(existing.difference(seen))
+        for i in range(0, len(vanished), batch_size):
+            client.delete(
+                collection_name=index,
+                points_selector=PointIdsList(points=vanished[i : i + batch_size]),
+            )
+        logger.info(f"Deleted {len(vanished)} chunks no longer in the sources")
+
+    logger.info(f"Uploaded {uploaded} chunks to {index}")
+    return uploaded
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load csv corpora into the qdrant database."
+    )
+    parser.add_argument("sources", nargs="+", help="Csv files or glob patterns")
+    parser.add_argument("--index", type=str, required=True)
+    parser.add_argument("--format", choices=["plots", "table"], default="plots")
+    parser.add_argument("--url", type=str, default="http://localhost:6333")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--overlap", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--uploaders", type=int, default=4)
+    parser.add_argument("--checkpoint", type=Path, default=None)
+    parser.add_argument("--models-dir", type=str, default=".cache")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only upload new or changed chunks, and delete the ones no longer in the sources",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sources = sorted({path for pattern in args.sources for path in glob.glob(pattern)})
+    if not sources:
+        parser.error(f"No files match {args.sources}")
+    if args.sync and args.checkpoint:
+        parser.error("--sync cannot be combined with --checkpoint")
+
+    ingest(
+        sources,
+        index=args.index,
+        format=args.format,
+        url=args.url,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        overlap=args.overlap,
+        workers=args.workers,
+        uploaders=args.uploaders,
+        checkpoint_path=args.checkpoint,
+        models_dir=args.models_dir,
+        sync=args.sync,
+    )
+
+
+if __name__ == "__main__":
+    main()
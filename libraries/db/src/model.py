@@ -1,5 +1,5 @@
 # Context retrieval models
-from typing import List, Optional, Union
+from typing import List, Literal, Optional, Union
 
 from pydantic import BaseModel
 
@@ -13,6 +13,15 @@ class ContextRequest(BaseModel):
     indexes: List[Optional[str]] = []
 
 
+class ContextBatchRequest(BaseModel):
+    """Request model for batched context retrieval."""
+
+    texts: List[str]
+    threshold: Optional[float] = None
+    limit: Optional[int] = None
+    indexes: List[Optional[str]] = []
+
+
 class ContextDocument(BaseModel):
     """Document model for context retrieval."""
 
@@ -27,3 +36,37 @@ class ContextDocumentList(BaseModel):
 
     documents: List[ContextDocument] = []
     index: Optional[str] = None
+
+
+class DeleteRequest(BaseModel):
+    """Request model for deleting documents by id, content hash or metadata filter."""
+
+    ids: List[Union[str, int]] = []
+    hashes: List[str] = []
+    collection: Optional[str] = None
+    older_than: Optional[float] = None
+    index: Optional[str] = None
+
+
+class IndexConfig(BaseModel):
+    """Storage and search settings of a collection."""
+
+    # Compression of the vectors kept for search, the originals are kept for rescoring
+    quantization: Optional[Literal["scalar", "product", "binary"]] = None
+    quantile: Optional[float] = None  # scalar quantization only
+    compression: Literal["x4", "x8", "x16", "x32", "x64"] = "x16"  # product only
+    always_ram: bool = True  # keep the quantized vectors in RAM
+    on_disk: bool = False  # keep the original vectors on disk (memory-mapped)
+    # HNSW graph, Qdrant defaults if None
+    hnsw_m: Optional[int] = None
+    hnsw_ef_construct: Optional[int] = None
+    # Search
+    hnsw_ef: Optional[int] = None
+    oversampling: float = 2.0
+    rescore: bool = True
+
+
+class CreateIndexRequest(IndexConfig):
+    """Request model for creating a collection."""
+
+    name: str
@@ -1,30 +1,204 @@
 # Retrieval module for chatbot using qdrant for similarity search
+import asyncio
+import heapq
+import json
 import logging
+import threading
+import time
 import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple, Union
 
-from qdrant_client import QdrantClient, conversions
+import httpx
+import xxhash
+from fastembed import TextEmbedding
+from qdrant_client import AsyncQdrantClient, QdrantClient, conversions
 from qdrant_client.fastembed_common import QueryResponse
-from qdrant_client.models import PointIdsList
+from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CompressionRatio,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    HnswConfigDiff,
+    MatchValue,
+    NamedVector,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    ProductQuantization,
+    ProductQuantizationConfig,
+    QuantizationConfig,
+    QuantizationSearchParams,
+    Range,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    ScoredPoint,
+    SearchParams,
+    SearchRequest,
+)
 
-from src.model import ContextDocument, ContextDocumentList
+from src.model import ContextDocument, ContextDocumentList, IndexConfig
+from src.titles import TitleIndex
 
 logger = logging.getLogger(__name__)
 
+# Internal metadata indexed in every collection
+PAYLOAD_INDEXES = {
+    "collection": PayloadSchemaType.KEYWORD,
+    "timestamp": PayloadSchemaType.FLOAT,
+}
+
+
+def content_id(document: str, metadata: Optional[Dict] = None) -> str:
+    """Derive a deterministic point id from the content of a document.
+    Args:
+        document (str): The document text.
+        metadata (Optional[Dict]): The metadata given with the document, if any.
+    Returns:
+        str: A UUID built from the 128-bit xxhash of the document and its metadata.
+    """
+    content = document
+    if metadata:
+        content += json.dumps(metadata, sort_keys=True, default=str)
+    return hash_to_id(xxhash.xxh3_128_hexdigest(content))
+
+
+def hash_to_id(content_hash: str) -> str:
+    """Convert a 128-bit content hash in hexadecimal to its point id."""
+    return str(uuid.UUID(hex=content_hash))
+
+
+def create_payload_indexes(client: QdrantClient, collection_name: str):
+    """Index the internal metadata of a collection, so that deletes by filter are fast."""
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=field_name,
+            field_schema=field_schema,
+        )
+
+
+def quantization_config(config: IndexConfig) -> Optional[QuantizationConfig]:
+    """Get the quantization of a collection's vectors, or None for full precision."""
+    if config.quantization == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=config.quantile,
+                always_ram=config.always_ram,
+            )
+        )
+    if config.quantization == "product":
+        return ProductQuantization(
+            product=ProductQuantizationConfig(
+                compression=CompressionRatio(config.compression),
+                always_ram=config.always_ram,
+            )
+        )
+    if config.quantization == "binary":
+        return BinaryQuantization(
+            binary=BinaryQuantizationConfig(always_ram=config.always_ram)
+        )
+    return None
+
+
+def search_params(config: IndexConfig) -> Optional[SearchParams]:
+    """Get the search parameters of a collection, or None for Qdrant defaults.
+    Quantized collections are searched with oversampling, the candidates being rescored
+    with the original vectors.
+    """
+    quantization = None
+    if config.quantization is not None:
+        quantization = QuantizationSearchParams(
+            rescore=config.rescore, oversampling=config.oversampling
+        )
+    if quantization is None and config.hnsw_ef is None:
+        return None
+    return SearchParams(hnsw_ef=config.hnsw_ef, quantization=quantization)
+
+
+def collection_config(
+    client: Union[QdrantClient, AsyncQdrantClient], config: Optional[IndexConfig] = None
+) -> Dict:
+    """Get the vector parameters of a collection for the fastembed model of the client.
+    Args:
+        client (Union[QdrantClient, AsyncQdrantClient]): The qdrant client.
+        config (Optional[IndexConfig]): Quantization, on-disk storage and HNSW settings, Qdrant defaults if None.
+    Returns:
+        Dict: The `vectors_config` and `sparse_vectors_config` arguments of `create_collection`.
+    """
+    config = config or IndexConfig()
+    hnsw_config = None
+    if config.hnsw_m is not None or config.hnsw_ef_construct is not None:
+        hnsw_config = HnswConfigDiff(
+            m=config.hnsw_m, ef_construct=config.hnsw_ef_construct
+        )
+    return {
+        "vectors_config": client.get_fastembed_vector_params(
+            on_disk=config.on_disk or None,
+            quantization_config=quantization_config(config),
+            hnsw_config=hnsw_config,
+        ),
+        "sparse_vectors_config": client.get_fastembed_sparse_vector_params(
+            on_disk=config.on_disk or None
+        ),
+    }
+
+
+def create_collection(
+    client: QdrantClient, collection_name: str, config: Optional[IndexConfig] = None
+):
+    """Create a collection for the fastembed model of the client, with its payload indexes.
+    Args:
+        client (QdrantClient): The qdrant client.
+        collection_name (str): Name of the collection.
+        config (Optional[IndexConfig]): Quantization, on-disk storage and HNSW settings, Qdrant defaults if None.
+    """
+    client.create_collection(
+        collection_name=collection_name, **collection_config(client, config)
+    )
+    create_payload_indexes(client, collection_name)
+
+
+def collection_ids(client: QdrantClient, collection_name: str) -> Set[str]:
+    """Get the ids of every point of a collection."""
+    ids = set()
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        ids.update(str(point.id) for point in points)
+        if offset is None:
+            return ids
+
 
 class ContextRetriever:
     """
-    A class to manage retrieval of data using QdrantClient.
+    A class to manage retrieval of data using AsyncQdrantClient.
+    Every method talking to qdrant is a coroutine, and embeddings are computed in a pool of
+    worker threads, so that concurrent requests never block the event loop.
     Attributes:
         collection (str): The name of the collection in the QdrantClient.
         models_dir (str): Directory to store embedding models.
         device (str): Device to run the embedding model on.
+        registry_ttl (float): Seconds after which the cached list of collections is refreshed.
+        prefer_grpc (bool): Whether to talk to qdrant over gRPC instead of REST.
     Methods:
         initialize(): Initialize the QdrantClient and collection.
         load(document): Load a document into the vectorstore.
         query(question, threshold): Query the vector store for a question.
         delete(uuid): Delete a document by uuid.
+        close(): Release the connections and the worker threads.
     """
 
     def __init__(
@@ -33,14 +207,29 @@ class ContextRetriever:
         device: str = "cpu",
         collection: str = "documents",
         url: str = "http://qdrant:6333",
+        registry_ttl: float = 60,
+        max_workers: int = 8,
+        title_index: bool = True,
+        title_refresh_interval: float = 300,
+        prefer_grpc: bool = False,
+        grpc_port: int = 6334,
+        pool_size: int = 64,
     ):
         """
-        Initialize the ContextRetriever instance.
+        Initialize the ContextRetriever instance. The client is created by `initialize`, to be
+        awaited once an event loop is running.
         Args:
             models_dir (str): Directory to store embedding models. Defaults to ".cache".
             device (str): Device to run the embedding model on. Defaults to "cpu".
             collection (str): The name of the collection in the QdrantClient. Defaults to "documents".
             url (str): Url to client server.
+            registry_ttl (float): Seconds after which the cached list of collections is refreshed. Defaults to 60.
+            max_workers (int): Number of worker threads embedding texts. Defaults to 8.
+            title_index (bool): Whether to answer questions naming a film from an in-memory title index before searching vectors. Defaults to True.
+            title_refresh_interval (float): Seconds between two rebuilds of the title indexes, to pick up documents changed outside the service, 0 to never rebuild. Defaults to 300.
+            prefer_grpc (bool): Whether to talk to qdrant over gRPC instead of REST. Defaults to False.
+            grpc_port (int): Port of the gRPC interface of qdrant. Defaults to 6334.
+            pool_size (int): Maximum number of pooled REST connections to qdrant. Defaults to 64.
         This uses FastEmbedding's default model (BAAI/bge-small-en-v1.5), which built for speed and efficiency.
         """
         # embedding settings
@@ -49,57 +238,326 @@ class ContextRetriever:
 
         # client and collection
         self.url = url
-        self.client: QdrantClient = None
+        self.prefer_grpc = prefer_grpc
+        self.grpc_port = grpc_port
+        self.pool_size = pool_size
+        self.client: AsyncQdrantClient = None
         self.collection = None
         self.collection_name = collection
 
-        self.initialize()  # Initialize client and collection
+        # cached collection names, to avoid a round trip on every search
+        self.registry_ttl = registry_ttl
+        self.registry: Set[str] = set()
+        self.registry_updated_at: Optional[float] = None
+
+        # pool embedding texts off the event loop (onnxruntime releases the GIL)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.embedding_model: Optional[TextEmbedding] = None
+        self.embedding_model_lock = threading.Lock()
+
+        # titles of the documents of each collection, built on first search
+        self.titles: Optional[TitleIndex] = TitleIndex() if title_index else None
+        self.titles_lock = asyncio.Lock()
+        self.title_refresh_interval = title_refresh_interval
+        self.titles_task: Optional[asyncio.Task] = None
+
+        # search parameters of each collection, read from its config on first search
+        self.search_params: Dict[str, Optional[SearchParams]] = {}
 
     def __init_client(self):
-        """Initialize QdrantClient."""
-        self.client = QdrantClient(url=self.url)
-        logger.debug("Initialized Qdrant Client")
-
-    def __init_collection(self, collection_name: str):
-        """Check if collection exists, if not, create it."""
-        if self.client.collection_exists(collection_name=collection_name) == False:
-            self.client.create_collection(
+        """Initialize AsyncQdrantClient."""
+        self.client = AsyncQdrantClient(
+            url=self.url,
+            prefer_grpc=self.prefer_grpc,
+            grpc_port=self.grpc_port,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            ),
+        )
+        logger.debug(
+            f"Initialized Qdrant Client ({'gRPC' if self.prefer_grpc else 'REST'})"
+        )
+
+    async def __run(self, function, *args):
+        """Run a blocking function in the worker threads."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def __init_collection(
+        self, collection_name: str, config: Optional[IndexConfig] = None
+    ) -> bool:
+        """Check if collection exists, if not, create it.
+        Args:
+            collection_name (str): Name of the collection.
+            config (Optional[IndexConfig]): Storage and search settings, Qdrant defaults if None.
+        Returns:
+            bool: Whether the collection was created.
+        """
+        created = False
+        if (
+            await self.client.collection_exists(collection_name=collection_name)
+            == False
+        ):
+            config = config or IndexConfig()
+            await self.client.create_collection(
+                collection_name=collection_name,
+                **collection_config(self.client, config),
+            )
+            await asyncio.gather(
+                *[
+                    self.client.create_payload_index(
+                        collection_name=collection_name,
+                        field_name=field_name,
+                        field_schema=field_schema,
+                    )
+                    for field_name, field_schema in PAYLOAD_INDEXES.items()
+                ]
+            )
+            self.search_params[collection_name] = search_params(config)
+            created = True
+            logger.info(f"Created new collection for retrieval {collection_name}")
+        self.registry.add(collection_name)
+        return created
+
+    async def __refresh_registry(self):
+        """Refresh the cached collection names."""
+        collections = (await self.client.get_collections()).collections
+        self.registry = {collection.name for collection in collections}
+        self.registry_updated_at = time.monotonic()
+        logger.debug(f"Refreshed collection registry: {self.registry}")
+
+    async def __existing_collections(self, collection_names: List[str]) -> List[str]:
+        """Filter the collection names that exist, refreshing the registry if stale or missing one."""
+        stale = (
+            self.registry_updated_at is None
+            or time.monotonic() - self.registry_updated_at > self.registry_ttl
+        )
+        if stale or not self.registry.issuperset(collection_names):
+            await self.__refresh_registry()
+        return [name for name in collection_names if name in self.registry]
+
+    async def __collections_to_search(self, indexes: Optional[List[str]]) -> List[str]:
+        """Get the existing collections among the requested ones."""
+        collection_names = list(dict.fromkeys(indexes or [self.collection_name]))
+        existing = await self.__existing_collections(collection_names)
+        for collection in collection_names:
+            if collection not in existing:
+                logger.error(f"Collection {collection} does not exist.")
+        return existing
+
+    async def __collection_ids(self, collection_name: str) -> Set[str]:
+        """Get the ids of every point of a collection."""
+        ids = set()
+        offset = None
+        while True:
+            points, offset = await self.client.scroll(
+                collection_name=collection_name,
+                limit=1000,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False,
+            )
+            ids.update(str(point.id) for point in points)
+            if offset is None:
+                return ids
+
+    async def __search_params(self, collection_name: str) -> Optional[SearchParams]:
+        """Get the search parameters of a collection, from its config on first use.
+        The search-time settings are not stored by Qdrant: a quantized collection created by
+        another process is searched with the default oversampling and rescoring.
+        """
+        if collection_name not in self.search_params:
+            config = (await self.client.get_collection(collection_name)).config
+            vector_params = config.params.vectors
+            if isinstance(vector_params, dict):
+                vector_params = vector_params.get(self.client.get_vector_field_name())
+            quantized = config.quantization_config is not None or (
+                getattr(vector_params, "quantization_config", None) is not None
+            )
+            defaults = IndexConfig()
+            self.search_params[collection_name] = (
+                SearchParams(
+                    quantization=QuantizationSearchParams(
+                        rescore=defaults.rescore, oversampling=defaults.oversampling
+                    )
+                )
+                if quantized
+                else None
+            )
+        return self.search_params[collection_name]
+
+    async def __read_documents(self, collection_name: str) -> List[ContextDocument]:
+        """Read every document of a collection, without its vector."""
+        documents = []
+        offset = None
+        while True:
+            points, offset = await self.client.scroll(
                 collection_name=collection_name,
-                vectors_config=self.client.get_fastembed_vector_params(),
-                sparse_vectors_config=self.client.get_fastembed_sparse_vector_params(),
+                limit=1000,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False,
+            )
+            documents.extend(
+                ContextDocument(
+                    id=point.id,
+                    document=point.payload.pop("document", ""),
+                    metadata=point.payload,
+                )
+                for point in points
             )
-            logger.info(f"Created new collection for retrieval {self.collection_name}")
+            if offset is None:
+                return documents
 
-    def __load_documents(
-        self, documents: list, metadata: list, collection_name: str
+    def __parse_titles(
+        self, collection_name: str, documents: List[ContextDocument]
+    ) -> TitleIndex:
+        """Build the title index of a collection apart, to be swapped in."""
+        index = TitleIndex(fuzzy_cutoff=self.titles.fuzzy_cutoff)
+        index.add(collection_name, documents)
+        return index
+
+    async def __build_titles(self, collection_names: List[str], rebuild: bool = False):
+        """Build the title index of collections, parsing their documents in the worker threads.
+        Searches keep using the previous index of a collection until the new one is swapped in.
+        """
+        # Concurrent searches wait for the index being built instead of building it again
+        async with self.titles_lock:
+            for collection_name in collection_names:
+                if collection_name in self.titles and not rebuild:
+                    continue
+                documents = await self.__read_documents(collection_name)
+                index = await self.__run(
+                    self.__parse_titles, collection_name, documents
+                )
+                self.titles.replace(collection_name, index)
+                logger.info(f"Built title index of collection {collection_name}")
+
+    async def __refresh_titles(self):
+        """Rebuild the title indexes periodically, to pick up documents changed by the CLIs."""
+        while True:
+            await asyncio.sleep(self.title_refresh_interval)
+            try:
+                await self.__refresh_registry()
+                await self.__build_titles(sorted(self.registry), rebuild=True)
+            except Exception as e:
+                logger.error(f"Could not refresh the title indexes: {e!r}")
+
+    async def __lookup_title(
+        self,
+        text: str,
+        threshold: Optional[float],
+        limit: int,
+        collection_names: List[str],
+    ) -> Tuple[List[ContextDocument], bool]:
+        """Look a question up in the title index, returning no documents if disabled.
+        Returns:
+            Tuple[List[ContextDocument], bool]: The documents found, and whether they answer
+            the question on their own, without a vector search.
+        """
+        if self.titles is None:
+            return [], False
+        if not all(name in self.titles for name in collection_names):
+            await self.__build_titles(collection_names)
+        documents, conclusive = self.titles.lookup(text, collection_names, limit=limit)
+        documents = [
+            doc for doc in documents if threshold is None or doc.score >= threshold
+        ]
+        return documents, conclusive and bool(documents)
+
+    @staticmethod
+    def __merge(
+        titled: List[ContextDocument], hits: List[ContextDocument], limit: int
+    ) -> List[ContextDocument]:
+        """Put the documents found by title first, then the vector hits not found by title."""
+        ids = {str(doc.id) for doc in titled}
+        return [*titled, *[doc for doc in hits if str(doc.id) not in ids]][:limit]
+
+    def __get_embedding_model(self) -> TextEmbedding:
+        """Get the embedding model of the client's vector field, loading it on first use."""
+        with self.embedding_model_lock:
+            if self.embedding_model is None:
+                self.embedding_model = TextEmbedding(
+                    model_name=self.client.embedding_model_name,
+                    cache_dir=self.models_dir,
+                )
+        return self.embedding_model
+
+    def __embed_queries(self, questions: List[str]) -> List[List[float]]:
+        """Embed questions in one batch, to be reused for every collection queried."""
+        model = self.__get_embedding_model()
+        return [vector.tolist() for vector in model.query_embed(query=questions)]
+
+    def __embed_documents(self, documents: List[str]) -> List[List[float]]:
+        """Embed documents for storage."""
+        model = self.__get_embedding_model()
+        return [vector.tolist() for vector in model.passage_embed(documents)]
+
+    @staticmethod
+    def __to_query_responses(points: List[ScoredPoint]) -> List[QueryResponse]:
+        """Convert the points found by a search, stored with their document in the payload."""
+        return [
+            QueryResponse(
+                id=point.id,
+                embedding=None,
+                metadata=point.payload or {},
+                document=(point.payload or {}).get("document", ""),
+                score=point.score,
+            )
+            for point in points
+        ]
+
+    async def __load_documents(
+        self, documents: list, metadata: list, ids: list, collection_name: str
     ) -> list:
-        """Load documents into the vectorstore collection.
+        """Load documents into the vectorstore collection, replacing the points with the same ids.
         Args:
             documents (list): List of documents
             metadata (list): List of metadata for each document
+            ids (list): List of ids for each document
             collection_name (str): Name of the collection to load the documents into.
 
         Returns:
             id (list): List of ids of the documents just added.
         """
-        ids = self.client.add(
-            collection_name=collection_name, documents=documents, metadata=metadata
-        )  # creates a collection if it does not already exist
-
-        return ids
+        await self.__init_collection(collection_name=collection_name)
+        vectors = await self.__run(self.__embed_documents, documents)
+        vector_name = self.client.get_vector_field_name()
+        points = [
+            PointStruct(
+                id=id,
+                vector={vector_name: vector},
+                payload={"document": document, **(payload or {})},
+            )
+            for id, document, vector, payload in zip(ids, documents, vectors, metadata)
+        ]
+        await self.client.upload_points(
+            collection_name=collection_name, points=points, wait=True
+        )
+        return [point.id for point in points]
 
-    def __query(
-        self, question: str, threshold: float, limit: int, collection_name: str = None
+    async def __query(
+        self,
+        vector: List[float],
+        threshold: Optional[float],
+        limit: int,
+        collection_name: str = None,
     ) -> List[QueryResponse]:
-        """Query the vector store by question."""
-        hits = self.client.query(
+        """Query a collection of the vector store by embedding."""
+        points = await self.client.search(
             collection_name=collection_name,
-            query_text=question,
+            query_vector=NamedVector(
+                name=self.client.get_vector_field_name(), vector=vector
+            ),
             limit=limit,
             score_threshold=threshold,
+            with_payload=True,
+            search_params=await self.__search_params(collection_name),
         )
+        hits = self.__to_query_responses(points)
 
-        logger.info(f"Found relevant documents for question: {question}")
         logger.debug(
             "\n".join(
                 [
@@ -110,14 +568,49 @@ class ContextRetriever:
         )
         return hits
 
-    def __delete_documents(self, document_ids: List[str], collection_name: str):
-        res = self.client.delete(
+    async def __query_batch(
+        self,
+        vectors: List[List[float]],
+        threshold: Optional[float],
+        limit: int,
+        collection_name: str = None,
+    ) -> List[List[QueryResponse]]:
+        """Query a collection of the vector store by several embeddings in a single request."""
+        params = await self.__search_params(collection_name)
+        requests = [
+            SearchRequest(
+                vector=NamedVector(
+                    name=self.client.get_vector_field_name(), vector=vector
+                ),
+                limit=limit,
+                score_threshold=threshold,
+                with_payload=True,
+                params=params,
+            )
+            for vector in vectors
+        ]
+        responses = await self.client.search_batch(
+            collection_name=collection_name, requests=requests
+        )
+        return [self.__to_query_responses(points) for points in responses]
+
+    @staticmethod
+    def __to_documents(hits: List[QueryResponse]) -> List[ContextDocument]:
+        """Convert hits to ContextDocument."""
+        documents = [ContextDocument(**hit.model_dump()) for hit in hits]
+        # Remove docuement from docs's metadata
+        for doc in documents:
+            doc.metadata.pop("document", None)
+        return documents
+
+    async def __delete_documents(self, document_ids: List[str], collection_name: str):
+        res = await self.client.delete(
             collection_name=collection_name,
             points_selector=PointIdsList(
                 points=document_ids,
             ),
         )
-        logger.info(f"Deleted document with id {document_ids}. Operation result: {res}")
+        logger.info(f"Deleted {len(document_ids)} documents. Operation result: {res}")
 
     def __generate_metadata(
         self, collection_name: str, documents: List[str], metadata: Optional[List[Dict]]
@@ -143,76 +636,180 @@ class ContextRetriever:
         assert len(metadata) == len(metadata)
         return metadata
 
-    def initialize(self, collection_name: str = None):
+    async def initialize(self, collection_name: str = None):
         """Initialize the ContextRetriever."""
         try:
             collection_name = collection_name or self.collection_name
 
             self.__init_client()
-            self.__init_collection(collection_name=collection_name)
+            await self.__init_collection(collection_name=collection_name)
+            # Load the embedding model and the title indexes before the first request
+            await self.__run(self.__embed_queries, ["warm up"])
+            if self.titles is not None:
+                await self.__refresh_registry()
+                await self.__build_titles(sorted(self.registry))
+                if self.title_refresh_interval:
+                    self.titles_task = asyncio.create_task(self.__refresh_titles())
         except Exception as e:
             logger.error(
                 f"Qdrant server could not be reached. {traceback.format_exc()}"
             )
 
-    def create_index(self, name: str):
-        self.__init_collection(collection_name=name)
+    async def close(self):
+        """Release the connections to qdrant and the worker threads."""
+        if self.titles_task is not None:
+            self.titles_task.cancel()
+            await asyncio.gather(self.titles_task, return_exceptions=True)
+        if self.client is not None:
+            await self.client.close()
+        self.executor.shutdown(wait=False)
+
+    async def create_index(
+        self, name: str, config: Optional[IndexConfig] = None
+    ) -> bool:
+        """Create a collection with the given storage and search settings.
+        Args:
+            name (str): Name of the collection.
+            config (Optional[IndexConfig]): Quantization, on-disk storage and HNSW settings, Qdrant defaults if None.
+        Returns:
+            bool: Whether the collection was created, False if it already existed (its settings are left unchanged).
+        """
+        return await self.__init_collection(collection_name=name, config=config)
 
-    def add_documents(
+    async def add_documents(
         self,
         chunks: List[str],
         metadata: Optional[List[dict]] = None,
         index: Optional[str] = None,
     ) -> List[str]:
-        """Add documents to the collection
+        """Add documents to the collection.
+        Point ids are derived from the content of the documents, so adding a document again
+        replaces it instead of duplicating it.
         Args:
             chunks (List[str]): List of documents
             metadata (Optional[List[dict]]): List of metadata for each document
             index (Optional[str]): Name of the collection to load the documents into. Defaults to the collection_name set during initialization.
+        Returns:
+            List[str]: The id of each document.
         """
         collection_name = index or self.collection_name
+        ids = [
+            content_id(chunk, metadata[i] if metadata else None)
+            for i, chunk in enumerate(chunks)
+        ]
 
         # Generate metadata
         metadata = self.__generate_metadata(collection_name, chunks, metadata)
 
-        # Load documents
-        ids = self.__load_documents(
-            documents=chunks, metadata=metadata, collection_name=collection_name
+        # Load documents, once per id
+        unique = {id: i for i, id in reversed(list(enumerate(ids)))}
+        await self.__load_documents(
+            documents=[chunks[i] for i in unique.values()],
+            metadata=[metadata[i] for i in unique.values()],
+            ids=list(unique),
+            collection_name=collection_name,
         )
+        if self.titles is not None and collection_name in self.titles:
+            self.titles.add(
+                collection_name,
+                [
+                    ContextDocument(id=id, document=chunks[i], metadata=metadata[i])
+                    for id, i in unique.items()
+                ],
+            )
         logger.debug("Stored documents in vectorstore.")
         return ids
 
-    def search(
+    async def sync_documents(
+        self,
+        chunks: List[str],
+        metadata: Optional[List[dict]] = None,
+        index: Optional[str] = None,
+    ) -> Dict[str, int]:
+        """Make the collection hold exactly the given documents.
+        Documents already stored with the same content are left untouched, new or changed ones
+        are added, and the ones missing from the given documents are deleted.
+        Args:
+            chunks (List[str]): List of documents
+            metadata (Optional[List[dict]]): List of metadata for each document
+            index (Optional[str]): Name of the collection to synchronize. Defaults to the collection_name set during initialization.
+        Returns:
+            Dict[str, int]: Number of documents added, unchanged and deleted.
+        """
+        collection_name = index or self.collection_name
+        await self.__init_collection(collection_name=collection_name)
+        existing = await self.__collection_ids(collection_name)
+
+        ids = [
+            content_id(chunk, metadata[i] if metadata else None)
+            for i, chunk in enumerate(chunks)
+        ]
+        changed = [i for i, id in enumerate(ids) if id not in existing]
+        if changed:
+            await self.add_documents(
+                [chunks[i] for i in changed],
+                [metadata[i] for i in changed] if metadata else None,
+                index=collection_name,
+            )
+
+        vanished = list(existing.difference(ids))
+        if vanished:
+            await self.__delete_documents(vanished, collection_name)
+            if self.titles is not None:
+                self.titles.remove(collection_name, vanished)
+
+        stats = {
+            "added": len(set(ids[i] for i in changed)),
+            "unchanged": len(existing.intersection(ids)),
+            "deleted": len(vanished),
+        }
+        logger.info(f"Synchronized {collection_name}: {stats}")
+        return stats
+
+    async def search(
         self,
         text: str,
         threshold: Optional[float] = 0.95,
         limit: Optional[int] = 3,
         indexes: Optional[List[str]] = [],
-    ) -> List[ContextDocumentList]:
+    ) -> List[ContextDocument]:
         """Query the vectorstore.
+        The collections are queried concurrently with a single embedding of the text, and their
+        hits are merged into one list ranked by score.
         Args:
             text (str): The query text.
-            threshold (Optional[float]): Maximum score. Defaults to 0.95.
-            limit (Optional[int]): Maximum number of results to return. Defaults to 3.
+            threshold (Optional[float]): Minimum score. Defaults to 0.95.
+            limit (Optional[int]): Maximum number of results to return across all collections. Defaults to 3.
             indexes (Optional[List[str]]): List of collection names to query. Defaults to the collection_name set during initialization.
         """
-        collection_names = indexes or [self.collection_name]
-        results = []
-        for collection in collection_names:
-            metadata = {"collection": collection}
-            if not self.client.collection_exists(collection_name=collection):
-                logger.error(f"Collection {collection} does not exist.")
-                continue
+        limit = limit or 3
+        existing = await self.__collections_to_search(indexes)
+        if not existing:
+            return []
 
-            hits = self.__query(
-                text, threshold=threshold, limit=limit, collection_name=collection
-            )
+        # Questions clearly naming a film are answered from the title index
+        titled, conclusive = await self.__lookup_title(text, threshold, limit, existing)
+        if conclusive:
+            logger.info(f"Found {len(titled)} documents by title for: {text}")
+            return titled
+
+        vector = (await self.__run(self.__embed_queries, [text]))[0]
+        responses = await asyncio.gather(
+            *[
+                self.__query(
+                    vector,
+                    threshold=threshold,
+                    limit=limit,
+                    collection_name=collection,
+                )
+                for collection in existing
+            ]
+        )
+
+        results = []
+        for collection, hits in zip(existing, responses):
             if hits:
-                # Convert hits to ContextDocument
-                documents = [ContextDocument(**hit.model_dump()) for hit in hits]
-                # Remove docuement from docs's metadata
-                for doc in documents:
-                    doc.metadata.pop("document", None)
+                documents = self.__to_documents(hits)
                 # Add collection hits to the results
                 results.extend(documents)
                 logger.info(
@@ -220,16 +817,129 @@ class ContextRetriever:
                 )
             else:
                 logger.info(f"No relevant documents found in collection {collection}")
+
+        # Keep the global top-k across collections, after the documents found by title
+        results = heapq.nlargest(limit, results, key=lambda doc: doc.score)
+        results = self.__merge(titled, results, limit)
+        logger.info(f"Found relevant documents for question: {text}")
         return results
 
-    def delete_documents(self, document_ids: List[str], index: Optional[str] = None):
+    async def search_batch(
+        self,
+        texts: List[str],
+        threshold: Optional[float] = 0.95,
+        limit: Optional[int] = 3,
+        indexes: Optional[List[str]] = [],
+    ) -> List[List[ContextDocument]]:
+        """Query the vectorstore for several texts at once.
+        The texts are embedded in one batch and each collection is queried for all of them in a
+        single request, the collections being queried concurrently.
+        Args:
+            texts (List[str]): The query texts.
+            threshold (Optional[float]): Minimum score. Defaults to 0.95.
+            limit (Optional[int]): Maximum number of results to return per text across all collections. Defaults to 3.
+            indexes (Optional[List[str]]): List of collection names to query. Defaults to the collection_name set during initialization.
+        Returns:
+            List[List[ContextDocument]]: The results of each text, in the same order as the texts.
+        """
+        limit = limit or 3
+        existing = await self.__collections_to_search(indexes)
+        if not texts or not existing:
+            return [[] for _ in texts]
+
+        # Questions clearly naming a film are answered from the title index, the others by vectors
+        lookups = [
+            await self.__lookup_title(text, threshold, limit, existing)
+            for text in texts
+        ]
+        titled = [documents for documents, _ in lookups]
+        misses = [i for i, (_, conclusive) in enumerate(lookups) if not conclusive]
+        if not misses:
+            return titled
+
+        vectors = await self.__run(self.__embed_queries, [texts[i] for i in misses])
+        responses = await asyncio.gather(
+            *[
+                self.__query_batch(
+                    vectors,
+                    threshold=threshold,
+                    limit=limit,
+                    collection_name=collection,
+                )
+                for collection in existing
+            ]
+        )
+
+        results = [[] for _ in misses]
+        for response in responses:
+            for i, hits in enumerate(response):
+                results[i].extend(self.__to_documents(hits))
+
+        # Keep the global top-k across collections of each text
+        for i, documents in zip(misses, results):
+            documents = heapq.nlargest(limit, documents, key=lambda doc: doc.score)
+            titled[i] = self.__merge(titled[i], documents, limit)
+        results = titled
+        logger.info(
+            f"Found {sum(map(len, results))} relevant documents for {len(texts)} questions"
+        )
+        return results
+
+    async def delete_documents(
+        self, document_ids: List[str], index: Optional[str] = None
+    ):
         """Delete a document fron the vectorstore by it's uuid.
         Args:
             document_ids (List[str]): List of UUID of the document to delete
             index (Optional[str]): Name of the collection to delete the document from. Defaults to the collection_name set during initialization.
         """
         collection_name = index or self.collection_name
-        self.__delete_documents(document_ids, collection_name)
+        await self.__delete_documents(document_ids, collection_name)
+        if self.titles is not None:
+            self.titles.remove(collection_name, document_ids)
         logger.debug(
             f"Deleted documents with ids {document_ids} from {collection_name}"
         )
+
+    async def delete_by_filter(
+        self,
+        collection: Optional[str] = None,
+        older_than: Optional[float] = None,
+        index: Optional[str] = None,
+    ) -> str:
+        """Delete the documents matching a metadata filter, in a single request.
+        Qdrant does not report how many points a filter deleted, so only the status of the
+        operation is returned.
+        Args:
+            collection (Optional[str]): Delete the documents added to this collection name.
+            older_than (Optional[float]): Delete the documents added before this timestamp.
+            index (Optional[str]): Name of the collection to delete the documents from. Defaults to the collection_name set during initialization.
+        Returns:
+            str: Status of the delete operation (e.g. "completed").
+        Raises:
+            ValueError: If no condition is given.
+        """
+        conditions = []
+        if collection is not None:
+            conditions.append(
+                FieldCondition(key="collection", match=MatchValue(value=collection))
+            )
+        if older_than is not None:
+            conditions.append(
+                FieldCondition(key="timestamp", range=Range(lt=older_than))
+            )
+        if not conditions:
+            raise ValueError("At least one filter condition is required")
+
+        collection_name = index or self.collection_name
+        result = await self.client.delete(
+            collection_name=collection_name,
+            points_selector=FilterSelector(filter=Filter(must=conditions)),
+            wait=True,
+        )
+        if self.titles is not None:
+            self.titles.invalidate(collection_name)
+        logger.info(
+            f"Deleted documents from {collection_name} matching {conditions}: {result.status}"
+        )
+        return str(result.status.value)
@@ -0,0 +1,319 @@
+# In-memory index of movie titles, to answer title lookups without vector search
+import difflib
+import logging
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from src.model import ContextDocument
+
+logger = logging.getLogger(__name__)
+
+# Fields holding a title or an alias, in documents ("Key: value" lines) and metadata
+TITLE_FIELDS = {"title", "names", "original title", "movie name", "movietitle"}
+YEAR_FIELDS = {"year", "date released", "year of release", "movieyear"}
+
+# Spans of a question likely to name a film: quoted text, or runs of capitalized words
+QUOTED = re.compile(r"[\"'‘“](.+?)[\"'’”](?:\s|$|[?.!,])")
+CONNECTORS = {"of", "the", "a", "an", "and", "in", "on", "to", "for"}
+CAPITALIZED = re.compile(
+    r"\b[A-Z0-9][\w'&:-]*(?:\s+(?:[A-Z0-9][\w'&:-]*|(?:"
+    + "|".join(CONNECTORS)
+    + r")\b))*"
+)
+# Role prefixes of the turns of a formatted conversation ("User: ...\nBot: ...")
+ROLE = re.compile(r"^(user|bot|assistant):[ \t]*", re.IGNORECASE | re.MULTILINE)
+YEAR = re.compile(r"(?:19|20)\d{2}")
+QUESTION_WORDS = {
+    "what",
+    "whats",
+    "who",
+    "whos",
+    "when",
+    "where",
+    "which",
+    "how",
+    "why",
+    "is",
+    "tell",
+    "can",
+    "do",
+    "does",
+    "did",
+    "i",
+    "and",
+    "about",
+    "also",
+    "so",
+    "then",
+    "please",
+    "hi",
+    "hey",
+    "ok",
+    "okay",
+    "me",
+    "you",
+    "could",
+    "would",
+    "are",
+    "was",
+    "were",
+    "give",
+    "show",
+    "find",
+}
+
+# Words that are never a one-word title on their own, unless quoted (e.g. "I" or "It")
+STOP_WORDS = {
+    *"i me my you your he him his she her it its we us our they them their".split(),
+    *"a an the this that these those and or but of in on at to for with from by".split(),
+    *"is are was were be been am do does did can could will would should may might".split(),
+    *"what who whom which when where why how there here so if not no yes".split(),
+    *"movie movies film films show".split(),
+}
+
+
+def normalize(text: str) -> str:
+    """Normalize a title for lookups: no accents, case, punctuation or extra spaces."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = text.replace("&", " and ")
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def last_user_turn(text: str) -> str:
+    """Get the last user message of a formatted conversation, without its role prefix.
+    Text without role prefixes is returned as is.
+    """
+    turns = list(ROLE.finditer(text))
+    for index in range(len(turns) - 1, -1, -1):
+        if turns[index].group(1).lower() == "user":
+            end = turns[index + 1].start() if index + 1 < len(turns) else len(text)
+            return text[turns[index].end() : end].strip()
+    return ROLE.sub("", text) if turns else text
+
+
+def parse_entities(
+    document: str, metadata: Optional[Dict] = None
+) -> Tuple[Set[str], Optional[str]]:
+    """Get the normalized titles and the release year of a document.
+    Documents are either "Key: value" lines (e.g. imbd_movies) or a title line followed by
+    the plot (e.g. movie_plots).
+    """
+    fields = {}
+    for line in document.splitlines():
+        key, separator, value = line.partition(":")
+        if separator and value.strip():
+            fields.setdefault(key.strip().lower(), value.strip())
+    fields.update({str(k).lower(): str(v) for k, v in (metadata or {}).items()})
+
+    titles = {fields[key] for key in TITLE_FIELDS if key in fields}
+    if not titles and "\n" in document:
+        first_line = document.split("\n", 1)[0]
+        if len(first_line) <= 100:
+            titles.add(first_line)
+
+    year = None
+    for key in YEAR_FIELDS:
+        match = re.search(r"\b(\d{4})\b", fields.get(key, ""))
+        if match:
+            year = match.group(1)
+            break
+
+    aliases = set()
+    for title in titles:
+        title = normalize(title)
+        if title:
+            aliases.add(title)
+            if title.startswith("the "):
+                aliases.add(title[len("the ") :])
+    return aliases, year
+
+
+class TitleIndex:
+    """
+    An in-memory index from normalized titles and aliases to the documents of each collection.
+    Attributes:
+        fuzzy_cutoff (float): Minimum similarity ratio for a fuzzy match.
+        collections (Dict[str, Dict[str, List[str]]]): Point ids per normalized title, per collection.
+        documents (Dict[str, Dict[str, Tuple[ContextDocument, Optional[str]]]]): Document and year per point id, per collection.
+        words (Dict[str, Dict[str, Set[str]]]): Titles per word, per collection, to narrow down fuzzy matches.
+    Methods:
+        add(collection, documents): Index documents of a collection.
+        replace(collection, index): Swap in the index of a collection built apart.
+        remove(collection, ids): Remove documents from the index.
+        invalidate(collection): Drop the index of a collection, to be rebuilt.
+        lookup(text, collections, limit): Find the documents of the films named in a question.
+    """
+
+    def __init__(self, fuzzy_cutoff: float = 0.85):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.collections: Dict[str, Dict[str, List[str]]] = {}
+        self.documents: Dict[str, Dict[str, Tuple[ContextDocument, Optional[str]]]] = {}
+        self.words: Dict[str, Dict[str, Set[str]]] = {}
+
+    def __contains__(self, collection: str) -> bool:
+        return collection in self.collections
+
+    def add(self, collection: str, documents: Iterable[ContextDocument]):
+        """Index documents of a collection."""
+        titles = self.collections.setdefault(collection, {})
+        indexed = self.documents.setdefault(collection, {})
+        words = self.words.setdefault(collection, {})
+        for document in documents:
+            aliases, year = parse_entities(document.document, document.metadata)
+            if not aliases:
+                continue
+            id = str(document.id)
+            indexed[id] = (document, year)
+            for alias in aliases:
+                ids = titles.setdefault(alias, [])
+                if id not in ids:
+                    ids.append(id)
+                for word in alias.split():
+                    if word not in STOP_WORDS:
+                        words.setdefault(word, set()).add(alias)
+
+    def replace(self, collection: str, index: "TitleIndex"):
+        """Swap in the index of a collection built apart (e.g. in a worker thread)."""
+        self.collections[collection] = index.collections.get(collection, {})
+        self.documents[collection] = index.documents.get(collection, {})
+        self.words[collection] = index.words.get(collection, {})
+
+    def remove(self, collection: str, ids: Iterable[str]):
+        """Remove documents from the index of a collection."""
+        titles = self.collections.get(collection)
+        if titles is None:
+            return
+        ids = set(map(str, ids))
+        for id in ids:
+            self.documents[collection].pop(id, None)
+        words = self.words[collection]
+        for alias in list(titles):
+            titles[alias] = [id for id in titles[alias] if id not in ids]
+            if not titles[alias]:
+                del titles[alias]
+                for word in alias.split():
+                    words.get(word, set()).discard(alias)
+
+    def invalidate(self, collection: str):
+        """Drop the index of a collection, to be rebuilt on next use."""
+        self.collections.pop(collection, None)
+        self.documents.pop(collection, None)
+        self.words.pop(collection, None)
+
+    @staticmethod
+    def __candidate_spans(text: str) -> List[Tuple[str, bool]]:
+        """Get the spans of a question that may name a film, and whether they were quoted."""
+        spans = [(span, True) for span in QUOTED.findall(text)]
+        for span in CAPITALIZED.findall(text):
+            words = span.split()
+            # Drop the capitalized question words starting the sentence
+            while words and normalize(words[0]) in QUESTION_WORDS:
+                words = words[1:]
+            # Drop a release year, or a lowercase connector, following the title
+            while words and (YEAR.fullmatch(words[-1]) or words[-1] in CONNECTORS):
+                words = words[:-1]
+            if words:
+                spans.append((" ".join(words), False))
+        return spans
+
+    @staticmethod
+    def __is_single_word_title(span: str, key: str) -> bool:
+        """Whether an unquoted capitalized word may name a title (e.g. "Titanic", not "Her")."""
+        return (
+            len(key) > 1 and key not in STOP_WORDS and bool(re.match(r"[A-Z0-9]", span))
+        )
+
+    def __match(
+        self, span: str, quoted: bool, collection: str
+    ) -> Tuple[Optional[str], float]:
+        """Match a span to a title exactly, or fuzzily if it was quoted or has several words.
+        Fuzzy matches are only looked for among the titles sharing a word with the span.
+        """
+        titles = self.collections[collection]
+        key = normalize(span)
+        single_word = len(key.split()) < 2
+        if not quoted and single_word and not self.__is_single_word_title(span, key):
+            return None, 0.0
+        if key in titles:
+            return key, 1.0
+        if key.startswith("the ") and key[len("the ") :] in titles:
+            return key[len("the ") :], 1.0
+        if not quoted and single_word:
+            return None, 0.0
+        words = self.words[collection]
+        candidates = set().union(*[words.get(word, ()) for word in key.split()])
+        matches = difflib.get_close_matches(
+            key, candidates, n=1, cutoff=self.fuzzy_cutoff
+        )
+        if matches:
+            return matches[0], difflib.SequenceMatcher(None, key, matches[0]).ratio()
+        return None, 0.0
+
+    def lookup(
+        self, text: str, collections: List[str], limit: int = 3
+    ) -> Tuple[List[ContextDocument], bool]:
+        """Find the documents of the films named in a question.
+        Only the last user message of a formatted conversation is looked into, so that titles
+        from earlier turns or from the bot answers do not take over the current question.
+        A single unquoted word (e.g. "Up" in "Up until now") may name a film or not: it is
+        matched, but the match is not conclusive.
+        Args:
+            text (str): The question, or the formatted conversation ending with it.
+            collections (List[str]): Names of the collections to look into.
+            limit (int): Maximum number of documents to return. Defaults to 3.
+        Returns:
+            Tuple[List[ContextDocument], bool]: The documents of each matching title, best
+            title first and taking turns between titles, scored by the match similarity (1.0 for
+            exact matches). And whether every title was quoted or has several words, so that
+            no vector search is needed.
+        """
+        text = last_user_turn(text)
+        years = set(re.findall(rf"\b{YEAR.pattern}\b", text))
+        # Rank and documents of each matching title
+        matches: Dict[str, Tuple[Tuple, bool, Dict]] = {}
+        for span, quoted in self.__candidate_spans(text):
+            for collection in collections:
+                if not self.collections.get(collection):
+                    continue
+                title, score = self.__match(span, quoted, collection)
+                if title is None:
+                    continue
+                conclusive = quoted or len(title.split()) > 1
+                rank, known, documents = matches.get(title, ((0.0, 0), False, {}))
+                matches[title] = (
+                    max(rank, (score, len(title))),
+                    known or conclusive,
+                    documents,
+                )
+                for id in self.collections[collection][title]:
+                    document, year = self.documents[collection][id]
+                    # Prefer the release mentioned in the question, if any
+                    release = bool(years) and year in years
+                    key = (collection, id)
+                    if key not in documents or documents[key][0] < (score, release):
+                        documents[key] = (
+                            (score, release),
+                            document.model_copy(update={"score": score}),
+                        )
+        if not matches:
+            return [], False
+
+        # Take turns between the titles, best first, so that every film named gets documents
+        ranked = sorted(matches.values(), key=lambda match: match[0], reverse=True)
+        queues = [
+            [
+                doc
+                for _, doc in sorted(
+                    documents.values(), key=lambda d: d[0], reverse=True
+                )
+            ]
+            for _, _, documents in ranked
+        ]
+        results = []
+        for turn in range(max(map(len, queues))):
+            results.extend(queue[turn] for queue in queues if turn < len(queue))
+        conclusive = all(known for _, known, _ in ranked)
+        logger.debug(f"Title index matched {len(matches)} titles for: {text}")
+        return results[:limit], conclusive
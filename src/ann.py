@@ -0,0 +1,251 @@
+# In-process retrieval from ANN snapshots of the collections, without the retrieval service
+import asyncio
+import heapq
+import json
+import logging
+import mmap
+import re
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from annoy import AnnoyIndex
+
+from src.cache import TTLCache
+from src.embeddings import embed_query
+
+logger = logging.getLogger(__name__)
+
+
+class AnnSnapshot:
+    """
+    A read-only snapshot of a collection, exported by the retrieval service (`src.export`).
+    The annoy index, the offsets and the payloads are memory-mapped, so that every worker
+    process serving the same snapshot shares the same pages.
+    A retired snapshot is closed once the last search using it releases it.
+    Attributes:
+        path (Path): Directory of the snapshot version, with the collection symlink resolved.
+        meta (Dict): Collection, embedding model, dimension, metric and number of points.
+        users (int): Number of searches using the snapshot.
+        retired (bool): Whether the snapshot is replaced and closes when unused.
+    Methods:
+        search(vector, limit, search_k): Find the nearest documents to an embedding.
+        acquire(): Use the snapshot for a search, unless it is retired.
+        release(): Stop using the snapshot, closing it if it is retired and unused.
+        retire(): Close the snapshot once it is unused.
+        close(): Release the memory maps.
+    """
+
+    def __init__(self, path: Path):
+        # Resolve the symlink once, so that every file comes from the same version
+        self.path = Path(path).resolve()
+        self.lock = threading.Lock()
+        self.users = 0
+        self.retired = False
+        self.closed = False
+        self.meta: Dict = json.loads((self.path / "meta.json").read_text())
+
+        self.index = AnnoyIndex(self.meta["dimension"], self.meta["metric"])
+        self.index.load(str(self.path / "vectors.ann"), prefault=False)
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode="r")
+        with open(self.path / "payloads.bin", "rb") as file:
+            self.payloads = (
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.meta["count"]
+                else b""
+            )
+        logger.info(f"Loaded snapshot of {self.meta['collection']} from {self.path}")
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def __record(self, item: int) -> Dict:
+        start, end = int(self.offsets[item]), int(self.offsets[item + 1])
+        return json.loads(self.payloads[start:end])
+
+    def search(
+        self, vector: np.ndarray, limit: int, search_k: int = -1
+    ) -> List[Tuple[float, Dict]]:
+        """Find the nearest documents to an embedding.
+        Returns:
+            List[Tuple[float, Dict]]: Cosine similarity and record of each document found.
+        """
+        items, distances = self.index.get_nns_by_vector(
+            vector.tolist(), limit, search_k=search_k, include_distances=True
+        )
+        # Annoy angular distance is sqrt(2 - 2 cos) between normalized vectors
+        return [
+            (1 - distance**2 / 2, self.__record(item))
+            for item, distance in zip(items, distances)
+        ]
+
+    def acquire(self) -> bool:
+        """Use the snapshot for a search, unless it is retired.
+        Returns:
+            bool: Whether the snapshot can be searched.
+        """
+        with self.lock:
+            if self.retired:
+                return False
+            self.users += 1
+            return True
+
+    def release(self):
+        """Stop using the snapshot, closing it if it is retired and unused."""
+        with self.lock:
+            self.users -= 1
+            unused = self.retired and self.users == 0
+        if unused:
+            self.close()
+
+    def retire(self):
+        """Close the snapshot once the searches in flight release it."""
+        with self.lock:
+            self.retired = True
+            unused = self.users == 0
+        if unused:
+            self.close()
+
+    def close(self):
+        """Release the annoy index, the offsets and the payloads."""
+        if self.closed:
+            return
+        self.closed = True
+        self.index.unload()
+        if isinstance(self.payloads, mmap.mmap):
+            self.payloads.close()
+        # numpy memory maps have no close, the mapping is released with its last reference
+        self.offsets = None
+        logger.info(f"Closed snapshot of {self.meta['collection']} at {self.path}")
+
+
+class SnapshotRetriever:
+    """
+    A retrieval backend searching ANN snapshots in-process, with the interface of `RetrievalClient`.
+    Attributes:
+        snapshot_dir (Path): Directory holding one snapshot directory per collection.
+        search_k (int): Number of nodes annoy inspects per search, -1 for its default.
+        cache (TTLCache): Cache of search results, keyed by normalized text, indexes, limit and threshold.
+    Methods:
+        search(text, limit, threshold, indexes): Search the relevant documents for a text.
+        invalidate(indexes): Discard the cached results and reload the snapshots of the given indexes.
+        close(): Release the snapshots.
+    """
+
+    def __init__(
+        self,
+        snapshot_dir: Path,
+        search_k: int = -1,
+        cache_size: int = 1024,
+        cache_ttl: float = 300,
+    ):
+        self.snapshot_dir = Path(snapshot_dir)
+        self.search_k = search_k
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.snapshots: Dict[str, AnnSnapshot] = {}
+        # Searches run in worker threads, guard the loaded snapshots
+        self.lock = threading.Lock()
+
+    def __acquire_snapshot(self, index: str) -> Optional[AnnSnapshot]:
+        """Get the snapshot of an index for a search, loading it on first use.
+        The snapshot must be released once the search completes.
+        """
+        with self.lock:
+            if index not in self.snapshots:
+                path = self.snapshot_dir / index
+                if not (path / "meta.json").exists():
+                    logger.error(
+                        f"RAG :: No snapshot of {index} in {self.snapshot_dir}"
+                    )
+                    return None
+                self.snapshots[index] = AnnSnapshot(path)
+            # Snapshots are retired only once removed from the loaded ones
+            snapshot = self.snapshots[index]
+            snapshot.acquire()
+            return snapshot
+
+    def __search(
+        self, text: str, limit: int, threshold: float, indexes: List[str]
+    ) -> List[Dict]:
+        snapshots = [
+            snapshot
+            for snapshot in map(self.__acquire_snapshot, dict.fromkeys(indexes))
+            if snapshot is not None
+        ]
+        try:
+            # Embed once per model, usually a single one
+            vectors = {}
+            results = []
+            for snapshot in snapshots:
+                model = snapshot.meta["model"]
+                if model not in vectors:
+                    vectors[model] = embed_query(text, model_name=model)
+                for score, record in snapshot.search(
+                    vectors[model], limit, self.search_k
+                ):
+                    if score >= threshold:
+                        results.append({**record, "score": score})
+        finally:
+            for snapshot in snapshots:
+                snapshot.release()
+        return heapq.nlargest(limit, results, key=lambda document: document["score"])
+
+    async def search(
+        self,
+        text: str,
+        limit: int = 1,
+        threshold: float = 0.75,
+        indexes: List[str] = ["imbd_movies"],
+    ) -> List[Dict]:
+        """Search the relevant documents for a text.
+        Args:
+            text (str): The query text.
+            limit (int): Maximum number of results to return. Defaults to 1.
+            threshold (float): Minimum score of the results. Defaults to 0.75.
+            indexes (List[str]): List of collection names to query. Defaults to ["imbd_movies"].
+        Returns:
+            List[Dict]: The documents found.
+        """
+        normalized_text = re.sub(r"\s+", " ", text).strip().lower()
+        key = (normalized_text, tuple(sorted(indexes)), limit, threshold)
+        documents = self.cache.get(key)
+        if documents is None:
+            # Embedding is CPU-bound, keep the event loop responsive
+            documents = await asyncio.to_thread(
+                self.__search, text, limit, threshold, indexes
+            )
+            self.cache.set(key, documents)
+        return documents
+
+    def invalidate(self, indexes: Optional[List[str]] = None) -> int:
+        """Discard the cached results and reload the snapshots of the given indexes, or all of them.
+        Returns:
+            int: Number of cached results discarded.
+        """
+        # Searches in flight keep their snapshot until they complete, it is closed after
+        with self.lock:
+            retired = [
+                self.snapshots.pop(index)
+                for index in list(self.snapshots if indexes is None else indexes)
+                if index in self.snapshots
+            ]
+        for snapshot in retired:
+            snapshot.retire()
+        if indexes is None:
+            discarded = len(self.cache)
+            self.cache.clear()
+        else:
+            discarded = self.cache.discard_if(
+                lambda key: any(index in key[1] for index in indexes)
+            )
+        logger.info(f"RAG :: Invalidated {discarded} cached results for {indexes}")
+        return discarded
+
+    async def close(self):
+        """Release the snapshots."""
+        with self.lock:
+            snapshots = list(self.snapshots.values())
+            self.snapshots.clear()
+        for snapshot in snapshots:
+            snapshot.retire()
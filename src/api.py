@@ -1,16 +1,20 @@
 # Create a fastapi app and define the routes
+import hmac
+import json
 import logging
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from uuid import UUID, uuid4
 
-from fastapi import APIRouter, Request
-from fastapi.responses import RedirectResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 
 from src.chat import ChatBot
-from src.health import health_check
+from src.health import health_monitor
+from src.retrieval import retrieval_client
+from src.settings import INTERNAL_API_TOKEN
 
 logger = logging.getLogger(__name__)
 
@@ -24,49 +28,142 @@ class Message(BaseModel):
     context: str = Field(default="N/A")
 
 
+class InvalidationRequest(BaseModel):
+    indexes: Optional[List[str]] = None
+
+
+async def server_sent_events(
+    events: AsyncIterator[Tuple[str, Any]],
+) -> AsyncIterator[str]:
+    """Format the events generated by the chatbot as server-sent events."""
+    async for event, data in events:
+        if event == "message":
+            data = Message(**data).model_dump(mode="json")
+        elif event != "factcheck":
+            data = {"content": data}
+        yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def verify_internal_token(x_internal_token: Optional[str] = Header(default=None)):
+    """Only let callers holding the shared internal token through."""
+    if not INTERNAL_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Internal routes are disabled")
+    if x_internal_token is None or not hmac.compare_digest(
+        x_internal_token, INTERNAL_API_TOKEN
+    ):
+        raise HTTPException(status_code=401, detail="Invalid internal token")
+
+
 # create router
 router = APIRouter()
-internal_router = APIRouter()
+internal_router = APIRouter(dependencies=[Depends(verify_internal_token)])
+
+# Release pooled connections on shutdown
+router.add_event_handler("shutdown", chat.close)
+router.add_event_handler("shutdown", retrieval_client.close)
+router.add_event_handler("startup", health_monitor.start)
+router.add_event_handler("shutdown", health_monitor.close)
 
 
 @router.post("/generate_moderated", tags=["Chatbot"])
-async def moderated(message: Message) -> Message:
+async def moderated(
+    message: Message, session_id: str, use_cache: bool = True
+) -> Message:
     """Receive a user message and return a bot message using the moderated chatbot."""
-    logger.info(f"API :: Received message: {message}")
+    logger.info(f"API :: Received message for session {session_id}: {message}")
     user_message = message.model_dump()
-    bot_message = await chat.generate_moderated_message(user_message)
+    bot_message = await chat.generate_moderated_message(
+        user_message, session_id, use_cache
+    )
     print(bot_message)
     return Message(**bot_message)
 
 
 @router.post("/generate_unmoderated", tags=["Chatbot"])
-async def unmoderated(message: Message):
+async def unmoderated(message: Message, session_id: str, use_cache: bool = True):
     """Receive a list of user messages and return a bot message using the unmoderated chatbot."""
-    logger.info(f"API :: Received message: {message}")
+    logger.info(f"API :: Received message for session {session_id}: {message}")
     user_message = message.model_dump()
-    bot_message = await chat.generate_unmoderated_message(user_message)
+    bot_message = await chat.generate_unmoderated_message(
+        user_message, session_id, use_cache
+    )
     return Message(**bot_message)
 
 
+@router.post("/generate_moderated/stream", tags=["Chatbot"])
+async def moderated_stream(
+    message: Message, session_id: str, use_cache: bool = True
+) -> StreamingResponse:
+    """Receive a user message and stream the bot message tokens using the moderated chatbot."""
+    logger.info(f"API :: Received message for session {session_id}: {message}")
+    user_message = message.model_dump()
+    events = chat.stream_moderated_message(user_message, session_id, use_cache)
+    return StreamingResponse(server_sent_events(events), media_type="text/event-stream")
+
+
+@router.post("/generate_unmoderated/stream", tags=["Chatbot"])
+async def unmoderated_stream(
+    message: Message, session_id: str, use_cache: bool = True
+) -> StreamingResponse:
+    """Receive a user message and stream the bot message tokens using the unmoderated chatbot."""
+    logger.info(f"API :: Received message for session {session_id}: {message}")
+    user_message = message.model_dump()
+    events = chat.stream_unmoderated_message(user_message, session_id, use_cache)
+    return StreamingResponse(server_sent_events(events), media_type="text/event-stream")
+
+
+@router.get("/factcheck/{message_id}", tags=["Fact-Checking"])
+def factcheck(message_id: UUID) -> Dict:
+    """Get the fact-check result of a bot message, checked in the background after it was sent."""
+    if chat.fact_checker is None:
+        raise HTTPException(status_code=404, detail="Fact-checking is disabled")
+    result = chat.fact_checker.get(str(message_id))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown message")
+    return result
+
+
 @router.get("/history", tags=["Conversation History"])
-def history() -> List:
-    return chat.get_history()
+def history(session_id: str) -> List:
+    return chat.get_history(session_id)
 
 
 @router.post("/clear", tags=["Conversation History"])
-def clear():
-    chat.clear_history()
+def clear(session_id: str):
+    chat.clear_history(session_id)
     return {"status": "success"}
 
 
+@internal_router.post("/cache/invalidate", tags=["Cache"])
+def invalidate_cache(request: InvalidationRequest):
+    """Discard cached retrieval results of indexes changed in the retrieval service."""
+    discarded = retrieval_client.invalidate(request.indexes)
+    return {"status": "success", "discarded": discarded}
+
+
+@internal_router.get("/cache/stats", tags=["Cache"])
+def cache_stats() -> Dict:
+    stats = {"retrieval": retrieval_client.cache.stats()}
+    if chat.response_cache is not None:
+        stats["responses"] = chat.response_cache.stats()
+    return stats
+
+
+@internal_router.get("/factcheck/stats", tags=["Fact-Checking"])
+def factcheck_stats() -> Dict:
+    if chat.fact_checker is None:
+        return {"enabled": False}
+    return {"enabled": True, **chat.fact_checker.stats()}
+
+
 @router.get("/healthz", tags=["Health"])
 async def healthz():
-    return health_check()
+    return health_monitor.status()
 
 
 @router.get("/health", tags=["Health"])
 async def health():
-    return health_check(details=True)
+    return health_monitor.status(details=True)
 
 
 # Use public endpoint for static files
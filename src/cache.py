@@ -0,0 +1,170 @@
+# In-memory caches for the chatbot
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    A bounded cache evicting expired and least recently used entries.
+    Attributes:
+        maxsize (int): Maximum number of entries kept.
+        ttl (float): Seconds after which an entry expires.
+        hits (int): Number of lookups that found a valid entry.
+        misses (int): Number of lookups that did not find a valid entry.
+    Methods:
+        get(key): Get the value of an entry.
+        set(key, value): Add or replace an entry.
+        discard_if(predicate): Remove every entry whose key matches a predicate.
+        clear(): Remove every entry.
+        stats(): Get the hit/miss counters.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """Get the value of an entry, or `default` if missing or expired."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        """Add or replace an entry, evicting the least recently used ones if full."""
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Remove every entry whose key matches a predicate.
+        Returns:
+            int: Number of entries removed.
+        """
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        """Remove every entry."""
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the hit/miss counters."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SemanticCache:
+    """
+    A bounded cache of values looked up by embedding similarity, partitioned by namespace.
+    Attributes:
+        maxsize (int): Maximum number of entries kept per namespace.
+        threshold (float): Minimum cosine similarity for a lookup to match an entry.
+        ttl (float): Seconds after which an entry expires.
+        hits (int): Number of lookups that matched an entry.
+        misses (int): Number of lookups that did not match an entry.
+    Methods:
+        get(namespace, embedding): Get the value of the most similar entry.
+        set(namespace, embedding, value): Add an entry.
+        clear(namespace): Remove every entry of a namespace, or of all of them.
+        stats(): Get the hit/miss counters.
+    """
+
+    def __init__(self, maxsize: int = 1024, threshold: float = 0.95, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.namespaces: Dict[str, TTLCache] = {}
+        # Stacked embeddings of each namespace, rebuilt after it changes
+        self.matrices: Dict[str, Tuple[List[Hashable], np.ndarray]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.counter = 0
+
+    def __matrix(self, namespace: str) -> Tuple[List[Hashable], np.ndarray]:
+        if namespace not in self.matrices:
+            entries = self.namespaces[namespace].entries
+            keys = list(entries)
+            embeddings = [entries[key][1][0] for key in keys]
+            self.matrices[namespace] = (keys, np.stack(embeddings))
+        return self.matrices[namespace]
+
+    def get(self, namespace: str, embedding: np.ndarray) -> Optional[Any]:
+        """Get the value of the most similar entry, if above the similarity threshold."""
+        cache = self.namespaces.get(namespace)
+        if not cache:
+            self.misses += 1
+            return None
+
+        keys, matrix = self.__matrix(namespace)
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        value = None
+        if scores[best] >= self.threshold:
+            entry = cache.get(keys[best])
+            if entry is None:  # Expired
+                self.matrices.pop(namespace, None)
+            else:
+                value = entry[1]
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            logger.debug(f"Semantic cache hit in {namespace} ({scores[best]:.3f})")
+        return value
+
+    def set(self, namespace: str, embedding: np.ndarray, value: Any):
+        """Add an entry, evicting the least recently used ones of its namespace if full."""
+        cache = self.namespaces.get(namespace)
+        if cache is None:
+            cache = self.namespaces[namespace] = TTLCache(
+                maxsize=self.maxsize, ttl=self.ttl
+            )
+        self.counter += 1
+        cache.set(self.counter, (embedding, value))
+        self.matrices.pop(namespace, None)
+
+    def clear(self, namespace: Optional[str] = None):
+        """Remove every entry of a namespace, or of all of them if not specified."""
+        if namespace is None:
+            self.namespaces.clear()
+            self.matrices.clear()
+        else:
+            self.namespaces.pop(namespace, None)
+            self.matrices.pop(namespace, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the hit/miss counters."""
+        lookups = self.hits + self.misses
+        return {
+            "size": {name: len(cache) for name, cache in self.namespaces.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,15 +1,54 @@
+import asyncio
 import logging
-from collections import deque
 from pathlib import Path
-from typing import Deque, Dict, List, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from uuid import uuid4
 
-from huggingface_hub import InferenceClient
+import numpy as np
 from jinja2 import Environment, Template
 from nemoguardrails import LLMRails, RailsConfig
 from nemoguardrails.llm.output_parsers import verbose_v1_parser
-
-from src.config.actions import format_chat_history, retrieve_information
-from src.settings import INFERENCE_ENDPOINT
+from nemoguardrails.rails.llm.options import GenerationResponse
+from nemoguardrails.streaming import StreamingHandler
+
+from src.cache import SemanticCache
+from src.config.actions import (
+    format_chat_history,
+    retrieve_information,
+    start_speculative_retrieval,
+)
+from src.embeddings import embed_query
+from src.factcheck import FactChecker, get_fact_checker
+from src.facts import get_fact_store
+from src.history import ConversationStore, current_chat_history
+from src.inference import TGIClient
+from src.intents import IntentClassifier, local_intent_action
+from src.llm import DeduplicatingTGI
+from src.settings import (
+    FACTCHECK_STREAM_TIMEOUT,
+    FACTCHECKING,
+    FACTS_ENABLED,
+    GUARDRAILS_SNAPSHOT_DIR,
+    GUARDRAILS_SNAPSHOT_ENABLED,
+    HISTORY_MAX_MESSAGES,
+    HISTORY_MAX_SESSIONS,
+    HISTORY_MEMORY_SIZE,
+    HISTORY_TTL,
+    INFERENCE_ENDPOINT,
+    INFERENCE_KEEPALIVE_TIMEOUT,
+    INFERENCE_MAX_CONCURRENCY,
+    INFERENCE_MAX_CONNECTIONS,
+    INFERENCE_TIMEOUT,
+    INTENT_CLASSIFIER_ENABLED,
+    INTENT_MIN_MARGIN,
+    INTENT_MIN_SIMILARITY,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_THRESHOLD,
+    RESPONSE_CACHE_TTL,
+    SPECULATIVE_RETRIEVAL,
+)
+from src.snapshot import load_snapshot, save_snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -20,14 +59,34 @@ def verbose_v2_parser(s: str):
 
 
 class ChatBot:
-    def __init__(self, memory_size: int = 10):
+    def __init__(self, memory_size: int = HISTORY_MEMORY_SIZE):
         self.rails: LLMRails = None
-        self.client: InferenceClient = None
+        self.client: TGIClient = None
         self.prompt_template: Template = None
         self.system_prompt: str = None
-        self.history: Deque[Dict] = deque(maxlen=memory_size)
+        self.intent_classifier: Optional[IntentClassifier] = None
+        self.history: ConversationStore = ConversationStore(
+            memory_size=memory_size,
+            max_sessions=HISTORY_MAX_SESSIONS,
+            max_messages=HISTORY_MAX_MESSAGES,
+            ttl=HISTORY_TTL,
+        )
+        self.response_cache: Optional[SemanticCache] = (
+            SemanticCache(
+                maxsize=RESPONSE_CACHE_SIZE,
+                threshold=RESPONSE_CACHE_THRESHOLD,
+                ttl=RESPONSE_CACHE_TTL,
+            )
+            if RESPONSE_CACHE_ENABLED
+            else None
+        )
+        self.fact_checker: Optional[FactChecker] = (
+            get_fact_checker() if FACTCHECKING else None
+        )
         self.initialize_guardrails()
         self.initialize_client()
+        if FACTS_ENABLED:
+            get_fact_store()  # Load the tables ahead of the first question
 
     def __str__(self) -> str:
         return (
@@ -50,18 +109,110 @@ class ChatBot:
         cleaned_text = utf8_encoded_text.decode("utf-8")
         return cleaned_text
 
-    def clear_history(self):
-        """Clear conversation history."""
-        self.history.clear()
-        logger.info("Conversation history cleared.")
+    def clear_history(self, session_id: str):
+        """Clear conversation history of a session."""
+        self.history.clear(session_id)
+        logger.info(f"Conversation history cleared for session {session_id}.")
+
+    def get_history(self, session_id: str) -> List[Dict]:
+        """Get current conversation history of a session."""
+        return self.history.get(session_id)
+
+    def add_history(self, session_id: str, message: Dict[str, str]):
+        """Add message to conversation history of a session."""
+        self.history.add(session_id, message)
+
+    async def __lookup_response_cache(
+        self, profile: str, chat_history: List[Dict], use_cache: bool
+    ) -> Tuple[Optional[np.ndarray], Optional[Dict]]:
+        """Look up the answer to a context-free question (first turn of the conversation) in the semantic cache.
+        Returns:
+            Tuple[Optional[np.ndarray], Optional[Dict]]: The question embedding, or None if the cache does not apply, and the cached bot message, if any.
+        """
+        if self.response_cache is None or not use_cache or len(chat_history) != 1:
+            return None, None
+        try:
+            embedding = await asyncio.to_thread(embed_query, chat_history[0]["content"])
+        except Exception as e:
+            logger.error(f"Could not embed question for the response cache: {e}")
+            return None, None
+
+        bot_message = self.response_cache.get(profile, embedding)
+        if bot_message is not None:
+            logger.info(f"Response cache hit for {profile} question")
+            # Every serving is a message of its own, with its own fact-check
+            bot_message = {**bot_message, "id": str(uuid4())}
+        return embedding, bot_message
+
+    def __store_response_cache(
+        self, profile: str, embedding: Optional[np.ndarray], bot_message: Dict
+    ):
+        """Store the answer to a context-free question in the semantic cache."""
+        if embedding is not None:
+            # The id is the one of this message, cached answers get a new one when served
+            self.response_cache.set(
+                profile,
+                embedding,
+                {key: value for key, value in bot_message.items() if key != "id"},
+            )
+
+    def __check_facts(self, bot_message: Dict) -> bool:
+        """Check a bot message against its context in the background, if enabled.
+        The message gets an id to look up its result, if it does not have one yet.
+        """
+        if self.fact_checker is None:
+            return False
+        bot_message.setdefault("id", str(uuid4()))
+        return self.fact_checker.submit(
+            bot_message["id"], bot_message["content"], bot_message.get("context")
+        )
 
-    def get_history(self) -> List[Dict]:
-        """Get current conversation history."""
-        return list(self.history)
+    async def __wait_fact_check(self, bot_message: Dict) -> Optional[Dict]:
+        """Wait a little for the fact-check result of a streamed bot message."""
+        if self.fact_checker is None or "id" not in bot_message:
+            return None
+        return await self.fact_checker.wait(
+            bot_message["id"], timeout=FACTCHECK_STREAM_TIMEOUT
+        )
 
-    def add_history(self, message: Dict[str, str]):
-        """Add message to conversation history."""
-        self.history.append(message)
+    @staticmethod
+    def __start_speculation(chat_history: List[Dict]) -> Optional[asyncio.Task]:
+        """Start retrieval in parallel with the input rails and intent generation, if enabled."""
+        if not SPECULATIVE_RETRIEVAL:
+            return None
+        return start_speculative_retrieval(chat_history)
+
+    @staticmethod
+    async def __stream_tokens(
+        streaming_handler: StreamingHandler, generation: asyncio.Task
+    ) -> AsyncIterator[str]:
+        """Forward the tokens of a generation until its stream ends, or until the generation
+        is over without ending it (e.g. it failed before its first token).
+        """
+        tokens = streaming_handler.__aiter__()
+        while True:
+            next_token = asyncio.ensure_future(tokens.__anext__())
+            if not generation.done():
+                await asyncio.wait(
+                    {next_token, generation}, return_when=asyncio.FIRST_COMPLETED
+                )
+            if generation.done() and not next_token.done():
+                # Tokens pushed before the generation returned are still queued
+                await asyncio.wait({next_token}, timeout=0.05)
+                if not next_token.done():
+                    next_token.cancel()
+                    return
+            try:
+                chunk = await next_token
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+    @staticmethod
+    def __discard_speculation(speculation: Optional[asyncio.Task]):
+        """Discard the speculative retrieval if the rails did not use it (e.g. the input was refused)."""
+        if speculation is not None and not speculation.done():
+            speculation.cancel()
 
     def build_prompt_from_config(self, config: RailsConfig):
         """Build prompt template from RailsConfig object."""
@@ -87,7 +238,46 @@ class ChatBot:
         return
 
     def initialize_client(self):
-        self.client = InferenceClient(model=INFERENCE_ENDPOINT)
+        """Initialize the pooled, non-blocking inference client."""
+        self.client = TGIClient(
+            url=INFERENCE_ENDPOINT,
+            timeout=INFERENCE_TIMEOUT,
+            max_connections=INFERENCE_MAX_CONNECTIONS,
+            max_concurrency=INFERENCE_MAX_CONCURRENCY,
+            keepalive_timeout=INFERENCE_KEEPALIVE_TIMEOUT,
+        )
+
+    async def close(self):
+        """Release the connections held by the chatbot."""
+        await self.client.close()
+        if isinstance(self.rails.llm, DeduplicatingTGI):
+            await self.rails.llm.client.close()
+        if self.fact_checker is not None:
+            await self.fact_checker.close()
+
+    def initialize_intent_classifier(
+        self, config: RailsConfig, snapshot: Optional[Dict] = None
+    ):
+        """Classify user intents locally, falling back to the LLM when not confident."""
+        if snapshot and "embeddings" in snapshot:
+            self.intent_classifier = IntentClassifier(
+                snapshot["intents"],
+                snapshot["labels"],
+                snapshot["embeddings"],
+                min_margin=INTENT_MIN_MARGIN,
+                min_similarity=INTENT_MIN_SIMILARITY,
+            )
+        else:
+            self.intent_classifier = IntentClassifier.from_user_messages(
+                config.user_messages,
+                min_margin=INTENT_MIN_MARGIN,
+                min_similarity=INTENT_MIN_SIMILARITY,
+            )
+        fallback = self.rails.llm_generation_actions.generate_user_intent
+        self.rails.register_action(
+            local_intent_action(self.intent_classifier, fallback),
+            name="generate_user_intent",
+        )
 
     def initialize_guardrails(
         self, path_to_config: Path = Path().cwd() / "src" / "config"
@@ -109,75 +299,255 @@ class ChatBot:
         self.rails = LLMRails(config, verbose=True)
 
         # Register custom context variables
+        # (per-conversation variables such as the chat history are set in `current_chat_history`)
         self.rails.register_action_param(
             name="rag_prompt", value=config.custom_data["rag_prompt"]
         )
         self.rails.register_output_parser(
             output_parser=verbose_v2_parser, name="verbose_v2"
         )
+        if INTENT_CLASSIFIER_ENABLED:
+            # Skip embedding the intent examples if a matching snapshot exists
+            snapshot = None
+            if GUARDRAILS_SNAPSHOT_ENABLED:
+                snapshot = load_snapshot(path_to_config, GUARDRAILS_SNAPSHOT_DIR)
+            self.initialize_intent_classifier(config, snapshot)
+            if GUARDRAILS_SNAPSHOT_ENABLED and not snapshot:
+                save_snapshot(
+                    path_to_config, GUARDRAILS_SNAPSHOT_DIR, self.intent_classifier
+                )
 
         logger.info("Successfully initialized guardrails")
         return
 
+    async def __build_unmoderated_prompt(
+        self, chat_history: List[Dict]
+    ) -> Tuple[Optional[str], str, Optional[str]]:
+        """Retrieve the relevant context and render the prompt for the unmoderated chatbot.
+        Returns:
+            Tuple[Optional[str], str, Optional[str]]: The prompt, the relevant context, and the
+            answer from the fact store if the question needs no generation (without prompt).
+        """
+        # Get RAG
+        action_result = await retrieve_information(chat_history=chat_history)
+        relevant_context: str = action_result.return_value
+        fact_answer = action_result.context_updates.get("fact_answer")
+        if fact_answer:
+            return None, relevant_context, fact_answer
+
+        # Generate bot message
+        prompt = self.prompt_template.render(
+            general_instructions=self.system_prompt,
+            relevant_chunks=relevant_context,
+            history=format_chat_history(chat_history),
+        )
+
+        logger.info(f"Prompt template :: {self.prompt_template.debug_info}")
+        logger.info(f"Prompt :: {prompt}")
+        return prompt, relevant_context, None
+
+    def __build_moderated_bot_message(self, response: GenerationResponse) -> Dict:
+        """Build the bot message from the response of the rails."""
+        bot_message = response.response[0]  # Get the bot message generated
+        bot_message["content"] = self.post_processing(bot_message["content"])
+        bot_message["context"] = response.output_data.get("relevant_chunks")
+        return bot_message
+
     async def generate_moderated_message(
-        self, user_message: Dict[str, str]
+        self, user_message: Dict[str, str], session_id: str, use_cache: bool = True
     ) -> Dict[str, str]:
         """Generate a bot message based on the user message using the NeMo Guardrails framework for moderation.
         Args:
             user_message (Dict[str, str]): User message
+            session_id (str): Id of the conversation the message belongs to
+            use_cache (bool): Whether to answer from (and store in) the response cache. Defaults to True.
         Returns:
             Dict[str, str]: Bot message
         """
         # Save user message to history
-        self.add_history(user_message)
-        chat_history = self.get_history()
+        self.add_history(session_id, user_message)
+        chat_history = self.get_history(session_id)
 
-        # Generate bot message
-        self.rails.register_action_param("chat_history", chat_history)
-        response = await self.rails.generate_async(
-            messages=chat_history, options={"output_vars": True}
+        embedding, bot_message = await self.__lookup_response_cache(
+            "moderated", chat_history, use_cache
         )
-        bot_message = response.response[0]  # Get the bot message generated
-        bot_message["content"] = self.post_processing(bot_message["content"])
-        bot_message["context"] = response.output_data.get("relevant_chunks")
+        if bot_message is None:
+            # Generate bot message
+            current_chat_history.set(chat_history)
+            speculation = self.__start_speculation(chat_history)
+            try:
+                response = await self.rails.generate_async(
+                    messages=chat_history, options={"output_vars": True}
+                )
+            finally:
+                self.__discard_speculation(speculation)
+            bot_message = self.__build_moderated_bot_message(response)
+            self.__check_facts(bot_message)
+            self.__store_response_cache("moderated", embedding, bot_message)
+        else:
+            self.__check_facts(bot_message)
 
         # Save bot message to history
-        self.add_history(bot_message)
+        self.add_history(session_id, bot_message)
 
         return bot_message
 
+    async def stream_moderated_message(
+        self, user_message: Dict[str, str], session_id: str, use_cache: bool = True
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Stream a bot message based on the user message using the NeMo Guardrails framework for moderation.
+        Tokens are only produced by the bot message generation, i.e. once the input rails have passed.
+        Args:
+            user_message (Dict[str, str]): User message
+            session_id (str): Id of the conversation the message belongs to
+            use_cache (bool): Whether to answer from (and store in) the response cache. Defaults to True.
+        Yields:
+            Tuple[str, Any]: ("token", str) for every generated token, then ("message", Dict) with the bot message,
+            then ("factcheck", Dict) with its fact-check result if enabled and ready in time
+        """
+        # Save user message to history
+        self.add_history(session_id, user_message)
+        chat_history = self.get_history(session_id)
+
+        embedding, bot_message = await self.__lookup_response_cache(
+            "moderated", chat_history, use_cache
+        )
+        if bot_message is not None:
+            self.__check_facts(bot_message)
+            yield "token", bot_message["content"]
+        else:
+            # Generate bot message in the background and forward tokens as they arrive
+            current_chat_history.set(chat_history)
+            speculation = self.__start_speculation(chat_history)
+            streaming_handler = StreamingHandler()
+            generation = asyncio.create_task(
+                self.rails.generate_async(
+                    messages=chat_history,
+                    options={"output_vars": True},
+                    streaming_handler=streaming_handler,
+                )
+            )
+            try:
+                async for chunk in self.__stream_tokens(streaming_handler, generation):
+                    yield "token", self.post_processing(chunk)
+                # Raise the error of a failed generation
+                response = await generation
+            finally:
+                generation.cancel()
+                self.__discard_speculation(speculation)
+            bot_message = self.__build_moderated_bot_message(response)
+            self.__check_facts(bot_message)
+            self.__store_response_cache("moderated", embedding, bot_message)
+
+        # Save bot message to history
+        self.add_history(session_id, bot_message)
+
+        yield "message", bot_message
+
+        # The answer is complete, report its fact-check as a follow-up
+        result = await self.__wait_fact_check(bot_message)
+        if result is not None:
+            yield "factcheck", result
+
     async def generate_unmoderated_message(
         self,
         user_message: Dict[str, str],
+        session_id: str,
+        use_cache: bool = True,
     ) -> Dict[str, str]:
         """Generate a bot message based on the user message using the unmoderated chatbot.
         Args:
             user_message (Dict[str, str]): User message
+            session_id (str): Id of the conversation the message belongs to
+            use_cache (bool): Whether to answer from (and store in) the response cache. Defaults to True.
         Returns:
             Dict[str, str]: Bot message
         """
         # Save user message to history
-        self.add_history(user_message)
-        chat_history = self.get_history()
-
-        # Get RAG
-        action_result = await retrieve_information(chat_history=chat_history)
-        relevant_context: str = action_result.return_value
+        self.add_history(session_id, user_message)
+        chat_history = self.get_history(session_id)
 
-        # Generate bot message
-        prompt = self.prompt_template.render(
-            general_instructions=self.system_prompt,
-            relevant_chunks=relevant_context,
-            history=format_chat_history(chat_history),
+        embedding, bot_message = await self.__lookup_response_cache(
+            "unmoderated", chat_history, use_cache
         )
-
-        logger.info(f"Prompt template :: {self.prompt_template.debug_info}")
-        logger.info(f"Prompt :: {prompt}")
-        response = self.client.text_generation(prompt=prompt, max_new_tokens=100)
-        response = self.post_processing(response)
-        bot_message = {"role": "bot", "content": response, "context": relevant_context}
+        if bot_message is None:
+            prompt, relevant_context, response = await self.__build_unmoderated_prompt(
+                chat_history
+            )
+            if response is None:
+                response = await self.client.text_generation(
+                    prompt=prompt, max_new_tokens=100
+                )
+                response = self.post_processing(response)
+            bot_message = {
+                "role": "bot",
+                "content": response,
+                "context": relevant_context,
+            }
+            self.__check_facts(bot_message)
+            self.__store_response_cache("unmoderated", embedding, bot_message)
+        else:
+            self.__check_facts(bot_message)
 
         # Save bot message to history
-        self.add_history(bot_message)
+        self.add_history(session_id, bot_message)
 
         return bot_message
+
+    async def stream_unmoderated_message(
+        self,
+        user_message: Dict[str, str],
+        session_id: str,
+        use_cache: bool = True,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Stream a bot message based on the user message using the unmoderated chatbot.
+        Args:
+            user_message (Dict[str, str]): User message
+            session_id (str): Id of the conversation the message belongs to
+            use_cache (bool): Whether to answer from (and store in) the response cache. Defaults to True.
+        Yields:
+            Tuple[str, Any]: ("token", str) for every generated token, then ("message", Dict) with the bot message,
+            then ("factcheck", Dict) with its fact-check result if enabled and ready in time
+        """
+        # Save user message to history
+        self.add_history(session_id, user_message)
+        chat_history = self.get_history(session_id)
+
+        embedding, bot_message = await self.__lookup_response_cache(
+            "unmoderated", chat_history, use_cache
+        )
+        if bot_message is not None:
+            self.__check_facts(bot_message)
+            yield "token", bot_message["content"]
+        else:
+            prompt, relevant_context, response = await self.__build_unmoderated_prompt(
+                chat_history
+            )
+            if response is not None:
+                yield "token", response
+            else:
+                tokens = self.client.text_generation_stream(
+                    prompt=prompt, max_new_tokens=100
+                )
+                response = ""
+                async for token in tokens:
+                    token = self.post_processing(token)
+                    response += token
+                    yield "token", token
+            bot_message = {
+                "role": "bot",
+                "content": response,
+                "context": relevant_context,
+            }
+            self.__check_facts(bot_message)
+            self.__store_response_cache("unmoderated", embedding, bot_message)
+
+        # Save bot message to history
+        self.add_history(session_id, bot_message)
+
+        yield "message", bot_message
+
+        # The answer is complete, report its fact-check as a follow-up
+        result = await self.__wait_fact_check(bot_message)
+        if result is not None:
+            yield "factcheck", result
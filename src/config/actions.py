@@ -1,11 +1,14 @@
+import asyncio
 import logging
 from typing import Optional
 
-import requests
 from langchain.llms import BaseLLM
 from nemoguardrails.actions.actions import ActionResult
 
-from src.settings import RETRIEVAL_ENDPOINT
+from src.facts import get_fact_store
+from src.history import current_chat_history
+from src.retrieval import retrieval_client, speculative_retrieval
+from src.settings import FACTS_ENABLED, FACTS_SKIP_LLM
 
 logger = logging.getLogger(__name__)
 
@@ -24,20 +27,48 @@ def format_chat_history(chat_history: list) -> str:
 async def retrieve_information(
     context: Optional[dict] = {},
     llm: Optional[BaseLLM] = None,
-    chat_history: Optional[list] = [],
+    chat_history: Optional[list] = None,
 ) -> ActionResult:
-    """Retrieve relevant knowledge chunks and update the context."""
-    context_updates = {}
+    """Retrieve relevant knowledge chunks and update the context.
+    The answer of the fact store to a factual question is put first in the chunks. If
+    FACTS_SKIP_LLM is enabled, it is set as `fact_answer` to be used as the bot message
+    directly, and the retrieval is skipped.
+    """
+    context_updates = {"fact_answer": None}
+    context = context or {}
+
+    # Use the history of the conversation being processed when called from the rails
+    if chat_history is None:
+        chat_history = current_chat_history.get() or []
+
+    # Answer factual questions from the tables
+    fact = __lookup_fact(chat_history)
+    if fact is not None:
+        logger.info(f"RAG :: Answered from the fact store: {fact['answer']}")
+        if FACTS_SKIP_LLM:
+            context_updates["relevant_chunks"] = fact["answer"]
+            context_updates["fact_answer"] = fact["answer"]
+            return ActionResult(
+                return_value=context_updates["relevant_chunks"],
+                context_updates=context_updates,
+            )
 
     # Format chat history into a single string
     messages = format_chat_history(chat_history)
     logger.info(f"RAG :: Request: {str(messages)}")
 
     try:
-        chunks = await __retrieve_relevant_chunks(text=str(messages))
+        speculation = speculative_retrieval.get()
+        if speculation is not None and speculation[0] == messages:
+            logger.info("RAG :: Using speculative retrieval")
+            chunks = await speculation[1]
+        else:
+            chunks = await __retrieve_relevant_chunks(text=str(messages))
     except Exception as e:
         logger.error(f"RAG :: Failed to retrieve relevant chunks: {str(e)}")
         chunks = []
+    if fact is not None:
+        chunks = [fact["answer"], *chunks]
     if chunks != []:
         context_updates["relevant_chunks"] = "\n".join(chunks)
     else:
@@ -52,20 +83,47 @@ async def retrieve_information(
     )
 
 
+def start_speculative_retrieval(chat_history: list) -> asyncio.Task:
+    """Start retrieving the relevant chunks ahead of the `retrieve_information` action.
+    The action picks up the result when it later runs in the same context.
+    """
+    messages = format_chat_history(chat_history)
+    task = asyncio.create_task(__retrieve_relevant_chunks(text=messages))
+    # Do not report failures of speculations that are never used
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    speculative_retrieval.set((messages, task))
+    return task
+
+
+def __lookup_fact(chat_history: list) -> Optional[dict]:
+    """Answer the last user message from the fact store, if it is a factual question."""
+    if not FACTS_ENABLED:
+        return None
+    question = next(
+        (
+            item.get("content")
+            for item in reversed(chat_history)
+            if item.get("role") == "user"
+        ),
+        None,
+    )
+    if not question:
+        return None
+    try:
+        return get_fact_store().answer(question)
+    except Exception as e:
+        logger.error(f"RAG :: Failed to look up facts: {str(e)}")
+        return None
+
+
 async def __retrieve_relevant_chunks(text: str):
-    url = RETRIEVAL_ENDPOINT
-    headers = {"Content-Type": "application/json", "accept": "application/json"}
-    body = {
-        "text": text,
-        "limit": 1,
-        "threshold": 0.75,
-        "indexes": ["imbd_movies"],
-    }
-    response = requests.post(url, headers=headers, json=body)
+    response = await retrieval_client.search(
+        text=text, limit=1, threshold=0.75, indexes=["imbd_movies"]
+    )
 
     documents = [
         str(item["document"]).strip()
-        for item in response.json()
+        for item in response
         if str(item["document"]).strip()
     ]
     return documents
@@ -1,6 +1,11 @@
 from nemoguardrails import LLMRails  # The NeMo railing class
+from nemoguardrails.llm.providers import register_llm_provider
 
 from src.config.actions import retrieve_information
+from src.llm import DeduplicatingTGI
+
+# Register the TGI provider that shares identical short completions (used by `config.yaml`)
+register_llm_provider("deduplicating_tgi", DeduplicatingTGI)
 
 
 def init(app: LLMRails):
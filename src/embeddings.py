@@ -0,0 +1,29 @@
+# Local text embeddings, using the same model as the guardrails and the retrieval service
+import logging
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+from fastembed import TextEmbedding
+
+from src.settings import EMBEDDING_MODEL
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache
+def get_embedding_model(model_name: str = EMBEDDING_MODEL) -> TextEmbedding:
+    """Load an embedding model once per process."""
+    logger.info(f"Loading embedding model {model_name}")
+    return TextEmbedding(model_name=model_name)
+
+
+def embed(texts: List[str], model_name: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Embed a list of texts into a matrix of normalized embeddings."""
+    model = get_embedding_model(model_name)
+    return np.array(list(model.embed(texts)), dtype=np.float32)
+
+
+def embed_query(text: str, model_name: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Embed a single text into a normalized embedding."""
+    return embed([text], model_name=model_name)[0]
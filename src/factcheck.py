@@ -0,0 +1,223 @@
+# Background fact-checking of bot messages against their context with AlignScore
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import aiohttp
+
+from src.cache import TTLCache
+from src.settings import (
+    ALIGNSCORE_ENDPOINT,
+    FACTCHECK_DROP_POLICY,
+    FACTCHECK_MODEL,
+    FACTCHECK_QUEUE_SIZE,
+    FACTCHECK_RESULTS_SIZE,
+    FACTCHECK_RESULTS_TTL,
+    FACTCHECK_THRESHOLD,
+    FACTCHECK_TIMEOUT,
+    FACTCHECK_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class FactChecker:
+    """
+    Score bot messages against their context in the background, after they are sent.
+    Messages wait in a bounded queue: when it is full, either the new message or the oldest
+    queued one is dropped, so that a slow verifier never delays the answers.
+    Attributes:
+        url (str): Url to the AlignScore endpoint scoring a claim against an evidence.
+        threshold (float): Minimum score of a supported message.
+        timeout (float): Maximum number of seconds to score a message.
+        queue_size (int): Maximum number of messages waiting to be checked.
+        workers (int): Number of messages checked concurrently.
+        drop_policy (str): "newest" to drop new messages when the queue is full, "oldest" to drop the oldest queued one.
+        results (TTLCache): Result of each message, keyed by message id.
+        metrics (Dict[str, float]): Counters of submitted, dropped, checked, supported, unsupported and failed messages.
+    Methods:
+        submit(message_id, content, context): Queue a bot message to be checked.
+        get(message_id): Get the result of a message.
+        wait(message_id, timeout): Wait for the result of a message.
+        stats(): Get the metrics of the fact-checker.
+        close(): Stop the workers and close the pooled connections.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        threshold: float = 0.5,
+        timeout: float = 10,
+        queue_size: int = 100,
+        workers: int = 4,
+        drop_policy: str = "oldest",
+        results_size: int = 10000,
+        results_ttl: float = 3600,
+    ):
+        if drop_policy not in ("newest", "oldest"):
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.url = url
+        self.threshold = threshold
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.workers = workers
+        self.drop_policy = drop_policy
+        self.results = TTLCache(maxsize=results_size, ttl=results_ttl)
+        self.metrics: Dict[str, float] = {
+            "submitted": 0,
+            "dropped": 0,
+            "checked": 0,
+            "supported": 0,
+            "unsupported": 0,
+            "errors": 0,
+            "latency_total": 0.0,
+        }
+
+        # Created on first use, within the running event loop
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks = []
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.waiters: Dict[str, asyncio.Future] = {}
+
+    def __start(self):
+        """Start the workers and the pooled session, if needed."""
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.workers),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self.tasks = [
+                asyncio.create_task(self.__work()) for _ in range(self.workers)
+            ]
+
+    def __set_result(self, message_id: str, result: Dict):
+        self.results.set(message_id, result)
+        waiter = self.waiters.pop(message_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(result)
+
+    def submit(self, message_id: str, content: str, context: Optional[str]) -> bool:
+        """Queue a bot message to be checked against its context, without waiting.
+        Messages without context, or already checked, are not queued.
+        Returns:
+            bool: Whether the message was queued.
+        """
+        message_id = str(message_id)
+        if not context or context == "N/A" or not content:
+            return False
+        if self.results.get(message_id) is not None or message_id in self.waiters:
+            return False
+        self.__start()
+
+        if self.queue.full():
+            if self.drop_policy == "newest":
+                self.__drop(message_id)
+                return False
+            dropped_id, _, _, _ = self.queue.get_nowait()
+            self.queue.task_done()
+            self.__drop(dropped_id)
+
+        self.waiters[message_id] = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message_id, content, context, time.monotonic()))
+        self.metrics["submitted"] += 1
+        return True
+
+    def __drop(self, message_id: str):
+        self.metrics["dropped"] += 1
+        self.__set_result(message_id, {"id": message_id, "verdict": "dropped"})
+        logger.warning(f"FactCheck :: Queue full, dropped message {message_id}")
+
+    def get(self, message_id: str) -> Optional[Dict]:
+        """Get the result of a message, {"verdict": "pending"} if queued, or None if unknown."""
+        message_id = str(message_id)
+        result = self.results.get(message_id)
+        if result is None and message_id in self.waiters:
+            return {"id": message_id, "verdict": "pending"}
+        return result
+
+    async def wait(self, message_id: str, timeout: float) -> Optional[Dict]:
+        """Wait for the result of a message.
+        Returns:
+            Optional[Dict]: The result, or None if unknown or not ready within the timeout.
+        """
+        message_id = str(message_id)
+        result = self.results.get(message_id)
+        if result is not None or message_id not in self.waiters:
+            return result
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(self.waiters[message_id]), timeout
+            )
+        except asyncio.TimeoutError:
+            return None
+
+    async def __score(self, evidence: str, claim: str) -> float:
+        async with self.session.post(
+            self.url, json={"evidence": evidence, "claim": claim}
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())["alignscore"]
+
+    async def __work(self):
+        while True:
+            message_id, content, context, queued_at = await self.queue.get()
+            try:
+                start = time.monotonic()
+                score = await self.__score(context, content)
+                supported = score >= self.threshold
+                result = {
+                    "id": message_id,
+                    "verdict": "supported" if supported else "unsupported",
+                    "score": score,
+                    "latency": time.monotonic() - start,
+                    "delay": time.monotonic() - queued_at,
+                }
+                self.metrics["checked"] += 1
+                self.metrics["supported" if supported else "unsupported"] += 1
+                self.metrics["latency_total"] += result["latency"]
+                logger.info(f"FactCheck :: {result}")
+            except Exception as e:
+                self.metrics["errors"] += 1
+                result = {"id": message_id, "verdict": "error"}
+                logger.error(
+                    f"FactCheck :: Could not check message {message_id}: {e!r}"
+                )
+            finally:
+                self.queue.task_done()
+            self.__set_result(message_id, result)
+
+    def stats(self) -> Dict:
+        """Get the metrics of the fact-checker."""
+        checked = self.metrics["checked"]
+        return {
+            **{k: v for k, v in self.metrics.items() if k != "latency_total"},
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "mean_latency": self.metrics["latency_total"] / checked if checked else 0.0,
+            "unsupported_rate": (
+                self.metrics["unsupported"] / checked if checked else 0.0
+            ),
+        }
+
+    async def close(self):
+        """Stop the workers and close the pooled connections."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+def get_fact_checker() -> FactChecker:
+    """Create the fact-checker of the chatbot, scoring with the configured AlignScore model."""
+    return FactChecker(
+        url=f"{ALIGNSCORE_ENDPOINT.rstrip('/')}/alignscore_{FACTCHECK_MODEL}",
+        threshold=FACTCHECK_THRESHOLD,
+        timeout=FACTCHECK_TIMEOUT,
+        queue_size=FACTCHECK_QUEUE_SIZE,
+        workers=FACTCHECK_WORKERS,
+        drop_policy=FACTCHECK_DROP_POLICY,
+        results_size=FACTCHECK_RESULTS_SIZE,
+        results_ttl=FACTCHECK_RESULTS_TTL,
+    )
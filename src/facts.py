@@ -0,0 +1,371 @@
+# Structured answers to factual questions about movies, from the tabular datasets
+import ast
+import csv
+import logging
+import re
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from src.settings import FACTS_DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Attributes answered from the tables, checked in order:
+# (question pattern, FAQScraper question pattern, answer template)
+ATTRIBUTES: Dict[str, Tuple[str, str, str]] = {
+    "certification": (
+        r"\bage rating\b|\bcertifi|\bmpaa\b|\bwhat is .+ rated\b|\brated (pg|r)\b",
+        r"^What is .+ rated\?$",
+        "{title} is rated {value}.",
+    ),
+    "rating": (
+        r"\bratings?\b|\bimdb score\b|\brated\b",
+        r"^What is the IMDb rating of ",
+        "The IMDb rating of {title} is {value}.",
+    ),
+    "runtime": (
+        r"\bhow long\b|\brun ?time\b|\bduration\b|\blength\b",
+        r"^How long is ",
+        "{title} runs for {value}.",
+    ),
+    "director": (
+        r"\bdirect(ed|or|ors)\b",
+        r"^Who directed ",
+        "{title} was directed by {value}.",
+    ),
+    "writer": (
+        r"\bwho wrote\b|\bwriters?\b|\bscreenplay\b",
+        r"^Who wrote ",
+        "{title} was written by {value}.",
+    ),
+    "release_date": (
+        r"\breleased?\b|\bc[ao]me out\b|\bpremiere",
+        r"^When was .+ released\?$",
+        "{title} was released on {value}.",
+    ),
+    "cast": (
+        r"\bstars? in\b|\bstarring\b|\bcast\b|\bactors?\b|\bwho (plays|played|acts|acted)\b",
+        r"^Who stars in ",
+        "{title} stars {value}.",
+    ),
+    "genre": (
+        r"\bgenres?\b|\bwhat (kind|type) of (movie|film)\b",
+        r"^What genre is ",
+        "The genre of {title} is {value}.",
+    ),
+    "budget": (
+        r"\bbudget\b|\bcost to make\b",
+        r"^What was the budget for ",
+        "The budget of {title} was {value}.",
+    ),
+    "box_office": (
+        r"\bbox office\b|\bgross(ed)?\b|\bearn(ed)?\b",
+        r"^How much did .+ earn at the US box office\?$",
+        "{title} earned {value} at the US box office.",
+    ),
+}
+
+# Questions about an attribute that the tables do not answer (e.g. the release on a platform)
+EXCLUSIONS: Dict[str, str] = {
+    "release_date": r"\bnetflix\b|\bhulu\b|\bprime\b|\bdisney\b|\bhbo\b|\bstream|\bdvd\b|\bblu-?ray\b|\bon tv\b",
+}
+
+MAX_TITLE_WORDS = 12
+YEAR = re.compile(r"(?:19|20)\d{2}")
+
+# Words that are never a one-word title on their own, unless quoted (e.g. "I" or "It")
+STOP_WORDS = {
+    *"i me my you your he him his she her it its we us our they them their".split(),
+    *"a an the this that these those and or but of in on at to for with from by".split(),
+    *"is are was were be been am do does did can could will would should may might".split(),
+    *"what who whom which when where why how there here so if not no yes".split(),
+    *"movie movies film films show".split(),
+}
+# Questions about several movies, or comparing them, are not about a single fact
+AGGREGATE_WORDS = {
+    *"highest lowest best worst most least longest shortest top greatest".split(),
+    *"better worse higher lower longer shorter compare".split(),
+    *"movies films ones trilogy trilogies franchise series saga sequels prequels".split(),
+    *"all every each".split(),
+}
+QUOTES = "\"'‘’“”"
+
+
+def normalize(text: str) -> str:
+    """Normalize a title for lookups: no accents, case, punctuation or extra spaces."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = text.replace("&", " and ")
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def format_list(values: List[str]) -> str:
+    """Format a list of names as "a, b and c"."""
+    values = [value.strip() for value in values if value.strip()]
+    if len(values) <= 1:
+        return "".join(values)
+    return f"{', '.join(values[:-1])} and {values[-1]}"
+
+
+def format_runtime(minutes: int) -> str:
+    hours, minutes = divmod(int(minutes), 60)
+    parts = []
+    if hours:
+        parts.append(f"{hours} hour{'s' if hours > 1 else ''}")
+    if minutes:
+        parts.append(f"{minutes} minute{'s' if minutes > 1 else ''}")
+    return " and ".join(parts)
+
+
+def parse_list(value: str) -> str:
+    """Format a python list literal of the movie_data dataset."""
+    try:
+        return format_list(ast.literal_eval(value)) if value else ""
+    except (ValueError, SyntaxError):
+        return value
+
+
+class FactStore:
+    """
+    A columnar table of movie attributes, indexed by normalized title, answering factual
+    questions without retrieval or generation.
+    Attributes:
+        table (pa.Table): One row per movie, with the display value of each attribute.
+        years (np.ndarray): Release year of each row (0 if unknown).
+        titles (Dict[str, np.ndarray]): Rows of each normalized title, the most relevant first.
+    Methods:
+        from_directory(data_dir): Load the tables from the datasets of a directory.
+        answer(question): Answer a question about an attribute of a movie.
+    """
+
+    def __init__(self, table: pa.Table):
+        # Rows from the most recent and detailed sources first, then by popularity
+        order = np.lexsort(
+            (
+                -table.column("votes").to_numpy(zero_copy_only=False),
+                table.column("priority").to_numpy(zero_copy_only=False),
+            )
+        )
+        self.table = table.take(pa.array(order))
+        self.years = self.table.column("year").to_numpy(zero_copy_only=False)
+
+        rows: Dict[str, List[int]] = {}
+        for row, title in enumerate(self.table.column("title").to_pylist()):
+            key = normalize(title)
+            aliases = [key, key[len("the ") :]] if key.startswith("the ") else [key]
+            for alias in aliases:
+                rows.setdefault(alias, []).append(row)
+        self.titles = {key: np.array(value) for key, value in rows.items()}
+        logger.info(f"Loaded {len(self.table)} movies in the fact store")
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    @classmethod
+    def from_directory(cls, data_dir: Path) -> "FactStore":
+        """Load the tables from the FAQScraper, MoviesBasicDetailsScraper and movie_data datasets."""
+        data_dir = Path(data_dir)
+        columns: Dict[str, list] = {
+            name: []
+            for name in ["title", "year", "votes", "priority", *ATTRIBUTES.keys()]
+        }
+
+        def add_row(**values):
+            for name, column in columns.items():
+                column.append(
+                    values.get(name) or (0 if name in ("year", "votes") else None)
+                )
+
+        # Recent movies, with answers to their frequently asked questions
+        faq: Dict[str, Dict[str, str]] = {}
+        faq_path = data_dir / "FAQScraper.csv"
+        if faq_path.exists():
+            with open(faq_path, newline="", encoding="utf-8") as file:
+                for row in csv.DictReader(file):
+                    for name, (_, pattern, _) in ATTRIBUTES.items():
+                        if row["faqContent"] and re.search(
+                            pattern, row["faqTitle"] or ""
+                        ):
+                            faq.setdefault(row["movieID"], {}).setdefault(
+                                name, row["faqContent"].strip()
+                            )
+                            break
+
+        details_path = data_dir / "MoviesBasicDetailsScraper.csv"
+        if details_path.exists():
+            with open(details_path, newline="", encoding="utf-8") as file:
+                for row in csv.DictReader(file):
+                    runtime = re.fullmatch(
+                        r"(?:(\d+)h)?\s*(?:(\d+)m)?", row["movieTime"]
+                    )
+                    values = {
+                        "rating": (
+                            f"{row['movieAvgRating']} out of 10"
+                            if row["movieAvgRating"]
+                            else None
+                        ),
+                        "runtime": (
+                            format_runtime(
+                                int(runtime.group(1) or 0) * 60
+                                + int(runtime.group(2) or 0)
+                            )
+                            if runtime and row["movieTime"]
+                            else None
+                        ),
+                        **faq.get(row["movieID"], {}),
+                    }
+                    add_row(
+                        title=row["movieTitle"],
+                        year=int(row["movieYear"]) if row["movieYear"].isdigit() else 0,
+                        priority=0,
+                        **values,
+                    )
+
+        # Top movies of all time
+        movies_path = data_dir / "movie_data.csv"
+        if movies_path.exists():
+            with open(movies_path, newline="", encoding="utf-8") as file:
+                for row in csv.DictReader(file):
+                    gross = float(row["Gross"]) if row["Gross"] else None
+                    add_row(
+                        title=row["Movie Name"],
+                        year=(
+                            int(row["Year of Release"])
+                            if row["Year of Release"].isdigit()
+                            else 0
+                        ),
+                        votes=int(float(row["Votes"])) if row["Votes"] else 0,
+                        priority=1,
+                        rating=(
+                            f"{row['Movie Rating']} out of 10"
+                            if row["Movie Rating"]
+                            else None
+                        ),
+                        runtime=(
+                            format_runtime(float(row["Run Time in minutes"]))
+                            if row["Run Time in minutes"]
+                            else None
+                        ),
+                        director=parse_list(row["Director"]),
+                        cast=parse_list(row["Stars"]),
+                        genre=parse_list(row["Genre"]),
+                        certification=row["Certification"],
+                        box_office=f"${gross / 1e6:.1f} million" if gross else None,
+                    )
+
+        schema = pa.schema(
+            [
+                ("title", pa.string()),
+                ("year", pa.int32()),
+                ("votes", pa.int64()),
+                ("priority", pa.int8()),
+                *[(name, pa.string()) for name in ATTRIBUTES],
+            ]
+        )
+        return cls(pa.table(columns, schema=schema))
+
+    @staticmethod
+    def __detect_attribute(question: str) -> Optional[str]:
+        question = question.lower()
+        for name, (pattern, _, _) in ATTRIBUTES.items():
+            if re.search(pattern, question):
+                if re.search(EXCLUSIONS.get(name, r"(?!)"), question):
+                    return None
+                return name
+        return None
+
+    @staticmethod
+    def __is_single_word_title(word: str, key: str) -> bool:
+        """Whether a single word names a title: quoted (e.g. "It"), or capitalized and not a
+        pronoun nor a stop word (e.g. "Up", not "up" nor "I").
+        """
+        if len(word) > 2 and word[0] in QUOTES and word.rstrip("?!.,;:")[-1] in QUOTES:
+            return True
+        return (
+            len(key) > 1 and key not in STOP_WORDS and bool(re.match(r"[A-Z0-9]", word))
+        )
+
+    def __find_title(self, question: str) -> Optional[str]:
+        """Find the longest title named in a question, preferring the last one.
+        Titles that are just a year (e.g. "1984") only match when nothing else does, since
+        the year usually tells the release apart (e.g. "Dune 1984").
+        """
+        words = question.split()
+        best, best_rank = None, (False, 0)
+        for start in range(len(words)):
+            for end in range(start + 1, min(start + MAX_TITLE_WORDS, len(words)) + 1):
+                span = words[start:end]
+                key = normalize(" ".join(span))
+                if key not in self.titles:
+                    continue
+                if len(key.split()) < 2 and not self.__is_single_word_title(
+                    span[0], key
+                ):
+                    continue
+                rank = (not YEAR.fullmatch(key), len(key))
+                if rank >= best_rank:
+                    best, best_rank = key, rank
+        return best
+
+    def answer(self, question: str) -> Optional[Dict[str, str]]:
+        """Answer a question about an attribute of a movie.
+        Args:
+            question (str): The user question.
+        Returns:
+            Optional[Dict[str, str]]: The title, year, attribute, value and answer sentence,
+            or None if the question is not about a known attribute of a single known movie.
+        """
+        attribute = self.__detect_attribute(question)
+        if attribute is None:
+            return None
+        title = self.__find_title(question)
+        if title is None:
+            return None
+        # Superlatives, comparisons and franchises are about several movies
+        if (set(normalize(question).split()) - set(title.split())) & AGGREGATE_WORDS:
+            return None
+
+        rows = self.titles[title]
+        # Narrow down to the release year mentioned in the question, if any
+        years = [int(year) for year in re.findall(rf"\b{YEAR.pattern}\b", question)]
+        if years:
+            matching = rows[np.isin(self.years[rows], years)]
+            rows = matching if len(matching) else rows
+
+        candidates = self.table.take(pa.array(rows))
+        values = candidates.column(attribute)
+        valid = pc.is_valid(values).to_numpy(zero_copy_only=False)
+        if valid.any():
+            row = int(np.argmax(valid))
+            value = values[row].as_py()
+            template = ATTRIBUTES[attribute][2]
+        elif attribute == "release_date" and candidates.column("year")[0].as_py():
+            row = 0
+            value = str(candidates.column("year")[0].as_py())
+            template = "{title} was released in {value}."
+        else:
+            return None
+
+        name = candidates.column("title")[row].as_py()
+        year = candidates.column("year")[row].as_py()
+        display = f"{name} ({year})" if year and attribute != "release_date" else name
+        logger.debug(f"Facts :: {attribute} of {display}: {value}")
+        return {
+            "title": name,
+            "year": str(year) if year else "",
+            "attribute": attribute,
+            "value": value,
+            "answer": template.format(title=display, value=value),
+        }
+
+
+@lru_cache(maxsize=1)
+def get_fact_store() -> FactStore:
+    """Get the fact store, loading it on first use."""
+    return FactStore.from_directory(FACTS_DATA_DIR)
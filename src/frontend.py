@@ -1,5 +1,6 @@
 import asyncio
-from typing import Dict, List
+import json
+from typing import Any, AsyncIterator, Dict, List, Tuple
 
 import aiohttp
 import chainlit as cl
@@ -20,12 +21,28 @@ def store_message(message: Dict):
     cl.user_session.set("messages_history", chat_history)
 
 
-async def async_post_request(url, json=None) -> Dict:
+async def async_post_request(url, json=None, params=None) -> Dict:
     async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=json) as response:
+        async with session.post(url, json=json, params=params) as response:
             return await response.json()
 
 
+async def async_stream_request(
+    url, payload=None, params=None
+) -> AsyncIterator[Tuple[str, Any]]:
+    """Post a request and yield the (event, data) pairs of the server-sent events response."""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=payload, params=params) as response:
+            response.raise_for_status()
+            event = None
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if line.startswith("event:"):
+                    event = line[len("event:") :].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[len("data:") :])
+
+
 @cl.set_chat_profiles
 async def chat_profile():
     return [
@@ -71,7 +88,8 @@ async def set_starters():
 @cl.on_chat_start
 async def on_chat_start():
     cl.user_session.set("messages_history", {})
-    _ = await async_post_request(ENDPOINTS["clear"], {})
+    session_id: str = cl.user_session.get("id")
+    _ = await async_post_request(ENDPOINTS["clear"], {}, {"session_id": session_id})
     logger.info("New Chat")
 
 
@@ -90,24 +108,42 @@ async def message(message: cl.Message):
     """Receive a user message and return a bot message"""
     # Retrieve user variables
     chat_profile: str = cl.user_session.get("chat_profile")
+    session_id: str = cl.user_session.get("id")
     user_message = {"role": "user", "content": message.content or ""}
+    reply = cl.Message(content="")
+    answered = False
     try:
-        # Generate bot message
-        url = ENDPOINTS.get(chat_profile.lower())
-        bot_message = await async_post_request(url, user_message)
-        store_message(bot_message)
-
-        # Create chainlit message object
-        message = cl.Message(
-            content=bot_message.get("content"), id=str(bot_message.get("id"))
-        )
-        action_show_sources = cl.Action(
-            name="Show Sources", value=message.id, label="📄 Display Sources"
-        )
-        # Send bot message
-        await message.send()
-        await action_show_sources.send(for_id=message.id)
-
+        # Generate bot message, rendering tokens as they arrive
+        url = ENDPOINTS.get(f"{chat_profile.lower()}_stream")
+        async for event, data in async_stream_request(
+            url, user_message, {"session_id": session_id}
+        ):
+            if event == "token":
+                await reply.stream_token(data["content"])
+            elif event == "message":
+                # Send bot message as soon as it is complete, before it is fact-checked
+                bot_message = {**data, "id": reply.id}
+                store_message(bot_message)
+                reply.content = bot_message.get("content", reply.content)
+                await reply.send()
+                answered = True
+                action_show_sources = cl.Action(
+                    name="Show Sources", value=reply.id, label="📄 Display Sources"
+                )
+                await action_show_sources.send(for_id=reply.id)
+            elif event == "factcheck" and data.get("verdict") == "unsupported":
+                await cl.Message(
+                    content=(
+                        "⚠️ This answer may not be supported by its sources "
+                        f"(score: {data['score']:.2f})."
+                    ),
+                    parent_id=reply.id,
+                ).send()
     except Exception as e:
         logger.error(e)
+
+    # The request failed, or the stream broke before the bot message was complete
+    if not answered:
+        if reply.content:
+            await reply.remove()
         await cl.Message(content="Connection Error").send()
@@ -1,82 +1,142 @@
+import asyncio
 import logging
-import traceback
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
 
-import requests
+import aiohttp
 
 from src.settings import (
     ALIGNSCORE_ENDPOINT,
     FACTCHECKING,
+    HEALTH_CHECK_INTERVAL,
+    HEALTH_CHECK_TIMEOUT,
     INFERENCE_HEALTH_ENDPOINT,
-    RETRIEVAL_ENDPOINT,
+    RETRIEVAL_BACKEND,
+    RETRIEVAL_HEALTH_ENDPOINT,
 )
 
 logger = logging.getLogger(__name__)
 
 
-def health_check(details: bool = False):
-    # Custom health check to verify connectivity to the rag api
-    try:
-        rag_response = requests.post(
-            url=RETRIEVAL_ENDPOINT,
-            headers={"Content-Type": "application/json", "accept": "application/json"},
-            json={
-                "text": "King Kong",
-                "limit": 1,
-                "threshold": 0.85,
-                "indexes": ["imbd_movies"],
+class HealthMonitor:
+    """
+    Probe the dependencies of the chatbot concurrently in the background, and keep their latest status.
+    Health endpoints answer from the kept status, so that probes never add latency or load to the backends.
+    Attributes:
+        urls (Dict[str, Optional[str]]): Url probed with a GET per dependency, None if disabled.
+        interval (float): Seconds between two checks.
+        timeout (float): Maximum number of seconds of each probe.
+        health_status (Dict): Latest status, with the status and check time of each dependency.
+    Methods:
+        start(): Check the dependencies once, then keep checking them in the background.
+        check(): Probe every dependency concurrently and update the status.
+        status(details): Get the latest status.
+        close(): Stop the background checks and close the pooled connections.
+    """
+
+    def __init__(
+        self,
+        urls: Dict[str, Optional[str]],
+        interval: float = 10,
+        timeout: float = 1,
+    ):
+        self.urls = urls
+        self.interval = interval
+        self.timeout = timeout
+        self.health_status: Dict = {
+            "status": "unknown",
+            "checked_at": None,
+            "details": {
+                name: {"status": "unknown", "checked_at": None} for name in urls
             },
-            timeout=1,
+        }
+        self.summary: Dict = {"status": "unknown"}
+
+        # Created on start, within the running event loop
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def __probe(self, url: Optional[str]) -> Dict:
+        if url is None:
+            return {"status": "disabled"}
+        start = time.monotonic()
+        try:
+            async with self.session.get(url) as response:
+                status = "ok" if response.status == 200 else "error"
+        except Exception as e:
+            logger.error(f"Health :: Could not reach {url}: {e!r}")
+            status = "error"
+        return {"status": status, "latency": time.monotonic() - start}
+
+    async def check(self) -> Dict:
+        """Probe every dependency concurrently and update the status.
+        Returns:
+            Dict: The new status.
+        """
+        results = await asyncio.gather(
+            *[self.__probe(url) for url in self.urls.values()]
         )
-        rag_status = (
+        checked_at = datetime.now(timezone.utc).isoformat()
+        details = {
+            name: {**result, "checked_at": checked_at}
+            for name, result in zip(self.urls, results)
+        }
+        status = (
             "ok"
-            if (rag_response.status_code == 200 and rag_response.json())
+            if all(result["status"] in ("ok", "disabled") for result in results)
             else "error"
         )
-    except Exception:
-        logger.error(traceback.format_exc())
-        rag_status = "error"
+        if status != self.health_status["status"]:
+            logger.info(f"Health Status: {status} {details}")
+        # Replace, rather than update, so readers never see a partial status
+        self.health_status = {
+            "status": status,
+            "checked_at": checked_at,
+            "details": details,
+        }
+        self.summary = {"status": status}
+        return self.health_status
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Health :: Check failed: {e!r}")
 
-    # Custom health check to verify connectivity to the llm
-    try:
-        llm_response = requests.get(
-            url=INFERENCE_HEALTH_ENDPOINT,
-            timeout=1,
+    async def start(self):
+        """Check the dependencies once, then keep checking them in the background."""
+        if self.task is not None:
+            return
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
         )
-        llm_status = "ok" if (llm_response.status_code == 200) else "error"
-    except Exception:
-        logger.error(traceback.format_exc())
-        llm_status = "error"
+        await self.check()
+        self.task = asyncio.create_task(self.__run())
 
-    # Custom health check to verify connectivity to the align score server
-    try:
-        if FACTCHECKING:
-            alignscore_response = requests.get(url=ALIGNSCORE_ENDPOINT, timeout=1)
-            alignscore_status = (
-                "ok" if alignscore_response.status_code == 200 else "error"
-            )
-        else:
-            alignscore_status = "disabled"
-    except Exception:
-        logger.error(traceback.format_exc())
-        alignscore_status = "error"
+    def status(self, details: bool = False) -> Dict:
+        """Get the latest status, without probing the dependencies."""
+        return self.health_status if details else self.summary
 
-    # Constructing the health status response
-    health_status = {
-        "status": (
-            "ok"
-            if rag_status == "ok"
-            and llm_status == "ok"
-            and alignscore_status in ["ok", "disabled"]
-            else "error"
-        ),
-        "details": {
-            "rag": rag_status,
-            "llm": llm_status,
-            "alignscore": alignscore_status,
-        },
-    }
+    async def close(self):
+        """Stop the background checks and close the pooled connections."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
 
-    logger.info(f"Health Status: {health_status}")
-    if details:
-        return health_status
-    return {"status": health_status["status"]}
+
+health_monitor = HealthMonitor(
+    urls={
+        # Exported snapshots are searched in-process, without the retrieval service
+        "rag": RETRIEVAL_HEALTH_ENDPOINT if RETRIEVAL_BACKEND == "http" else None,
+        "llm": INFERENCE_HEALTH_ENDPOINT,
+        "alignscore": ALIGNSCORE_ENDPOINT if FACTCHECKING else None,
+    },
+    interval=HEALTH_CHECK_INTERVAL,
+    timeout=HEALTH_CHECK_TIMEOUT,
+)
@@ -0,0 +1,102 @@
+# Session-keyed conversation history for the chatbot
+import logging
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Chat history of the conversation being processed by the current task.
+# Used by actions called from within the rails, which are shared by all sessions.
+current_chat_history: ContextVar[Optional[List[Dict]]] = ContextVar(
+    "current_chat_history", default=None
+)
+
+
+class ConversationStore:
+    """
+    A bounded, session-keyed store of conversation windows.
+    Attributes:
+        memory_size (int): Maximum number of messages kept per session.
+        max_sessions (int): Maximum number of sessions kept in memory.
+        max_messages (int): Maximum number of messages kept across all sessions.
+        ttl (float): Seconds of inactivity after which a session is evicted.
+    Methods:
+        get(session_id): Get the conversation window of a session.
+        add(session_id, message): Add a message to the conversation window of a session.
+        clear(session_id): Remove a session from the store.
+    """
+
+    def __init__(
+        self,
+        memory_size: int = 10,
+        max_sessions: int = 10000,
+        max_messages: int = 100000,
+        ttl: float = 3600,
+    ):
+        self.memory_size = memory_size
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.ttl = ttl
+
+        # Sessions are kept in least recently used order
+        self.sessions: OrderedDict[str, Deque[Dict]] = OrderedDict()
+        self.last_access: Dict[str, float] = {}
+        self.total_messages = 0
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    def __remove(self, session_id: str):
+        window = self.sessions.pop(session_id)
+        self.last_access.pop(session_id, None)
+        self.total_messages -= len(window)
+
+    def __touch(self, session_id: str):
+        self.sessions.move_to_end(session_id)
+        self.last_access[session_id] = time.monotonic()
+
+    def evict(self):
+        """Evict idle sessions, then least recently used sessions until within bounds."""
+        deadline = time.monotonic() - self.ttl
+        while self.sessions:
+            session_id = next(iter(self.sessions))
+            if self.last_access[session_id] >= deadline:
+                break
+            self.__remove(session_id)
+            logger.debug(f"History :: Evicted idle session {session_id}")
+
+        while self.sessions and (
+            len(self.sessions) > self.max_sessions
+            or self.total_messages > self.max_messages
+        ):
+            session_id = next(iter(self.sessions))
+            self.__remove(session_id)
+            logger.debug(f"History :: Evicted least recently used session {session_id}")
+
+    def get(self, session_id: str) -> List[Dict]:
+        """Get the conversation window of a session."""
+        if session_id not in self.sessions:
+            return []
+        self.__touch(session_id)
+        return list(self.sessions[session_id])
+
+    def add(self, session_id: str, message: Dict):
+        """Add a message to the conversation window of a session."""
+        window = self.sessions.get(session_id)
+        if window is None:
+            window = self.sessions[session_id] = deque(maxlen=self.memory_size)
+        if len(window) < self.memory_size:
+            self.total_messages += 1
+        window.append(message)
+        self.__touch(session_id)
+        self.evict()
+
+    def clear(self, session_id: str):
+        """Remove a session from the store."""
+        if session_id in self.sessions:
+            self.__remove(session_id)
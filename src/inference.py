@@ -0,0 +1,127 @@
+# Non-blocking client for the Text Generation Inference (TGI) server
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class TGIClient:
+    """
+    An asynchronous TGI client sharing a pool of keep-alive connections.
+    Attributes:
+        url (str): Url to the TGI server.
+        timeout (float): Maximum number of seconds a generation may take.
+        max_connections (int): Maximum number of pooled connections to the server.
+        max_concurrency (int): Maximum number of generations in flight at the same time.
+        keepalive_timeout (float): Seconds an idle pooled connection is kept open.
+    Methods:
+        text_generation(prompt, max_new_tokens): Generate a completion for a prompt.
+        text_generation_stream(prompt, max_new_tokens): Stream the tokens of a completion for a prompt.
+        close(): Close the pooled connections.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = 60,
+        max_connections: int = 100,
+        max_concurrency: int = 32,
+        keepalive_timeout: float = 30,
+    ):
+        self.url = str(url).rstrip("/")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.keepalive_timeout = keepalive_timeout
+
+        # Created on first use, within the running event loop
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    def __str__(self) -> str:
+        return "TGIClient(url={}, max_concurrency={})".format(
+            self.url, self.max_concurrency
+        )
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        """Get the shared session, creating it if needed."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Content-Type": "application/json"},
+            )
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            logger.debug(f"Initialized connection pool to {self.url}")
+        return self.session
+
+    @staticmethod
+    def __build_body(prompt: str, max_new_tokens: int, **parameters) -> Dict:
+        return {
+            "inputs": prompt,
+            "parameters": {"max_new_tokens": max_new_tokens, **parameters},
+        }
+
+    async def text_generation(
+        self, prompt: str, max_new_tokens: int = 100, **parameters
+    ) -> str:
+        """Generate a completion for a prompt.
+        Args:
+            prompt (str): The prompt to complete.
+            max_new_tokens (int): Maximum number of tokens to generate. Defaults to 100.
+            **parameters: Additional TGI generation parameters (e.g. temperature, stop).
+        Returns:
+            str: The generated text.
+        """
+        session = self.__get_session()
+        body = self.__build_body(prompt, max_new_tokens, **parameters)
+        async with self.semaphore:
+            async with session.post(f"{self.url}/generate", json=body) as response:
+                response.raise_for_status()
+                output = await response.json()
+        return output["generated_text"]
+
+    async def text_generation_stream(
+        self, prompt: str, max_new_tokens: int = 100, **parameters
+    ) -> AsyncIterator[str]:
+        """Stream the tokens of a completion for a prompt as they are generated.
+        Args:
+            prompt (str): The prompt to complete.
+            max_new_tokens (int): Maximum number of tokens to generate. Defaults to 100.
+            **parameters: Additional TGI generation parameters (e.g. temperature, stop).
+        Yields:
+            str: The text of each generated token.
+        """
+        session = self.__get_session()
+        body = self.__build_body(prompt, max_new_tokens, **parameters)
+        async with self.semaphore:
+            async with session.post(
+                f"{self.url}/generate_stream", json=body
+            ) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    output = json.loads(line[len("data:") :])
+                    if "error" in output:
+                        raise RuntimeError(f"TGI :: {output['error']}")
+                    token = output["token"]
+                    if not token.get("special"):
+                        yield token["text"]
+
+    async def close(self):
+        """Close the pooled connections."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.debug(f"Closed connection pool to {self.url}")
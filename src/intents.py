@@ -0,0 +1,107 @@
+# Local classification of user messages into the canonical forms defined in the rails
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from nemoguardrails.actions.actions import ActionResult
+from nemoguardrails.actions.llm.utils import get_last_user_utterance_event
+from nemoguardrails.utils import new_event_dict
+
+from src.embeddings import embed, embed_query
+
+logger = logging.getLogger(__name__)
+
+
+class IntentClassifier:
+    """
+    A nearest-neighbour classifier over the example utterances of the user canonical forms.
+    Attributes:
+        intents (List[str]): The canonical forms, e.g. "ask movie trivia".
+        labels (np.ndarray): Index in `intents` of each example.
+        embeddings (np.ndarray): Normalized embedding of each example.
+        min_margin (float): Minimum similarity gap between the best and second best intents.
+        min_similarity (float): Minimum similarity to the closest example of the best intent.
+    Methods:
+        classify(text): Get the canonical form of a user message, if confident enough.
+    """
+
+    def __init__(
+        self,
+        intents: List[str],
+        labels: np.ndarray,
+        embeddings: np.ndarray,
+        min_margin: float = 0.05,
+        min_similarity: float = 0.7,
+    ):
+        self.intents = intents
+        self.labels = labels
+        self.embeddings = embeddings
+        self.min_margin = min_margin
+        self.min_similarity = min_similarity
+
+    @classmethod
+    def from_user_messages(
+        cls, user_messages: Dict[str, List[str]], **kwargs
+    ) -> "IntentClassifier":
+        """Embed the example utterances of each canonical form (`define user ...` in colang)."""
+        intents = list(user_messages)
+        examples, labels = [], []
+        for label, intent in enumerate(intents):
+            examples.extend(user_messages[intent])
+            labels.extend([label] * len(user_messages[intent]))
+        logger.info(
+            f"Embedding {len(examples)} examples of {len(intents)} user intents"
+        )
+        return cls(intents, np.array(labels), embed(examples), **kwargs)
+
+    def classify(self, text: str) -> Optional[str]:
+        """Get the canonical form of a user message, or None if not confident enough."""
+        if len(self.intents) == 0:
+            return None
+        scores = self.embeddings @ embed_query(text)
+
+        # Similarity of the closest example of each intent
+        best_scores = np.full(len(self.intents), -1.0)
+        np.maximum.at(best_scores, self.labels, scores)
+        ranking = np.argsort(best_scores)[::-1]
+        best = best_scores[ranking[0]]
+        margin = best - best_scores[ranking[1]] if len(ranking) > 1 else best
+
+        intent = self.intents[ranking[0]]
+        logger.info(
+            f"Intent :: {intent} (similarity={best:.3f}, margin={margin:.3f}) for '{text}'"
+        )
+        if best < self.min_similarity or margin < self.min_margin:
+            return None
+        return intent
+
+
+def local_intent_action(classifier: IntentClassifier, fallback: Callable) -> Callable:
+    """Wrap the `generate_user_intent` action so the LLM is only called when the classifier is not confident."""
+
+    async def generate_user_intent(
+        events: List[dict],
+        context: Optional[dict] = None,
+        config=None,
+        llm=None,
+        kb=None,
+    ):
+        event = get_last_user_utterance_event(events)
+        if event is not None:
+            try:
+                intent = await asyncio.to_thread(classifier.classify, event["text"])
+            except Exception as e:
+                logger.error(f"Intent :: Local classification failed: {e}")
+                intent = None
+            if intent is not None:
+                return ActionResult(
+                    events=[new_event_dict("UserIntent", intent=intent)]
+                )
+
+        logger.info("Intent :: Falling back to the LLM")
+        return await fallback(
+            events=events, context=context, config=config, llm=llm, kb=kb
+        )
+
+    return generate_user_intent
@@ -0,0 +1,173 @@
+# LLM provider for the guardrails, sharing identical short completions in flight
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+from langchain_core.pydantic_v1 import Field, root_validator
+
+from src.inference import TGIClient
+
+logger = logging.getLogger(__name__)
+
+
+class RequestDeduplicator:
+    """
+    Share the completion of identical requests in flight at the same time.
+    Distinct requests are sent right away, without waiting for others: TGI already batches
+    concurrent requests in the same forward passes with its continuous batching.
+    Attributes:
+        client (TGIClient): Client used to send the requests.
+        in_flight (Dict[Tuple[str, str], asyncio.Task]): Request in flight per prompt and parameters.
+    Methods:
+        submit(prompt, parameters): Send a request, or join the identical one in flight, and wait for its completion.
+    """
+
+    def __init__(self, client: TGIClient):
+        self.client = client
+        self.in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    async def submit(self, prompt: str, parameters: Dict) -> str:
+        """Send a request, or join the identical one in flight, and wait for its completion."""
+        key = (prompt, json.dumps(parameters, sort_keys=True))
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(
+                self.client.text_generation(prompt, **parameters)
+            )
+            self.in_flight[key] = task
+            task.add_done_callback(lambda task: self.__done(key, task))
+        else:
+            logger.debug("LLM :: Joined an identical request in flight")
+        # Cancelling one caller must not cancel the request shared with the others
+        return await asyncio.shield(task)
+
+    def __done(self, key: Tuple[str, str], task: asyncio.Task):
+        self.in_flight.pop(key, None)
+        # Do not report failures of requests whose callers were all cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+class DeduplicatingTGI(LLM):
+    """
+    TGI LLM for the guardrails sharing a pool of connections, where identical short completions
+    (e.g. the `self_check_input` and `generate_next_steps` tasks) in flight share one request.
+    Requests are not coalesced into batches on the client: TGI's continuous batching already
+    runs concurrent requests in the same forward passes, so holding them would only add latency.
+    """
+
+    inference_server_url: str = ""
+    """text-generation-inference instance base url"""
+    max_new_tokens: int = 512
+    """Maximum number of generated tokens"""
+    temperature: Optional[float] = 0.8
+    """The value used to module the logits distribution."""
+    stop_sequences: List[str] = Field(default_factory=list)
+    """Stop generating tokens if a member of `stop_sequences` is generated"""
+    timeout: float = 120
+    """Timeout in seconds"""
+    streaming: bool = False
+    """Whether to generate a stream of tokens asynchronously"""
+    max_concurrency: int = 32
+    """Maximum number of generations in flight at the same time"""
+    dedup_max_new_tokens: int = 5
+    """Identical completions of at most this many tokens in flight share one request"""
+    client: Any = None
+    deduplicator: Any = None
+
+    @root_validator(skip_on_failure=True)
+    def initialize_client(cls, values: Dict) -> Dict:
+        values["client"] = TGIClient(
+            url=values["inference_server_url"],
+            timeout=values["timeout"],
+            max_concurrency=values["max_concurrency"],
+        )
+        values["deduplicator"] = RequestDeduplicator(values["client"])
+        return values
+
+    @property
+    def _llm_type(self) -> str:
+        return "deduplicating_tgi"
+
+    def __parameters(self, stop: Optional[List[str]]) -> Dict:
+        """Read the generation parameters, which the rails temporarily set on the LLM for each task."""
+        parameters = {
+            "max_new_tokens": self.max_new_tokens,
+            "stop": [*self.stop_sequences, *(stop or [])],
+        }
+        if self.temperature:  # TGI only accepts strictly positive temperatures
+            parameters["temperature"] = self.temperature
+        return parameters
+
+    @staticmethod
+    def __remove_stop_sequences(text: str, stop: List[str]) -> str:
+        for stop_sequence in stop:
+            if stop_sequence in text:
+                text = text[: text.index(stop_sequence)]
+        return text
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        parameters = self.__parameters(stop)
+        response = requests.post(
+            f"{self.inference_server_url.rstrip('/')}/generate",
+            json={"inputs": prompt, "parameters": parameters},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        text = response.json()["generated_text"]
+        return self.__remove_stop_sequences(text, parameters["stop"])
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        parameters = self.__parameters(stop)
+
+        # Short completions (guard and intent tasks) are often identical across users
+        if parameters["max_new_tokens"] <= self.dedup_max_new_tokens:
+            text = await self.deduplicator.submit(prompt, parameters)
+            return self.__remove_stop_sequences(text, parameters["stop"])
+
+        if not self.streaming:
+            text = await self.client.text_generation(prompt, **parameters)
+            return self.__remove_stop_sequences(text, parameters["stop"])
+
+        completion = ""
+        tokens = self.client.text_generation_stream(prompt, **parameters)
+        try:
+            async for token in tokens:
+                stop_sequences = [
+                    s for s in parameters["stop"] if s in completion + token
+                ]
+                if stop_sequences:
+                    text = self.__remove_stop_sequences(
+                        completion + token, stop_sequences
+                    )
+                    token = text[len(completion) :]
+                completion += token
+                if run_manager:
+                    await run_manager.on_llm_new_token(
+                        token, chunk=GenerationChunk(text=token)
+                    )
+                if stop_sequences:
+                    break
+        finally:
+            await tokens.aclose()
+        return completion
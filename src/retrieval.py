@@ -0,0 +1,276 @@
+# Non-blocking client for the retrieval (rag) service
+import asyncio
+import logging
+import re
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from src.ann import SnapshotRetriever
+from src.cache import TTLCache
+from src.settings import (
+    RETRIEVAL_BACKEND,
+    RETRIEVAL_BACKOFF,
+    RETRIEVAL_CACHE_SIZE,
+    RETRIEVAL_CACHE_TTL,
+    RETRIEVAL_ENDPOINT,
+    RETRIEVAL_FAILURE_THRESHOLD,
+    RETRIEVAL_MAX_CONNECTIONS,
+    RETRIEVAL_RESET_TIMEOUT,
+    RETRIEVAL_RETRIES,
+    RETRIEVAL_SNAPSHOT_DIR,
+    RETRIEVAL_SNAPSHOT_SEARCH_K,
+    RETRIEVAL_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Retrieval started ahead of the rails for the current task, as (query text, task)
+speculative_retrieval: ContextVar[Optional[Tuple[str, asyncio.Task]]] = ContextVar(
+    "speculative_retrieval", default=None
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fail fast after repeated failures until a cool-down period has elapsed.
+    Once half-open, a single trial call goes through, the others are rejected until its outcome.
+    Attributes:
+        failure_threshold (int): Consecutive failures after which the circuit opens.
+        reset_timeout (float): Seconds after which an open circuit lets a trial call through.
+        probing (bool): Whether the trial call of the half-open circuit is in flight.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a call may go through. In the half-open state, only the first one does."""
+        state = self.state
+        if state == "half-open":
+            if self.probing:
+                return False
+            self.probing = True
+        return state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            logger.warning(f"Circuit opened after {self.failures} failures")
+        self.probing = False
+
+    def release(self):
+        """Let another trial call through, the current one ended without an outcome."""
+        self.probing = False
+
+
+class RetrievalClient:
+    """
+    An asynchronous client for the retrieval service sharing a pool of keep-alive connections.
+    Attributes:
+        url (str): Url to the search endpoint of the retrieval service.
+        timeout (float): Maximum number of seconds for each attempt.
+        retries (int): Number of retries after a failed attempt.
+        backoff (float): Seconds to wait before the first retry, doubled on every retry.
+        max_connections (int): Maximum number of pooled connections to the service.
+        breaker (CircuitBreaker): Circuit breaker protecting the service.
+        cache (TTLCache): Cache of search results, keyed by normalized text, indexes, limit and threshold.
+    Methods:
+        search(text, limit, threshold, indexes): Search the relevant documents for a text.
+        invalidate(indexes): Discard the cached results of the given indexes.
+        close(): Close the pooled connections.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = 2,
+        retries: int = 2,
+        backoff: float = 0.1,
+        max_connections: int = 100,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        cache_size: int = 1024,
+        cache_ttl: float = 300,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.breaker = CircuitBreaker(
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout
+        )
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.generation = 0  # Incremented on every invalidation
+
+        # Created on first use, within the running event loop
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        """Get the shared session, creating it if needed."""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    "Content-Type": "application/json",
+                    "accept": "application/json",
+                },
+            )
+        return self.session
+
+    @staticmethod
+    def __cache_key(
+        text: str, limit: int, threshold: float, indexes: List[str]
+    ) -> Tuple:
+        normalized_text = re.sub(r"\s+", " ", text).strip().lower()
+        return (normalized_text, tuple(sorted(indexes)), limit, threshold)
+
+    @staticmethod
+    def __is_unavailable(error: BaseException) -> bool:
+        """Whether an error means the service is unavailable: connection errors, timeouts and 5xx.
+        Other errors, e.g. 4xx, would fail again and do not count against the service.
+        """
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status >= 500
+        return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+    async def __post(self, body: Dict) -> List[Dict]:
+        """Post a request, retrying attempts failed on an unavailable service with exponential backoff."""
+        session = self.__get_session()
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.post(self.url, json=body) as response:
+                    response.raise_for_status()
+                    return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries or not self.__is_unavailable(e):
+                    raise
+                delay = self.backoff * 2**attempt
+                logger.warning(
+                    f"RAG :: Attempt {attempt + 1} failed ({e!r}), retrying in {delay}s"
+                )
+                await asyncio.sleep(delay)
+
+    async def search(
+        self,
+        text: str,
+        limit: int = 1,
+        threshold: float = 0.75,
+        indexes: List[str] = ["imbd_movies"],
+    ) -> List[Dict]:
+        """Search the relevant documents for a text.
+        Args:
+            text (str): The query text.
+            limit (int): Maximum number of results to return. Defaults to 1.
+            threshold (float): Minimum score of the results. Defaults to 0.75.
+            indexes (List[str]): List of collection names to query. Defaults to ["imbd_movies"].
+        Returns:
+            List[Dict]: The documents found.
+        Raises:
+            CircuitOpenError: If the retrieval service is failing and calls are rejected.
+        """
+        key = self.__cache_key(text, limit, threshold, indexes)
+        documents = self.cache.get(key)
+        if documents is not None:
+            logger.debug(f"RAG :: Cache hit for {key}")
+            return documents
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("Retrieval service is unavailable")
+        probe = self.breaker.probing
+
+        body = {
+            "text": text,
+            "limit": limit,
+            "threshold": threshold,
+            "indexes": indexes,
+        }
+        generation = self.generation
+        try:
+            documents = await self.__post(body)
+        except Exception as e:
+            if self.__is_unavailable(e):
+                self.breaker.record_failure()
+            else:
+                # The service answered, the request itself is at fault
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            # Cancelled, e.g. a discarded speculative retrieval
+            if probe:
+                self.breaker.release()
+            raise
+        self.breaker.record_success()
+
+        # Do not cache results that may predate an invalidation
+        if generation == self.generation:
+            self.cache.set(key, documents)
+        return documents
+
+    def invalidate(self, indexes: Optional[List[str]] = None) -> int:
+        """Discard the cached results of the given indexes, or all of them if not specified.
+        Returns:
+            int: Number of cached results discarded.
+        """
+        self.generation += 1
+        if indexes is None:
+            discarded = len(self.cache)
+            self.cache.clear()
+        else:
+            discarded = self.cache.discard_if(
+                lambda key: any(index in key[1] for index in indexes)
+            )
+        logger.info(f"RAG :: Invalidated {discarded} cached results for {indexes}")
+        return discarded
+
+    async def close(self):
+        """Close the pooled connections."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+if RETRIEVAL_BACKEND == "snapshot":
+    retrieval_client = SnapshotRetriever(
+        snapshot_dir=RETRIEVAL_SNAPSHOT_DIR,
+        search_k=RETRIEVAL_SNAPSHOT_SEARCH_K,
+        cache_size=RETRIEVAL_CACHE_SIZE,
+        cache_ttl=RETRIEVAL_CACHE_TTL,
+    )
+else:
+    retrieval_client = RetrievalClient(
+        url=RETRIEVAL_ENDPOINT,
+        timeout=RETRIEVAL_TIMEOUT,
+        retries=RETRIEVAL_RETRIES,
+        backoff=RETRIEVAL_BACKOFF,
+        max_connections=RETRIEVAL_MAX_CONNECTIONS,
+        failure_threshold=RETRIEVAL_FAILURE_THRESHOLD,
+        reset_timeout=RETRIEVAL_RESET_TIMEOUT,
+        cache_size=RETRIEVAL_CACHE_SIZE,
+        cache_ttl=RETRIEVAL_CACHE_TTL,
+    )
@@ -1,15 +1,104 @@
 import os
+from pathlib import Path
 
 INFERENCE_ENDPOINT = os.environ.get("INFERENCE_ENDPOINT")
 INFERENCE_HEALTH_ENDPOINT = os.environ.get("INFERENCE_HEALTH_ENDPOINT")
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", 60))
+INFERENCE_MAX_CONNECTIONS = int(os.environ.get("INFERENCE_MAX_CONNECTIONS", 100))
+INFERENCE_MAX_CONCURRENCY = int(os.environ.get("INFERENCE_MAX_CONCURRENCY", 32))
+INFERENCE_KEEPALIVE_TIMEOUT = float(os.environ.get("INFERENCE_KEEPALIVE_TIMEOUT", 30))
 RETRIEVAL_ENDPOINT = os.environ.get("RETRIEVAL_ENDPOINT")
+RETRIEVAL_HEALTH_ENDPOINT = os.environ.get(
+    "RETRIEVAL_HEALTH_ENDPOINT",
+    (RETRIEVAL_ENDPOINT or "").rsplit("/", 1)[0] + "/healthz",
+)
+RETRIEVAL_TIMEOUT = float(os.environ.get("RETRIEVAL_TIMEOUT", 2))
+RETRIEVAL_RETRIES = int(os.environ.get("RETRIEVAL_RETRIES", 2))
+RETRIEVAL_BACKOFF = float(os.environ.get("RETRIEVAL_BACKOFF", 0.1))
+RETRIEVAL_MAX_CONNECTIONS = int(os.environ.get("RETRIEVAL_MAX_CONNECTIONS", 100))
+RETRIEVAL_FAILURE_THRESHOLD = int(os.environ.get("RETRIEVAL_FAILURE_THRESHOLD", 5))
+RETRIEVAL_RESET_TIMEOUT = float(os.environ.get("RETRIEVAL_RESET_TIMEOUT", 30))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 1024))
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", 300))
+# "http" to search through the retrieval service, "snapshot" to search exported ANN snapshots in-process
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "http").lower()
+RETRIEVAL_SNAPSHOT_DIR = Path(os.environ.get("RETRIEVAL_SNAPSHOT_DIR", "snapshots"))
+RETRIEVAL_SNAPSHOT_SEARCH_K = int(os.environ.get("RETRIEVAL_SNAPSHOT_SEARCH_K", -1))
+# Start retrieval as soon as a moderated message arrives, in parallel with the input rails
+SPECULATIVE_RETRIEVAL = (
+    os.environ.get("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+)
 ALIGNSCORE_ENDPOINT = os.environ.get("ALIGNSCORE_ENDPOINT")
-FACTCHECKING = False
+# Check bot messages against their context in the background, after they are sent
+FACTCHECKING = os.environ.get("FACTCHECKING", "false").lower() == "true"
+FACTCHECK_MODEL = os.environ.get("FACTCHECK_MODEL", "base")
+FACTCHECK_THRESHOLD = float(os.environ.get("FACTCHECK_THRESHOLD", 0.5))
+FACTCHECK_TIMEOUT = float(os.environ.get("FACTCHECK_TIMEOUT", 10))
+FACTCHECK_QUEUE_SIZE = int(os.environ.get("FACTCHECK_QUEUE_SIZE", 100))
+FACTCHECK_WORKERS = int(os.environ.get("FACTCHECK_WORKERS", 4))
+# "oldest" to drop the oldest queued message when the queue is full, "newest" to drop the new one
+FACTCHECK_DROP_POLICY = os.environ.get("FACTCHECK_DROP_POLICY", "oldest").lower()
+FACTCHECK_RESULTS_SIZE = int(os.environ.get("FACTCHECK_RESULTS_SIZE", 10000))
+FACTCHECK_RESULTS_TTL = float(os.environ.get("FACTCHECK_RESULTS_TTL", 3600))
+# Seconds a streamed answer stays open for its fact-check result
+FACTCHECK_STREAM_TIMEOUT = float(os.environ.get("FACTCHECK_STREAM_TIMEOUT", 5))
+
+# Dependencies are probed in the background, health endpoints answer from the latest status
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", 10))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get("HEALTH_CHECK_TIMEOUT", 1))
+
+# Local embeddings
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+
+# Semantic cache of answers to context-free questions
+RESPONSE_CACHE_ENABLED = (
+    os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+)
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get("RESPONSE_CACHE_THRESHOLD", 0.95))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+
+# Local classification of user intents, skipping the LLM when confident
+INTENT_CLASSIFIER_ENABLED = (
+    os.environ.get("INTENT_CLASSIFIER_ENABLED", "true").lower() == "true"
+)
+INTENT_MIN_MARGIN = float(os.environ.get("INTENT_MIN_MARGIN", 0.05))
+INTENT_MIN_SIMILARITY = float(os.environ.get("INTENT_MIN_SIMILARITY", 0.7))
+
+# Warm-start snapshots of the intent classifier embeddings (arrays and JSON only)
+GUARDRAILS_SNAPSHOT_ENABLED = (
+    os.environ.get("GUARDRAILS_SNAPSHOT_ENABLED", "true").lower() == "true"
+)
+GUARDRAILS_SNAPSHOT_DIR = Path(
+    os.environ.get(
+        "GUARDRAILS_SNAPSHOT_DIR",
+        Path(__file__).resolve().parent.parent / ".cache" / "guardrails",
+    )
+).resolve()
+
+# Structured answers to factual questions, from the tabular datasets
+FACTS_ENABLED = os.environ.get("FACTS_ENABLED", "true").lower() == "true"
+FACTS_DATA_DIR = Path(os.environ.get("FACTS_DATA_DIR", "data"))
+# Answer factual questions directly, without generating a bot message with the LLM.
+# Disabled by default: the fact is given to the LLM as context instead.
+FACTS_SKIP_LLM = os.environ.get("FACTS_SKIP_LLM", "false").lower() == "true"
+
+# Conversation history
+HISTORY_MEMORY_SIZE = int(os.environ.get("HISTORY_MEMORY_SIZE", 10))
+HISTORY_MAX_SESSIONS = int(os.environ.get("HISTORY_MAX_SESSIONS", 10000))
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", 100000))
+HISTORY_TTL = float(os.environ.get("HISTORY_TTL", 3600))
+
+# Shared token required in the X-Internal-Token header of the /internal routes, which are
+# disabled when it is unset
+INTERNAL_API_TOKEN = os.environ.get("INTERNAL_API_TOKEN")
 
 HOST = os.environ.get("HOST", "localhost")
 PORT = os.environ.get("PORT", 8000)
 ENDPOINTS = {
     "moderated": f"http://{HOST}:{PORT}/api/generate_moderated",
     "unmoderated": f"http://{HOST}:{PORT}/api/generate_unmoderated",
+    "moderated_stream": f"http://{HOST}:{PORT}/api/generate_moderated/stream",
+    "unmoderated_stream": f"http://{HOST}:{PORT}/api/generate_unmoderated/stream",
     "clear": f"http://{HOST}:{PORT}/api/clear",
 }
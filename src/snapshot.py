@@ -0,0 +1,106 @@
+# Warm-start snapshots of the intent classifier built from the guardrails configuration
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import nemoguardrails
+import numpy as np
+
+from src.intents import IntentClassifier
+from src.settings import EMBEDDING_MODEL
+
+logger = logging.getLogger(__name__)
+
+
+def config_digest(path_to_config: Path) -> str:
+    """Hash what a snapshot depends on: the guardrails configuration files (config.yaml and
+    colang flows), the embedding model of the intent examples and the nemoguardrails version
+    the examples were parsed with.
+    """
+    digest = hashlib.sha256(str(path_to_config.resolve()).encode())
+    digest.update(f"\0{EMBEDDING_MODEL}\0{nemoguardrails.__version__}\0".encode())
+    files = sorted(
+        [*path_to_config.rglob("*.yaml"), *path_to_config.rglob("*.yml")]
+        + list(path_to_config.rglob("*.co"))
+    )
+    for file in files:
+        digest.update(str(file.relative_to(path_to_config)).encode())
+        digest.update(file.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def load_snapshot(path_to_config: Path, snapshot_dir: Path) -> Optional[Dict[str, Any]]:
+    """Load the intent classifier snapshot of a guardrails configuration, if one matches its
+    current files. Snapshots only hold arrays and JSON, never pickled objects.
+    Args:
+        path_to_config (Path): Path to the guardrails configuration folder.
+        snapshot_dir (Path): Folder where snapshots are stored.
+    Returns:
+        Optional[Dict[str, Any]]: The `intents`, `labels` and memory-mapped `embeddings` of
+            the intent classifier examples.
+    """
+    directory = snapshot_dir / config_digest(path_to_config)
+    if not (directory / "intents.json").exists():
+        logger.info(f"No intent snapshot found at {directory}")
+        return None
+
+    try:
+        with open(directory / "intents.json", "r") as f:
+            intents = json.load(f)
+        snapshot = {
+            "intents": intents["intents"],
+            "labels": np.array(intents["labels"]),
+            "embeddings": np.load(directory / "intents.npy", mmap_mode="r"),
+        }
+    except Exception as e:
+        logger.warning(f"Could not load intent snapshot at {directory}: {e}")
+        return None
+
+    logger.info(f"Loaded intent snapshot from {directory}")
+    return snapshot
+
+
+def save_snapshot(
+    path_to_config: Path, snapshot_dir: Path, classifier: IntentClassifier
+):
+    """Store the intent classifier snapshot of a guardrails configuration, keyed by the hash
+    of its files.
+    Args:
+        path_to_config (Path): Path to the guardrails configuration folder.
+        snapshot_dir (Path): Folder where snapshots are stored.
+        classifier (IntentClassifier): The intent classifier built from the configuration.
+    """
+    directory = snapshot_dir / config_digest(path_to_config)
+    staging = None
+    try:
+        # Stage in a directory of its own, since workers may build the same snapshot at once
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(prefix=f"{directory.name}.", dir=snapshot_dir))
+        np.save(staging / "intents.npy", np.asarray(classifier.embeddings))
+        with open(staging / "intents.json", "w") as f:
+            json.dump(
+                {"intents": classifier.intents, "labels": classifier.labels.tolist()},
+                f,
+            )
+        # Publish the snapshot atomically. If another worker published it first, keep theirs:
+        # both were built from the same digest.
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            if not (directory / "intents.json").exists():
+                raise
+            logger.info(f"Intent snapshot already saved to {directory}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+    except Exception as e:
+        logger.warning(f"Could not save intent snapshot at {directory}: {e}")
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        return
+
+    logger.info(f"Saved intent snapshot to {directory}")
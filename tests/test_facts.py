@@ -0,0 +1,100 @@
+# Unit tests of the fact store, on small tables written like the datasets of data/
+import csv
+
+import pytest
+
+from src.facts import FactStore
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def movie(name, year, rating, **values):
+    return {
+        "Movie Name": name,
+        "Year of Release": str(year),
+        "Run Time in minutes": values.get("runtime", "120"),
+        "Movie Rating": str(rating),
+        "Votes": values.get("votes", "1000"),
+        "Gross": "",
+        "Genre": "['Drama']",
+        "Certification": values.get("certification", "PG-13"),
+        "Director": str(values.get("director", ["Christopher Nolan"])),
+        "Stars": "['Leonardo DiCaprio']",
+    }
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data")
+    write_csv(
+        data_dir / "movie_data.csv",
+        [
+            movie("Inception", 2010, 8.8),
+            movie("Oppenheimer", 2023, 8.4),
+            movie("I", 2015, 7.4, director=["S. Shankar"], certification="Not Rated"),
+            movie("Up", 2009, 8.3, runtime="96", director=["Pete Docter"]),
+            movie("The Batman", 2022, 7.8, director=["Matt Reeves"]),
+            movie("Batman Begins", 2005, 8.2),
+            movie(
+                "The Lord of the Rings",
+                1978,
+                6.2,
+                runtime="132",
+                director=["Ralph Bakshi"],
+            ),
+        ],
+    )
+    return FactStore.from_directory(data_dir)
+
+
+@pytest.mark.parametrize(
+    "question, answer",
+    [
+        (
+            "Who directed Inception?",
+            "Inception (2010) was directed by Christopher Nolan.",
+        ),
+        (
+            "What is the IMDb rating of Inception?",
+            "The IMDb rating of Inception (2010) is 8.8 out of 10.",
+        ),
+        (
+            "What is the IMDb score of Oppenheimer?",
+            "The IMDb rating of Oppenheimer (2023) is 8.4 out of 10.",
+        ),
+        ("How long is Up?", "Up (2009) runs for 1 hour and 36 minutes."),
+        ("What is The Batman rated?", "The Batman (2022) is rated PG-13."),
+        ("When was Oppenheimer released?", "Oppenheimer was released in 2023."),
+    ],
+)
+def test_answers_factual_questions(store, question, answer):
+    assert store.answer(question)["answer"] == answer
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        # Pronouns and stop words are not one-word titles
+        "I want a movie with a good rating",
+        "Can I ask who directed the film that won Best Picture?",
+        "What movies are rated R that I can watch with friends?",
+        # Superlatives and franchises are about several movies
+        "Which Batman movie has the highest rating?",
+        "How long is the Lord of the Rings trilogy?",
+        # Attributes the tables do not hold
+        "Who composed the score for Inception?",
+        "Is Oppenheimer released on Netflix?",
+        "Can I stream Oppenheimer yet? When does it come out?",
+    ],
+)
+def test_ignores_other_questions(store, question):
+    assert store.answer(question) is None
+
+
+def test_quoted_single_word_title(store):
+    assert store.answer("Who directed 'I'?")["title"] == "I"